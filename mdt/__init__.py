@@ -188,7 +188,7 @@ def sample_model(model, problem_data, output_folder, sampler=None, recalculate=F
 
 def batch_fit(data_folder, batch_profile=None, subjects_selection=None, recalculate=False,
               models_to_fit=None, cascade_subdir=False, cl_device_ind=None, dry_run=False,
-              double_precision=False, tmp_results_dir=True):
+              double_precision=False, tmp_results_dir=True, parallel=1, retry_failed=True):
     """Run all the available and applicable models on the data in the given folder.
 
     Args:
@@ -212,6 +212,11 @@ def batch_fit(data_folder, batch_profile=None, subjects_selection=None, recalcul
         double_precision (boolean): if we would like to do the calculations in double precision
         tmp_results_dir (str, True or None): The temporary dir for the calculations. Set to a string to use
                 that path directly, set to True to use the config value, set to None to disable.
+        parallel (int): the number of subjects to process in parallel, each in a worker process pinned to a subset
+            of the devices. This requires Python 3.4 or higher. See :class:`~mdt.model_fitting.BatchFitting`
+            for details.
+        retry_failed (boolean): if we retry the subjects and models that failed in a previous run. The state of every
+            subject and model is kept in the batch jobs database in the data folder.
 
     Returns:
         The list of subjects we will calculate / have calculated.
@@ -225,7 +230,8 @@ def batch_fit(data_folder, batch_profile=None, subjects_selection=None, recalcul
     batch_fitting = BatchFitting(data_folder, batch_profile=batch_profile, subjects_selection=subjects_selection,
                                  recalculate=recalculate, models_to_fit=models_to_fit, cascade_subdir=cascade_subdir,
                                  cl_device_ind=cl_device_ind, double_precision=double_precision,
-                                 tmp_results_dir=tmp_results_dir)
+                                 tmp_results_dir=tmp_results_dir, parallel=parallel,
+                                 retry_failed=retry_failed)
 
     if dry_run:
         return batch_fitting.get_subjects_info()
@@ -1,7 +1,13 @@
-import glob
+import fnmatch
 import logging
 import os
+import re
 import shutil
+import sqlite3
+import stat
+import threading
+import time
+from contextlib import contextmanager
 import six
 from six import string_types
 from mdt.components_loader import BatchProfilesLoader, get_model
@@ -9,7 +15,7 @@ from mdt.data_loaders.protocol import ProtocolLoader
 from mdt.masking import create_write_median_otsu_brain_mask
 from mdt.models.cascade import DMRICascadeModelInterface
 from mdt.protocols import load_protocol, auto_load_protocol
-from mdt.utils import split_image_path, AutoDict, load_problem_data
+from mdt.utils import split_image_path, AutoDict, load_problem_data, get_fingerprint, get_file_fingerprint
 from mdt.nifti import load_nifti
 
 __author__ = 'Robbert Harms'
@@ -165,7 +171,7 @@ class SimpleBatchProfile(BatchProfile):
             float or None: a float if a float could be loaded from a file noise_std, else nothing.
         """
         file_path = file_path or os.path.join(self._root_dir, subject_id, 'noise_std')
-        noise_std_files = glob.glob(file_path + '*')
+        noise_std_files = self._glob(file_path + '*')
         if len(noise_std_files):
             with open(noise_std_files[0], 'r') as f:
                 return float(f.read())
@@ -181,6 +187,28 @@ class SimpleBatchProfile(BatchProfile):
         """
         return []
 
+    def _glob(self, pattern):
+        """Find the paths matching the given pattern, using the cached directory index of the root dir.
+
+        Use this (and :meth:`_isfile` and :meth:`_isdir`) instead of ``glob.glob`` when looking for subjects, such that
+        every directory is listed only once, for all the batch profiles. See :class:`DirectoryIndex`.
+
+        Args:
+            pattern (str): the glob pattern
+
+        Returns:
+            list of str: the sorted paths matching the pattern
+        """
+        return get_directory_index(self._root_dir).glob(pattern)
+
+    def _isfile(self, path):
+        """Check using the directory index if the given path is an existing file."""
+        return get_directory_index(self._root_dir).isfile(path)
+
+    def _isdir(self, path):
+        """Check using the directory index if the given path is an existing directory."""
+        return get_directory_index(self._root_dir).isdir(path)
+
     def _get_subject_output_dir(self, subject_id, mask_fname, subject_base_dir=None):
         """Helper function for generating the output directory for a subject.
 
@@ -218,7 +246,7 @@ class SimpleBatchProfile(BatchProfile):
             if fname:
                 if prepend_path:
                     fname = os.path.join(prepend_path, fname)
-                if os.path.isfile(fname):
+                if self._isfile(fname):
                     return fname
         return default
 
@@ -255,6 +283,179 @@ class SimpleBatchProfile(BatchProfile):
             bval_fname=bval_fname, protocol_columns=protocol_columns)
 
 
+class DirectoryIndex(object):
+
+    _magic_check = re.compile('[*?[]')
+
+    def __init__(self):
+        """Cached directory listings for quickly finding files, without listing or globbing directories repeatedly.
+
+        Every directory is listed once when first needed (using ``os.scandir`` if available, which gives the file types
+        without extra stat calls) and the listing is cached together with the modification time of the directory.
+        Since adding or removing entries updates the modification time of a directory, :meth:`refresh` can
+        efficiently drop the listings of the directories that changed.
+        """
+        self._listings = {}
+        self._lock = threading.Lock()
+
+    def listdir(self, directory):
+        """Get the entries of the given directory.
+
+        Args:
+            directory (str): the directory to list
+
+        Returns:
+            dict: per entry name if the entry is a directory (True) or not (False), or None if the type could not be
+                determined (for example for broken links). Empty if the directory does not exist.
+        """
+        directory = os.path.abspath(directory)
+        with self._lock:
+            if directory in self._listings:
+                return self._listings[directory][1]
+
+        mtime = _get_mtime(directory)
+        entries = {}
+        if mtime is not None:
+            try:
+                entries = _scan_directory(directory)
+            except OSError:
+                pass
+
+        with self._lock:
+            self._listings[directory] = (mtime, entries)
+        return entries
+
+    def exists(self, path):
+        """Check if the given path exists."""
+        directory, name = os.path.split(os.path.abspath(path))
+        if not name:
+            return os.path.isdir(path)
+        return name in self.listdir(directory)
+
+    def isfile(self, path):
+        """Check if the given path is an existing file."""
+        directory, name = os.path.split(os.path.abspath(path))
+        if not name:
+            return False
+        return self.listdir(directory).get(name, True) is False
+
+    def isdir(self, path):
+        """Check if the given path is an existing directory."""
+        directory, name = os.path.split(os.path.abspath(path))
+        if not name:
+            return os.path.isdir(path)
+        return self.listdir(directory).get(name) is True
+
+    def glob(self, pattern):
+        """Find the paths matching the given pattern, similar to ``glob.glob``.
+
+        As with ``glob.glob``, hidden entries (starting with a dot) only match patterns starting with a dot and a
+        pattern ending with a path separator only matches directories, returned with a trailing separator.
+
+        Args:
+            pattern (str): the glob pattern, may contain wildcards in every path component
+
+        Returns:
+            list of str: the sorted paths matching the pattern
+        """
+        separators = os.sep + (os.altsep or '')
+        if pattern.endswith(tuple(separators)):
+            directory_pattern = pattern.rstrip(separators)
+            if not directory_pattern:
+                return [pattern] if self.isdir(pattern) else []
+            return [path + os.sep for path in self.glob(directory_pattern) if self.isdir(path)]
+
+        if not self._magic_check.search(pattern):
+            return [pattern] if self.exists(pattern) else []
+
+        directory, name_pattern = os.path.split(pattern)
+        if self._magic_check.search(directory):
+            directories = [d for d in self.glob(directory) if self.isdir(d)]
+        else:
+            directories = [directory]
+
+        matches = []
+        for directory in directories:
+            for name in sorted(self.listdir(directory or os.curdir)):
+                if name.startswith('.') and not name_pattern.startswith('.'):
+                    continue
+                if fnmatch.fnmatch(name, name_pattern):
+                    matches.append(os.path.join(directory, name))
+        return matches
+
+    def refresh(self):
+        """Drop the cached listings of the directories that were modified (or removed) since they were listed."""
+        with self._lock:
+            listings = list(self._listings.items())
+
+        for directory, (mtime, _) in listings:
+            if _get_mtime(directory) != mtime:
+                with self._lock:
+                    self._listings.pop(directory, None)
+
+
+_directory_indices = {}
+_directory_indices_lock = threading.Lock()
+
+
+def get_directory_index(root_dir, refresh=False):
+    """Get the directory index shared by all batch profiles using the given root directory.
+
+    Args:
+        root_dir (str): the root directory of the batch profiles
+        refresh (boolean): if we want to refresh the index, dropping the listings of modified directories
+
+    Returns:
+        DirectoryIndex: the directory index for the given root directory
+    """
+    root_dir = os.path.abspath(root_dir)
+    with _directory_indices_lock:
+        if root_dir not in _directory_indices:
+            _directory_indices[root_dir] = DirectoryIndex()
+            refresh = False
+        index = _directory_indices[root_dir]
+
+    if refresh:
+        index.refresh()
+    return index
+
+
+def _get_mtime(directory):
+    """Get the modification time of the given directory, or None if it is not a directory."""
+    try:
+        stat_result = os.stat(directory)
+    except OSError:
+        return None
+    if not stat.S_ISDIR(stat_result.st_mode):
+        return None
+    return stat_result.st_mtime
+
+
+def _scan_directory(directory):
+    """List the given directory, see :meth:`DirectoryIndex.listdir`."""
+    if hasattr(os, 'scandir'):
+        entries = {}
+        for entry in os.scandir(directory):
+            try:
+                entries[entry.name] = entry.is_dir()
+                if not entries[entry.name] and not entry.is_file():
+                    entries[entry.name] = None
+            except OSError:
+                entries[entry.name] = None
+        return entries
+
+    entries = {}
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if os.path.isdir(path):
+            entries[name] = True
+        elif os.path.isfile(path):
+            entries[name] = False
+        else:
+            entries[name] = None
+    return entries
+
+
 class SubjectInfo(object):
 
     @property
@@ -275,11 +476,14 @@ class SubjectInfo(object):
         """
         return ''
 
-    def get_problem_data(self):
+    def get_problem_data(self, dtype=None):
         """Get the DMRIProblemData for this subject.
 
         This is the data we will use during model fitting.
 
+        Args:
+            dtype (np.dtype): the storage data type for the problem data, see :func:`mdt.utils.load_problem_data`
+
         Returns:
             :class:`~mdt.utils.DMRIProblemData`: the problem data to use during model fitting
         """
@@ -291,6 +495,17 @@ class SubjectInfo(object):
             str: the filename of the mask to use
         """
 
+    def get_input_fingerprint(self):
+        """Get a fingerprint of the input data of this subject, to detect changes in the input between runs.
+
+        This should be fast to compute, for example by using the size and modification time of the input files
+        instead of their content. See :func:`mdt.utils.get_fingerprint`.
+
+        Returns:
+            str: the fingerprint of the input data, or None if not supported
+        """
+        return None
+
 
 class SimpleSubjectInfo(SubjectInfo):
 
@@ -331,15 +546,34 @@ class SimpleSubjectInfo(SubjectInfo):
     def output_dir(self):
         return self._output_dir
 
-    def get_problem_data(self):
+    def get_problem_data(self, dtype=None):
         protocol = self._protocol_loader.get_protocol()
         brain_mask_fname = self.get_mask_filename()
         return load_problem_data(self._dwi_fname, protocol, brain_mask_fname,
-                                 gradient_deviations=self._get_gradient_deviations(), noise_std=self._noise_std)
+                                 gradient_deviations=self._get_gradient_deviations(), noise_std=self._noise_std,
+                                 dtype=dtype)
 
     def get_subject_id(self):
         return self.subject_id
 
+    def get_input_fingerprint(self):
+        noise_std = self._noise_std
+        if isinstance(noise_std, string_types):
+            noise_std = get_file_fingerprint(noise_std)
+
+        gradient_deviations = None
+        if self._use_gradient_deviations:
+            gradient_deviations = get_file_fingerprint(self._gradient_deviations)
+
+        protocol_files = []
+        if isinstance(self._protocol_loader, BatchFitProtocolLoader):
+            protocol_files = self._protocol_loader.get_input_files()
+
+        return get_fingerprint(get_file_fingerprint(self._dwi_fname),
+                               get_file_fingerprint(self._mask_fname),
+                               [get_file_fingerprint(path) for path in protocol_files],
+                               gradient_deviations, noise_std)
+
     def get_mask_filename(self):
         if not os.path.isfile(self._mask_fname):
             logger = logging.getLogger(__name__)
@@ -455,6 +689,144 @@ class BatchFitProtocolLoader(ProtocolLoader):
         return auto_load_protocol(self._base_dir, protocol_columns=self._protocol_columns,
                                   bvec_fname=self._bvec_fname, bval_fname=self._bval_fname)
 
+    def get_input_files(self):
+        """Get the paths of the files (possibly) used to load the protocol.
+
+        Returns:
+            list of str: the protocol, bvec and bval files, if given
+        """
+        return [path for path in [self._protocol_fname, self._bvec_fname, self._bval_fname] if path]
+
+
+class BatchJobsDatabase(object):
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    SKIPPED = 'skipped'
+
+    def __init__(self, db_path, timeout=600):
+        """A sqlite database with the state of every (subject, model) job of a batch fitting.
+
+        This allows resuming a batch fitting without checking the output of every subject, retrying the failed
+        jobs and reporting the status of the batch fitting. The database can be used by multiple processes
+        at the same time.
+
+        Args:
+            db_path (str): the path to the sqlite database, created if it does not exist
+            timeout (int): the number of seconds to wait for a lock on the database
+        """
+        self._db_path = db_path
+        self._timeout = timeout
+
+    def add_jobs(self, subject_ids, model_names):
+        """Add pending jobs for the given subjects and models, existing jobs are kept as they are.
+
+        Args:
+            subject_ids (list of str): the ids of the subjects
+            model_names (list of str): the names of the models
+        """
+        with self._transaction() as conn:
+            conn.executemany('INSERT OR IGNORE INTO jobs (subject_id, model_name, state, attempts) '
+                             'VALUES (?, ?, ?, 0)',
+                             [(subject_id, model_name, self.PENDING)
+                              for subject_id in subject_ids for model_name in model_names])
+
+    def get_job(self, subject_id, model_name):
+        """Get the information about a single job.
+
+        Args:
+            subject_id (str): the id of the subject
+            model_name (str): the name of the model
+
+        Returns:
+            dict: the columns of the job, or None if there is no such job
+        """
+        with self._transaction() as conn:
+            cursor = conn.execute('SELECT * FROM jobs WHERE subject_id = ? AND model_name = ?',
+                                  (subject_id, model_name))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            return dict(zip([column[0] for column in cursor.description], row))
+
+    def get_jobs(self):
+        """Get the information about all the jobs.
+
+        Returns:
+            list of dict: per job the columns of the job, ordered by subject and model
+        """
+        if not os.path.isfile(self._db_path):
+            return []
+        with self._transaction() as conn:
+            cursor = conn.execute('SELECT * FROM jobs ORDER BY subject_id, model_name')
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def set_running(self, subject_id, model_name, device=None):
+        """Mark the given job as running.
+
+        Args:
+            subject_id (str): the id of the subject
+            model_name (str): the name of the model
+            device (str): a description of the device(s) used
+        """
+        with self._transaction() as conn:
+            conn.execute('INSERT OR IGNORE INTO jobs (subject_id, model_name, attempts) VALUES (?, ?, 0)',
+                         (subject_id, model_name))
+            conn.execute('UPDATE jobs SET state = ?, started_at = ?, finished_at = NULL, runtime = NULL, device = ?, '
+                         'error = NULL, attempts = attempts + 1 WHERE subject_id = ? AND model_name = ?',
+                         (self.RUNNING, time.time(), device, subject_id, model_name))
+
+    def set_finished(self, subject_id, model_name, state, fingerprint=None, error=None):
+        """Mark the given job as finished with the given state.
+
+        Args:
+            subject_id (str): the id of the subject
+            model_name (str): the name of the model
+            state (str): the final state, one of DONE, FAILED or SKIPPED
+            fingerprint (str): the fingerprint of the input data of the subject
+            error (str): the error message, if any
+        """
+        finished_at = time.time()
+        with self._transaction() as conn:
+            conn.execute('INSERT OR IGNORE INTO jobs (subject_id, model_name, attempts) VALUES (?, ?, 0)',
+                         (subject_id, model_name))
+            conn.execute('UPDATE jobs SET state = ?, finished_at = ?, runtime = ? - COALESCE(started_at, ?), '
+                         'fingerprint = ?, error = ? WHERE subject_id = ? AND model_name = ?',
+                         (state, finished_at, finished_at, finished_at, fingerprint, error, subject_id, model_name))
+
+    @contextmanager
+    def _transaction(self):
+        """Create an exclusive transaction on the database, creating the table if needed."""
+        conn = sqlite3.connect(self._db_path, timeout=self._timeout, isolation_level=None)
+        try:
+            conn.execute('BEGIN EXCLUSIVE')
+            try:
+                conn.execute('CREATE TABLE IF NOT EXISTS jobs (subject_id TEXT, model_name TEXT, state TEXT, '
+                             'started_at REAL, finished_at REAL, runtime REAL, device TEXT, error TEXT, '
+                             'fingerprint TEXT, attempts INTEGER, PRIMARY KEY (subject_id, model_name))')
+                yield conn
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+
+def get_batch_jobs_database(data_folder):
+    """Get the batch jobs database of the given data folder.
+
+    Args:
+        data_folder (str): the data folder of the batch fitting
+
+    Returns:
+        BatchJobsDatabase: the jobs database, stored in the file ``mdt_batch_jobs.sqlite`` in the data folder
+    """
+    return BatchJobsDatabase(os.path.join(data_folder, 'mdt_batch_jobs.sqlite'))
+
 
 class BatchFitSubjectOutputInfo(object):
 
@@ -574,6 +946,8 @@ def batch_profile_factory(batch_profile, data_folder):
         If the given batch profile is None we return the output from get_best_batch_profile(). If batch profile is
         a string we use it from the batch profiles loader. Else we return the input.
     """
+    get_directory_index(data_folder, refresh=True)
+
     if batch_profile is None:
         batch_profile = get_best_batch_profile(data_folder)
     elif isinstance(batch_profile, string_types):
@@ -12,10 +12,12 @@ A few of the batch profile settings can be altered with arguments to this script
 use_gradient_deviations and models_to_fit override the values in the batch profile.
 """
 import argparse
+import datetime
 import os
+from collections import Counter
 import mdt
 from argcomplete.completers import FilesCompleter
-from mdt.batch_utils import batch_profile_factory, SelectedSubjects
+from mdt.batch_utils import batch_profile_factory, SelectedSubjects, get_batch_jobs_database
 from mdt.components_loader import BatchProfilesLoader
 
 from mdt.shell_utils import BasicShellApplication
@@ -44,6 +46,8 @@ class BatchFit(BasicShellApplication):
                 mdt-batch-fit /data/mgh --batch-profile 'HCP_MGH'
                 mdt-batch-fit . --subjects-index 0 1 2 --subjects-id 1003 1004
                 mdt-batch-fit . --dry-run
+                mdt-batch-fit . --cl-device-ind 0 1 2 3 --parallel 4
+                mdt-batch-fit . --status
         """)
         batch_profiles = BatchProfilesLoader().list_all()
 
@@ -103,9 +107,29 @@ class BatchFit(BasicShellApplication):
                             help='The directory for the temporary results. The default ("True") uses the config file '
                                  'setting. Set to the literal "None" to disable.').completer = FilesCompleter()
 
+        parser.add_argument('--parallel', type=int, default=1,
+                            help='The number of subjects to process in parallel. Every subject is processed in a '
+                                 'worker process that uses its own subset of the devices, the log of every '
+                                 'subject is written to batch_fit.log in its output directory. Requires '
+                                 'Python 3.4 or higher. Default 1.')
+
+        parser.add_argument('--retry-failed', dest='retry_failed', action='store_true',
+                            help="Retry the subjects and models that failed in a previous run. (default)")
+        parser.add_argument('--no-retry-failed', dest='retry_failed', action='store_false',
+                            help="Skip the subjects and models that failed in a previous run.")
+        parser.set_defaults(retry_failed=True)
+
+        parser.add_argument('--status', dest='status', action='store_true',
+                            help="Show the status of the batch fitting from the batch jobs database and exit.")
+        parser.set_defaults(status=False)
+
         return parser
 
     def run(self, args):
+        if args.status:
+            print_status(os.path.realpath(args.data_folder))
+            return
+
         batch_profile = batch_profile_factory(args.batch_profile, os.path.realpath(args.data_folder))
 
         if args.use_gradient_deviations is not None:
@@ -135,7 +159,39 @@ class BatchFit(BasicShellApplication):
                       double_precision=args.double_precision,
                       dry_run=args.dry_run,
                       cascade_subdir=args.cascade_subdir,
-                      tmp_results_dir=tmp_results_dir)
+                      tmp_results_dir=tmp_results_dir,
+                      parallel=args.parallel,
+                      retry_failed=args.retry_failed)
+
+
+def print_status(data_folder):
+    """Print the status of the batch fitting in the given data folder, using the batch jobs database.
+
+    Args:
+        data_folder (str): the data folder of the batch fitting
+    """
+    jobs = get_batch_jobs_database(data_folder).get_jobs()
+    if not jobs:
+        print('No batch fitting jobs found in {}.'.format(data_folder))
+        return
+
+    states = sorted(set(job['state'] for job in jobs))
+    counts = Counter((job['model_name'], job['state']) for job in jobs)
+
+    print('{:<40}'.format('Model') + ''.join('{:>10}'.format(state) for state in states))
+    for model_name in sorted(set(job['model_name'] for job in jobs)):
+        print('{:<40}'.format(model_name) + ''.join('{:>10}'.format(counts[(model_name, state)]) for state in states))
+
+    for job in jobs:
+        if job['state'] in ('running', 'failed'):
+            started = ''
+            if job['started_at']:
+                started = datetime.datetime.fromtimestamp(job['started_at']).strftime('%Y-%m-%d %H:%M:%S')
+            print('\n{} {} on subject {}, started at {} on device(s) {}, attempts: {}'.format(
+                job['state'].capitalize(), job['model_name'], job['subject_id'], started, job['device'],
+                job['attempts']))
+            if job['error']:
+                print(job['error'].strip().splitlines()[-1])
 
 
 if __name__ == '__main__':
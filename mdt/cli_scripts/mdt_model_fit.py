@@ -122,7 +122,8 @@ class ModelFit(BasicShellApplication):
                                             os.path.realpath(args.protocol),
                                             os.path.realpath(args.mask),
                                             gradient_deviations=args.gradient_deviations,
-                                            noise_std=noise_std),
+                                            noise_std=noise_std,
+                                            dtype=mdt.utils.get_storage_dtype(args.double_precision)),
                       output_folder, recalculate=args.recalculate,
                       only_recalculate_last=args.only_recalculate_last, cl_device_ind=args.cl_device_ind,
                       double_precision=args.double_precision,
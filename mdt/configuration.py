@@ -20,6 +20,7 @@ using :py:func:`config_context`. Example:
 """
 import os
 import re
+import tempfile
 from copy import deepcopy
 
 import collections
@@ -148,6 +149,17 @@ def load_from_dict(config_dict):
         loader.load(value)
 
 
+def get_config_dict():
+    """Get a copy of the current runtime configuration.
+
+    This can be used to transfer the current configuration to another process, see :class:`SetConfigDict`.
+
+    Returns:
+        dict: a deep copy of the current configuration
+    """
+    return deepcopy(_config)
+
+
 def update_gui_config(update_dict):
     """Update the GUI configuration file with the given settings.
 
@@ -211,6 +223,20 @@ class OutputFormatLoader(ConfigSectionLoader):
             if 'gzip' in options:
                 config_insert(['output_format', item, 'gzip'], bool(options['gzip']))
 
+        gzip_options = value.get('gzip_options', {}) or {}
+        if 'compression_level' in gzip_options:
+            config_insert(['output_format', 'gzip_options', 'compression_level'],
+                          int(gzip_options['compression_level']))
+        if 'nmr_workers' in gzip_options:
+            nmr_workers = gzip_options['nmr_workers']
+            config_insert(['output_format', 'gzip_options', 'nmr_workers'],
+                          int(nmr_workers) if nmr_workers else None)
+
+        dtypes = value.get('dtypes', {}) or {}
+        for map_class in ['parameters', 'vectors', 'return_codes', 'indices']:
+            if map_class in dtypes:
+                config_insert(['output_format', 'dtypes', map_class], dtypes[map_class] or None)
+
 
 class LoggingLoader(ConfigSectionLoader):
     """Loader for the top level key logging. """
@@ -240,6 +266,15 @@ class OptimizationSettingsLoader(ConfigSectionLoader):
             for key, sub_value in value['model_specific'].items():
                 config_insert(['optimization', 'model_specific', key], sub_value)
 
+        refit_info = value.get('refit_failed_voxels', {}) or {}
+        if 'enabled' in refit_info:
+            config_insert(['optimization', 'refit_failed_voxels', 'enabled'], bool(refit_info['enabled']))
+        if 'return_codes' in refit_info:
+            config_insert(['optimization', 'refit_failed_voxels', 'return_codes'],
+                          [int(code) for code in refit_info['return_codes']])
+        if 'optimizer' in refit_info:
+            config_insert(['optimization', 'refit_failed_voxels', 'optimizer'], refit_info['optimizer'])
+
 
 class SampleSettingsLoader(ConfigSectionLoader):
     """Loads the sampling section"""
@@ -277,6 +312,37 @@ class TmpResultsDirSectionLoader(ConfigSectionLoader):
         config_insert(['tmp_results_dir'], value)
 
 
+class NiftiCacheSectionLoader(ConfigSectionLoader):
+    """Load the section nifti_cache"""
+
+    def load(self, value):
+        if 'enabled' in value:
+            config_insert(['nifti_cache', 'enabled'], bool(value['enabled']))
+        if 'max_size' in value:
+            config_insert(['nifti_cache', 'max_size'], int(value['max_size']))
+
+
+class OutputMapsSectionLoader(ConfigSectionLoader):
+    """Load the section output_maps"""
+
+    def load(self, value):
+        if 'general' in value:
+            config_insert(['output_maps', 'general'], value['general'] or {})
+
+        ensure_exists(['output_maps', 'model_specific'])
+        if 'model_specific' in value:
+            for key, options in (value['model_specific'] or {}).items():
+                config_insert(['output_maps', 'model_specific', key], options)
+
+
+class BatchFittingSectionLoader(ConfigSectionLoader):
+    """Load the section batch_fitting"""
+
+    def load(self, value):
+        if 'prefetch_max_memory' in value:
+            config_insert(['batch_fitting', 'prefetch_max_memory'], int(value['prefetch_max_memory'] or 0))
+
+
 class NoiseStdEstimationSectionLoader(ConfigSectionLoader):
     """Load the section noise_std_estimating"""
 
@@ -336,6 +402,15 @@ def get_section_loader(section):
     if section == 'tmp_results_dir':
         return TmpResultsDirSectionLoader()
 
+    if section == 'nifti_cache':
+        return NiftiCacheSectionLoader()
+
+    if section == 'output_maps':
+        return OutputMapsSectionLoader()
+
+    if section == 'batch_fitting':
+        return BatchFittingSectionLoader()
+
     if section == 'noise_std_estimating':
         return NoiseStdEstimationSectionLoader()
 
@@ -363,6 +438,39 @@ def gzip_sampling_results():
     return _config['output_format']['sampling']['gzip']
 
 
+def get_gzip_compression_level():
+    """Get the compression level for writing gzipped volume maps.
+
+    Returns:
+        int: the gzip compression level, from 1 (fastest) to 9 (smallest)
+    """
+    return _config['output_format']['gzip_options']['compression_level']
+
+
+def get_gzip_nmr_workers():
+    """Get the number of volume maps we compress concurrently.
+
+    Returns:
+        int: the number of workers for compressing volume maps, or None to use one worker per CPU core.
+    """
+    return _config['output_format']['gzip_options']['nmr_workers']
+
+
+def get_output_dtype(map_class):
+    """Get the data type in which we store the result maps of the given class.
+
+    Args:
+        map_class (str): one of 'parameters' (single volume floating point maps), 'vectors' (floating point maps
+            with multiple volumes), 'return_codes' (the optimizer return codes) or 'indices' (other integer maps,
+            like rankings and indices)
+
+    Returns:
+        str: the name of the numpy data type to store the maps in, or None to store the maps in the data type
+            in which they were computed
+    """
+    return _config['output_format'].get('dtypes', {}).get(map_class)
+
+
 def get_tmp_results_dir():
     """Get the default tmp results directory.
 
@@ -375,6 +483,45 @@ def get_tmp_results_dir():
     return _config['tmp_results_dir']
 
 
+def use_nifti_cache():
+    """Check if we use the cache of decompressed .nii.gz input volumes.
+
+    Returns:
+        boolean: if the cache of decompressed input volumes is enabled
+    """
+    return _config['nifti_cache']['enabled']
+
+
+def get_nifti_cache_dir():
+    """Get the directory of the cache of decompressed .nii.gz input volumes.
+
+    This is the directory 'nifti_cache' in the tmp results dir, or in the system temporary directory if the tmp results
+    dir is not set.
+
+    Returns:
+        str: the directory for the decompressed volumes
+    """
+    return os.path.join(get_tmp_results_dir() or tempfile.gettempdir(), 'nifti_cache')
+
+
+def get_nifti_cache_max_size():
+    """Get the maximum size of the cache of decompressed .nii.gz input volumes.
+
+    Returns:
+        int: the maximum number of bytes of all the cached volumes together
+    """
+    return _config['nifti_cache']['max_size']
+
+
+def get_batch_fitting_prefetch_max_memory():
+    """Get the maximum memory for prefetching the data of the next subjects during batch fitting.
+
+    Returns:
+        int: the maximum number of bytes of prefetched subject data, 0 disables prefetching
+    """
+    return _config.get('batch_fitting', {}).get('prefetch_max_memory', 0)
+
+
 def get_processing_strategy(processing_type, model_names=None):
     """Get the correct processing strategy for the given model.
 
@@ -399,6 +546,27 @@ def get_processing_strategy(processing_type, model_names=None):
     return ProcessingStrategiesLoader().load(strategy_name, **options)
 
 
+def get_output_maps_selection(model_names=None):
+    """Get the include and exclude regexes of the output maps we want to compute and write for the given model.
+
+    Args:
+        model_names (list of str): the list of model names (the full recursive cascade of model names)
+
+    Returns:
+        tuple: two lists, the regexes of the maps to include and the regexes of the maps to exclude. An empty
+            include list means we include all maps.
+    """
+    options = _config.get('output_maps', {}).get('general', {}) or {}
+
+    if model_names and _config.get('output_maps', {}).get('model_specific'):
+        info_dict = get_model_config(model_names, _config['output_maps']['model_specific'])
+
+        if info_dict:
+            options = info_dict
+
+    return list(options.get('include', []) or []), list(options.get('exclude', []) or [])
+
+
 def get_noise_std_estimators():
     """Get the noise std estimators for finding the std of the noise.
 
@@ -451,6 +619,33 @@ def get_optimizer_for_model(model_names):
         return get_general_optimizer()
 
 
+def refit_failed_voxels():
+    """Check if we should refit the voxels that failed to converge using the refit optimizer.
+
+    Returns:
+        boolean: True if the failed voxels should be refitted, False otherwise.
+    """
+    return _config['optimization']['refit_failed_voxels']['enabled']
+
+
+def get_refit_return_codes():
+    """Get the optimizer return codes that mark a voxel as failed and in need of a refit.
+
+    Returns:
+        list of int: the return codes of the voxels we refit
+    """
+    return _config['optimization']['refit_failed_voxels']['return_codes']
+
+
+def get_refit_optimizer():
+    """Load the optimizer used for refitting the failed voxels.
+
+    Returns:
+        optimizer: the optimization routine for refitting the failed voxels
+    """
+    return _resolve_optimizer(_config['optimization']['refit_failed_voxels']['optimizer'])
+
+
 def _resolve_optimizer(optimizer_info):
     """Resolve the optimization routine from the given information dictionary.
 
@@ -683,6 +878,22 @@ class YamlStringAction(SimpleConfigAction):
         load_from_yaml(self._yaml_str)
 
 
+class SetConfigDict(SimpleConfigAction):
+
+    def __init__(self, config_dict):
+        """Replace the entire runtime configuration with the given configuration.
+
+        Args:
+            config_dict (dict): a complete configuration, as returned by :func:`get_config_dict`
+        """
+        super(SetConfigDict, self).__init__()
+        self._config_dict = config_dict
+
+    def _apply(self):
+        global _config
+        _config = deepcopy(self._config_dict)
+
+
 class SetGeneralSampler(SimpleConfigAction):
 
     def __init__(self, sampler_name, settings=None):
@@ -1,4 +1,3 @@
-import glob
 import os
 
 import mdt
@@ -51,7 +50,7 @@ class DirPerSubject(SimpleBatchProfile):
 
     def _get_subjects(self):
         subjects = []
-        for subject_id in sorted([os.path.basename(f) for f in glob.glob(os.path.join(self._root_dir, '*'))]):
+        for subject_id in sorted([os.path.basename(f) for f in self._glob(os.path.join(self._root_dir, '*'))]):
             pjoin = mdt.make_path_joiner(self._root_dir, subject_id)
             subject_info = self._get_subject_in_directory(subject_id, pjoin)
             if subject_info:
@@ -68,13 +67,13 @@ class DirPerSubject(SimpleBatchProfile):
         Returns:
             SimpleSubjectInfo or None: the subject info for this particular subject
         """
-        niftis = glob.glob(pjoin('*.nii*'))
+        niftis = self._glob(pjoin('*.nii*'))
         dwis = list(filter(lambda v: all(name not in v for name in ['_mask', 'grad_dev', 'noise_std']), niftis))
         masks = list(filter(lambda v: '_mask' in v, niftis))
         grad_devs = list(filter(lambda v: 'grad_dev' in v, niftis))
-        protocols = glob.glob(pjoin('*prtcl'))
-        bvals = glob.glob(pjoin('*bval*'))
-        bvecs = glob.glob(pjoin('*bvec*'))
+        protocols = self._glob(pjoin('*prtcl'))
+        bvals = self._glob(pjoin('*bval*'))
+        bvecs = self._glob(pjoin('*bvec*'))
         noise_std = self._autoload_noise_std(subject_id)
 
         if dwis:
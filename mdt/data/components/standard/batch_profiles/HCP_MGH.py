@@ -1,4 +1,3 @@
-import glob
 import os
 import mdt
 from mdt.batch_utils import SimpleBatchProfile, BatchFitProtocolLoader, SimpleSubjectInfo
@@ -38,33 +37,33 @@ class HCP_MGH(SimpleBatchProfile):
         self._output_base_dir = 'diff/preproc/output'
 
     def _get_subjects(self):
-        dirs = sorted([os.path.basename(f) for f in glob.glob(os.path.join(self._root_dir, '*'))])
+        dirs = sorted([os.path.basename(f) for f in self._glob(os.path.join(self._root_dir, '*'))])
         subjects = []
         for subject_id in dirs:
             pjoin = mdt.make_path_joiner(self._root_dir, subject_id, 'diff', 'preproc')
-            if os.path.isdir(pjoin()):
-                dwi_fname = list(glob.glob(pjoin('mri', 'diff_preproc.nii*')))[0]
+            if self._isdir(pjoin()):
+                dwi_fname = list(self._glob(pjoin('mri', 'diff_preproc.nii*')))[0]
                 noise_std = self._autoload_noise_std(subject_id, file_path=pjoin('noise_std'))
 
                 bval_fname = pjoin('bvals.txt')
-                if os.path.isfile(pjoin('diff_preproc.bval')):
+                if self._isfile(pjoin('diff_preproc.bval')):
                     bval_fname = pjoin('diff_preproc.bval')
 
                 bvec_fname = pjoin('bvecs_fsl_moco_norm.txt')
-                if os.path.isfile(pjoin('diff_preproc.bvec')):
+                if self._isfile(pjoin('diff_preproc.bvec')):
                     bvec_fname = pjoin('diff_preproc.bvec')
 
                 prtcl_fname = None
-                if os.path.isfile(pjoin('diff_preproc.prtcl')):
+                if self._isfile(pjoin('diff_preproc.prtcl')):
                     prtcl_fname = pjoin('diff_preproc.prtcl')
 
                 mask_fname = None
-                if list(glob.glob(pjoin('diff_preproc_mask.nii*'))):
-                    mask_fname = list(glob.glob(pjoin('diff_preproc_mask.nii*')))[0]
+                if list(self._glob(pjoin('diff_preproc_mask.nii*'))):
+                    mask_fname = list(self._glob(pjoin('diff_preproc_mask.nii*')))[0]
 
                 if mask_fname is None:
-                    if list(glob.glob(pjoin('mri', 'diff_preproc_mask.nii*'))):
-                        mask_fname = list(glob.glob(pjoin('mri', 'diff_preproc_mask.nii*')))[0]
+                    if list(self._glob(pjoin('mri', 'diff_preproc_mask.nii*'))):
+                        mask_fname = list(self._glob(pjoin('mri', 'diff_preproc_mask.nii*')))[0]
 
                 protocol_loader = BatchFitProtocolLoader(
                     pjoin(),
@@ -1,4 +1,3 @@
-import glob
 import os
 import mdt
 from mdt.batch_utils import SimpleBatchProfile, SimpleSubjectInfo
@@ -42,9 +41,9 @@ class HCP_WUMINN(SimpleBatchProfile):
 
     def _get_subjects(self):
         subjects = []
-        for subject_id in sorted([os.path.basename(f) for f in glob.glob(os.path.join(self._root_dir, '*'))]):
+        for subject_id in sorted([os.path.basename(f) for f in self._glob(os.path.join(self._root_dir, '*'))]):
             pjoin = mdt.make_path_joiner(self._root_dir, subject_id, 'T1w', 'Diffusion')
-            if os.path.isdir(pjoin()):
+            if self._isdir(pjoin()):
                 subject_info = self._get_subject_in_directory(subject_id, pjoin)
                 if subject_info:
                     subjects.append(subject_info)
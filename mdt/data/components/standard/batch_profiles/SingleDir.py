@@ -1,4 +1,3 @@
-import glob
 import os
 import mdt
 from mdt.batch_utils import SimpleBatchProfile, BatchFitProtocolLoader, SimpleSubjectInfo
@@ -50,15 +49,15 @@ class SingleDir(SimpleBatchProfile):
     def _get_subjects(self):
         pjoin = mdt.make_path_joiner(self._root_dir)
 
-        files = [os.path.basename(f) for f in glob.glob(pjoin('*'))]
+        files = [os.path.basename(f) for f in self._glob(pjoin('*'))]
         basenames = sorted(list({split_image_path(f)[1] for f in files}))
         subjects = []
 
         protocol_options = ['TE', 'TR', 'Delta', 'delta', 'maxG']
 
         default_mask = None
-        if list(glob.glob(pjoin('mask.nii*'))):
-            default_mask = list(glob.glob(pjoin('mask.nii*')))[0]
+        if list(self._glob(pjoin('mask.nii*'))):
+            default_mask = list(self._glob(pjoin('mask.nii*')))[0]
 
         for basename in basenames:
             dwi_fname = None
@@ -0,0 +1,85 @@
+import timeit
+from mdt.components_loader import get_component_class
+from mdt.processing_strategies import ChunkSizeTuningCache, ThroughputTuner, get_memory_limited_nmr_voxels
+
+__author__ = 'Robbert Harms'
+__date__ = "2017-03-08"
+__maintainer__ = "Robbert Harms"
+__email__ = "robbert.harms@maastrichtuniversity.nl"
+
+
+meta_info = {'title': 'Fit in chunks of voxel ranges with a self-tuning chunk size',
+             'description': 'Processes a model in chunks of voxel ranges, '
+                            'the chunk size is tuned using the measured throughput.'}
+
+
+class AdaptiveVoxelRange(get_component_class('processing_strategies', 'VoxelRange')):
+
+    def __init__(self, nmr_voxels=20000, min_nmr_voxels=1000, max_nmr_voxels=None, memory_fraction=0.5,
+                 step_factor=2.0, tuned_step_factor=1.25, use_tuning_cache=True, **kwargs):
+        """Optimize a given dataset in batches of voxels, tuning the batch size during processing.
+
+        After every chunk this measures the throughput (the number of voxels processed per second) and
+        grows or shrinks the size of the next chunk towards the size with the best throughput. If a larger chunk
+        improves the throughput we continue growing, if not we reverse direction with a smaller step. The chunk size
+        is bounded by the memory limits, see :func:`~mdt.processing_strategies.get_memory_limited_nmr_voxels`.
+
+        The best size found is stored in a tuning cache per model name, protocol length, precision and the devices in
+        use. Later runs start at the cached size and only fine-tune it with the ``tuned_step_factor``.
+
+        Args:
+            nmr_voxels (int): the size of the first chunk if there is no cached size
+            min_nmr_voxels (int): the minimum number of voxels per chunk
+            max_nmr_voxels (int): the maximum number of voxels per chunk, set to None to only bound by memory
+            memory_fraction (float): the fraction of the available host and device memory we may use
+            step_factor (float): the initial factor with which we grow or shrink the chunk size
+            tuned_step_factor (float): the initial factor to use if we start from a cached size
+            use_tuning_cache (boolean): if we want to read and write the tuned size from and to the tuning cache
+        """
+        super(AdaptiveVoxelRange, self).__init__(nmr_voxels=nmr_voxels, **kwargs)
+        self._min_nmr_voxels = min_nmr_voxels
+        self._max_nmr_voxels = max_nmr_voxels
+        self._memory_fraction = memory_fraction
+        self._step_factor = step_factor
+        self._tuned_step_factor = tuned_step_factor
+        self._use_tuning_cache = use_tuning_cache
+
+    def _chunks_generator(self, model, problem_data, output_path, worker, total_roi_indices):
+        cache = ChunkSizeTuningCache()
+        cache_key = cache.get_key(model)
+
+        max_nmr_voxels = get_memory_limited_nmr_voxels(model, memory_fraction=self._memory_fraction)
+        if self._max_nmr_voxels:
+            max_nmr_voxels = min(max_nmr_voxels, self._max_nmr_voxels)
+        max_nmr_voxels = max(self._min_nmr_voxels, max_nmr_voxels)
+
+        def bounded(nmr_voxels):
+            return int(min(max_nmr_voxels, max(self._min_nmr_voxels, nmr_voxels)))
+
+        tuner = ThroughputTuner(bounded(self.nmr_voxels), self._step_factor, bounded)
+
+        if self._use_tuning_cache:
+            cached_size = cache.get(cache_key)
+            if cached_size:
+                self._logger.info('Starting with the tuned chunk size of {} voxels.'.format(cached_size))
+                tuner = ThroughputTuner(bounded(cached_size), self._tuned_step_factor, bounded)
+
+        ind_start = 0
+        while ind_start < len(total_roi_indices):
+            chunk_size = tuner.chunk_size
+            ind_end = min(len(total_roi_indices), ind_start + chunk_size)
+
+            start_time = timeit.default_timer()
+            yield total_roi_indices[ind_start:ind_end]
+            run_time = timeit.default_timer() - start_time
+
+            timings = worker.chunk_timings
+            self._logger.debug('Chunk of {} voxels took {:.2f} seconds (processing: {}, writing: {}).'.format(
+                ind_end - ind_start, run_time, timings['process'], timings['write']))
+
+            if ind_end - ind_start == chunk_size:
+                tuner.add_measurement(chunk_size, run_time)
+            ind_start = ind_end
+
+        if self._use_tuning_cache and tuner.best_chunk_size:
+            cache.set(cache_key, tuner.best_chunk_size)
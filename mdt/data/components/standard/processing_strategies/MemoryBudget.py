@@ -0,0 +1,60 @@
+from mdt.processing_strategies import ChunksProcessingStrategy, get_memory_limited_nmr_voxels, yield_voxel_ranges
+
+__author__ = 'Robbert Harms'
+__date__ = "2017-03-06"
+__maintainer__ = "Robbert Harms"
+__email__ = "robbert.harms@maastrichtuniversity.nl"
+
+
+meta_info = {'title': 'Fit in chunks sized to the available memory',
+             'description': 'Processes a model in chunks of voxel ranges, '
+                            'the number of voxels is computed from the available host and device memory.'}
+
+
+class MemoryBudget(ChunksProcessingStrategy):
+
+    def __init__(self, memory_fraction=0.5, host_memory=None, device_memory=None, min_nmr_voxels=1000,
+                 max_nmr_voxels=None, **kwargs):
+        """Optimize a given dataset in batches of voxels, sized to fit the available memory.
+
+        For every model this estimates the memory needed per voxel, using the protocol length, the number of
+        parameters, the number of output maps and the precision of the model. The number of voxels per batch is
+        then the largest number of voxels for which the estimated memory fits in the given fraction of both the
+        host memory and the global memory of the OpenCL devices.
+
+        Args:
+            memory_fraction (float): the fraction of the available host and device memory we may use
+            host_memory (int): the host memory we may use in MB, if not set we use the memory fraction of the
+                memory currently available on the host.
+            device_memory (int): the device memory we may use in MB, if not set we use the memory fraction of the
+                global memory of the smallest device in use.
+            min_nmr_voxels (int): the minimum number of voxels per batch
+            max_nmr_voxels (int): the maximum number of voxels per batch, set to None for no maximum
+        """
+        super(MemoryBudget, self).__init__(**kwargs)
+        self._memory_fraction = memory_fraction
+        self._host_memory = host_memory
+        self._device_memory = device_memory
+        self._min_nmr_voxels = min_nmr_voxels
+        self._max_nmr_voxels = max_nmr_voxels
+
+    def _chunks_generator(self, model, problem_data, output_path, worker, total_roi_indices):
+        nmr_voxels = self._get_nmr_voxels(model)
+        self._logger.info('Using a memory budget of {} voxels per batch.'.format(nmr_voxels))
+
+        return yield_voxel_ranges(total_roi_indices, nmr_voxels)
+
+    def _get_nmr_voxels(self, model):
+        """Get the number of voxels per batch that fit in the memory budget.
+
+        Args:
+            model (:class:`~mdt.models.composite.DMRICompositeModel`): the model we are processing
+
+        Returns:
+            int: the number of voxels per batch
+        """
+        nmr_voxels = get_memory_limited_nmr_voxels(model, memory_fraction=self._memory_fraction,
+                                                   host_memory=self._host_memory, device_memory=self._device_memory)
+        if self._max_nmr_voxels:
+            nmr_voxels = min(nmr_voxels, self._max_nmr_voxels)
+        return int(max(self._min_nmr_voxels, nmr_voxels))
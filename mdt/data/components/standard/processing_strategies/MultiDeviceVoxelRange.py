@@ -0,0 +1,32 @@
+from mdt.processing_strategies import QueuedChunksProcessingStrategy, yield_voxel_ranges
+
+__author__ = 'Robbert Harms'
+__date__ = "2017-03-02"
+__maintainer__ = "Robbert Harms"
+__email__ = "robbert.harms@maastrichtuniversity.nl"
+
+
+meta_info = {'title': 'Fit in chunks of voxel ranges, one worker per device',
+             'description': 'Processes a model in chunks of voxel ranges, every device processes its own chunks.'}
+
+
+class MultiDeviceVoxelRange(QueuedChunksProcessingStrategy):
+
+    def __init__(self, nmr_voxels=10000, **kwargs):
+        """Optimize a given dataset in batches of the given number of voxels, concurrently on all devices.
+
+        Instead of dividing every chunk over all devices, every device gets its own chunks from a queue of chunks.
+        As such, it is best to use smaller chunks than with the regular VoxelRange strategy, such that the
+        last chunks are more evenly divided over the devices.
+
+        Args:
+            nmr_voxels (int): the number of voxels per batch
+
+        Attributes:
+            nmr_voxels (int): the number of voxels per chunk
+        """
+        super(MultiDeviceVoxelRange, self).__init__(**kwargs)
+        self.nmr_voxels = nmr_voxels
+
+    def _chunks_generator(self, model, problem_data, output_path, worker, total_roi_indices):
+        return yield_voxel_ranges(total_roi_indices, self.nmr_voxels)
@@ -41,7 +41,6 @@ class ProtocolDependent(SimpleProcessingStrategy):
             if int(col_length) < problem_data.get_nmr_inst_per_problem():
                 if voxel_range:
                     return load_component('processing_strategies', 'VoxelRange', nmr_voxels=int(voxel_range),
-                                          tmp_dir=self._tmp_dir, honor_voxels_to_analyze=self._honor_voxels_to_analyze)
+                                          **self._get_shared_options())
 
-        return load_component('processing_strategies', 'AllVoxelsAtOnce', tmp_dir=self._tmp_dir,
-                              honor_voxels_to_analyze=self._honor_voxels_to_analyze)
+        return load_component('processing_strategies', 'AllVoxelsAtOnce', **self._get_shared_options())
@@ -0,0 +1,33 @@
+from mdt.processing_strategies import ShardedChunksProcessingStrategy, yield_voxel_ranges
+
+__author__ = 'Robbert Harms'
+__date__ = "2017-03-13"
+__maintainer__ = "Robbert Harms"
+__email__ = "robbert.harms@maastrichtuniversity.nl"
+
+
+meta_info = {'title': 'Fit in chunks of voxel ranges, shared by multiple processes',
+             'description': 'Processes a model in chunks of voxel ranges, '
+                            'the chunks are divided over all processes fitting the same model to the same output.'}
+
+
+class ShardedVoxelRange(ShardedChunksProcessingStrategy):
+
+    def __init__(self, nmr_voxels=10000, **kwargs):
+        """Optimize a given dataset in batches of the given number of voxels, shared by multiple processes.
+
+        Start multiple processes (for example one per device) fitting the same model with the same output folder,
+        each process claims and processes the next batch of voxels until all batches are done.
+        The last process combines the results.
+
+        Args:
+            nmr_voxels (int): the number of voxels per batch
+
+        Attributes:
+            nmr_voxels (int): the number of voxels per chunk
+        """
+        super(ShardedVoxelRange, self).__init__(**kwargs)
+        self.nmr_voxels = nmr_voxels
+
+    def _chunks_generator(self, model, problem_data, output_path, worker, total_roi_indices):
+        return yield_voxel_ranges(total_roi_indices, self.nmr_voxels)
@@ -1,4 +1,4 @@
-from mdt.processing_strategies import ChunksProcessingStrategy
+from mdt.processing_strategies import ChunksProcessingStrategy, yield_voxel_ranges
 
 __author__ = 'Robbert Harms'
 __date__ = "2015-11-29"
@@ -25,6 +25,4 @@ class VoxelRange(ChunksProcessingStrategy):
         self.nmr_voxels = nmr_voxels
 
     def _chunks_generator(self, model, problem_data, output_path, worker, total_roi_indices):
-        for ind_start in range(0, len(total_roi_indices), self.nmr_voxels):
-            ind_end = min(len(total_roi_indices), ind_start + self.nmr_voxels)
-            yield total_roi_indices[ind_start:ind_end]
+        return yield_voxel_ranges(total_roi_indices, self.nmr_voxels)
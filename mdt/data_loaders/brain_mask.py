@@ -72,4 +72,6 @@ class BrainMaskFromArray(BrainMaskLoader):
         self._mask_data = mask_data
 
     def get_data(self):
+        if self._mask_data.dtype == np.bool_:
+            return self._mask_data
         return self._mask_data > 0
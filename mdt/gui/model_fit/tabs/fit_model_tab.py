@@ -133,7 +133,8 @@ class FitModelTab(MainTab, Ui_FitModelTabContent):
             mdt.load_problem_data(self.selectedDWI.text(),
                                   self.selectedProtocol.text(),
                                   self.selectedMask.text(),
-                                  noise_std=self._optim_options.noise_std),
+                                  noise_std=self._optim_options.noise_std,
+                                  dtype=mdt.utils.get_storage_dtype(self._optim_options.double_precision)),
             self.selectedOutputFolder.text(),
             recalculate=True,
             double_precision=self._optim_options.double_precision,
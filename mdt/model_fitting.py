@@ -1,21 +1,35 @@
 import collections
 import glob
+import json
 import logging
+import multiprocessing
 import os
+import shutil
+import sys
+import threading
 import time
 import timeit
+import traceback
+from collections import deque
 from contextlib import contextmanager
+import numpy as np
+import six
 from six import string_types
 from mdt.__version__ import __version__
-from mdt.nifti import get_all_image_data
-from mdt.batch_utils import batch_profile_factory, AllSubjects
+from mdt.nifti import get_all_image_data, load_nifti, write_nifti, nifti_filepath_resolution, yield_nifti_info, \
+    ScaledVolume
+from mdt.batch_utils import batch_profile_factory, AllSubjects, BatchJobsDatabase, get_batch_jobs_database
 from mdt.components_loader import get_model
-from mdt.configuration import get_processing_strategy, get_optimizer_for_model
+from mdt.configuration import get_processing_strategy, get_optimizer_for_model, refit_failed_voxels, \
+    get_refit_optimizer, get_refit_return_codes, get_output_maps_selection, get_config_dict, SetConfigDict, \
+    get_batch_fitting_prefetch_max_memory
 from mdt.models.cascade import DMRICascadeModelInterface
 from mdt.protocols import write_protocol
 from mdt.utils import create_roi, get_cl_devices, model_output_exists, \
-    per_model_logging_context, get_temporary_results_dir
-from mdt.processing_strategies import SimpleModelProcessingWorkerGenerator, FittingProcessingWorker
+    per_model_logging_context, get_temporary_results_dir, restore_volumes, get_storage_dtype, OutputMapsSelection, \
+    get_model_fit_fingerprint, load_output_manifest, remove_output_manifest, write_output_manifest
+from mdt.processing_strategies import SimpleModelProcessingWorkerGenerator, FittingProcessingWorker, \
+    get_fitting_results_prefetch
 from mdt.exceptions import InsufficientProtocolError
 from mot.load_balance_strategies import EvenDistribution
 import mot.configuration
@@ -31,7 +45,8 @@ class BatchFitting(object):
 
     def __init__(self, data_folder, batch_profile=None, subjects_selection=None, recalculate=False,
                  models_to_fit=None, cascade_subdir=False,
-                 cl_device_ind=None, double_precision=False, tmp_results_dir=True):
+                 cl_device_ind=None, double_precision=False, tmp_results_dir=True, parallel=1,
+                 use_jobs_database=True, retry_failed=True):
         """This class is meant to make running computations as simple as possible.
 
         The idea is that a single folder is enough to fit_model the computations. One can optionally give it the
@@ -61,6 +76,20 @@ class BatchFitting(object):
             double_precision (boolean): if we would like to do the calculations in double precision
             tmp_results_dir (str, True or None): The temporary dir for the calculations. Set to a string to use
                 that path directly, set to True to use the config value, set to None to disable.
+            parallel (int): the number of subjects to process in parallel. If larger than one, the subjects are
+                processed in a pool of (spawned) worker processes, each pinned to a subset of the devices
+                in ``cl_device_ind`` (or of the devices selected by the load balancer if not given). The log of each
+                subject is written to the file ``batch_fit.log`` in the output directory of that subject. When
+                processing the subjects one by one, the data of the next subject is loaded in the background while
+                the current subject is fitted, see the ``batch_fitting`` section of the configuration. Parallel
+                processing requires the spawn start method of multiprocessing (Python 3.4 and up), forking would copy
+                the OpenCL state of this process into the workers. On older interpreters we raise an error if this is
+                larger than one.
+            use_jobs_database (boolean): if we keep the state of every subject and model in a sqlite database in the
+                data folder (see :class:`~mdt.batch_utils.BatchJobsDatabase`). This database is used to resume the
+                batch fitting, to recalculate models whose input data changed and to report the status.
+            retry_failed (boolean): if we retry the subjects and models that failed in a previous run, only used
+                with the jobs database.
         """
         self._logger = logging.getLogger(__name__)
         self._batch_profile = batch_profile_factory(batch_profile, data_folder)
@@ -76,6 +105,15 @@ class BatchFitting(object):
         self._recalculate = recalculate
         self._double_precision = double_precision
         self._cascade_subdir = cascade_subdir
+        self._parallel = max(1, parallel or 1)
+        self._retry_failed = retry_failed
+
+        if self._parallel > 1:
+            _get_spawn_context()  # fails early, before we initialize any OpenCL state in this process
+
+        self._jobs_db = None
+        if use_jobs_database:
+            self._jobs_db = get_batch_jobs_database(data_folder)
 
         if self._batch_profile is None:
             raise RuntimeError('No suitable batch profile could be '
@@ -119,19 +157,296 @@ class BatchFitting(object):
         """Run the computations on the current dir with all the configured options. """
         self._logger.info('Running computations on {0} subjects'.format(len(self._subjects)))
 
+        if self._jobs_db is not None:
+            self._jobs_db.add_jobs([subject.subject_id for subject in self._subjects],
+                                   [_get_model_name(model) for model in self._models_to_fit])
+
+        if self._parallel > 1 and len(self._subjects) > 1:
+            return self._run_parallel()
+
         run_func = _BatchFitRunner(self._models_to_fit, self._recalculate, self._cascade_subdir,
-                                   self._cl_device_ind, self._double_precision, self._tmp_results_dir)
-        for ind, subject in enumerate(self._subjects):
+                                   self._cl_device_ind, self._double_precision, self._tmp_results_dir,
+                                   jobs_db=self._jobs_db, retry_failed=self._retry_failed)
+
+        prefetch_max_memory = get_batch_fitting_prefetch_max_memory()
+        if prefetch_max_memory:
+            def load_problem_data(subject_info):
+                if run_func.is_done(subject_info):
+                    return None
+                return run_func.load_problem_data(subject_info)
+            subjects_data = _ProblemDataPrefetcher(self._subjects, load_problem_data, prefetch_max_memory)
+        else:
+            subjects_data = ((subject, None) for subject in self._subjects)
+
+        for ind, (subject, problem_data) in enumerate(subjects_data):
             self._logger.info('Going to process subject {}, ({} of {}, we are at {:.2%})'.format(
                 subject.subject_id, ind + 1, len(self._subjects), ind / len(self._subjects)))
-            run_func(subject)
+            run_func(subject, problem_data=problem_data)
 
         return self._subjects
 
+    def _run_parallel(self):
+        """Run the computations with the subjects divided over a pool of worker processes.
+
+        The worker processes are spawned (not forked) to give every worker a clean OpenCL state. Every worker is
+        pinned to its own group of devices and gets a copy of the current configuration. A failing subject does not
+        stop the other subjects, after all subjects are processed we raise an error listing the failed subjects.
+        """
+        nmr_workers = min(self._parallel, len(self._subjects))
+        device_groups = _get_device_groups(self._cl_device_ind, nmr_workers)
+
+        self._logger.info('Processing the subjects with {} worker processes, using the devices: {}'.format(
+            nmr_workers, device_groups))
+
+        runner_kwargs = dict(models_to_fit=self._models_to_fit, recalculate=self._recalculate,
+                             cascade_subdir=self._cascade_subdir, double_precision=self._double_precision,
+                             tmp_results_dir=self._tmp_results_dir, jobs_db=self._jobs_db,
+                             retry_failed=self._retry_failed)
+
+        context = _get_spawn_context()
+        devices_queue = context.Queue()
+        for device_group in device_groups:
+            devices_queue.put(device_group)
+
+        pool = context.Pool(nmr_workers, initializer=_init_batch_fit_worker,
+                            initargs=(devices_queue, get_config_dict()))
+        try:
+            jobs = [(subject, pool.apply_async(_run_batch_fit_worker, (runner_kwargs, subject)))
+                    for subject in self._subjects]
+
+            failed_subjects = []
+            for ind, (subject, job) in enumerate(jobs):
+                try:
+                    job.get()
+                except Exception as exc:
+                    failed_subjects.append(subject.subject_id)
+                    self._logger.error('Processing subject {} failed with: {}, see the log file {}.'.format(
+                        subject.subject_id, exc, _get_subject_log_path(subject)))
+                else:
+                    self._logger.info('Finished subject {} ({} of {}), see the log file {}.'.format(
+                        subject.subject_id, ind + 1, len(self._subjects), _get_subject_log_path(subject)))
+        finally:
+            pool.close()
+            pool.join()
+
+        if failed_subjects:
+            raise RuntimeError('Processing failed for the subjects: {}.'.format(', '.join(failed_subjects)))
+
+        return self._subjects
+
+
+def _get_device_groups(cl_device_ind, nmr_groups):
+    """Divide the devices round robin over the given number of groups.
+
+    If there are fewer devices than groups, the devices are shared by multiple groups.
+
+    Args:
+        cl_device_ind (list of int): the indices of the devices to divide, if None we use the devices selected by the
+            load balancer of the current MOT runtime configuration
+        nmr_groups (int): the number of groups
+
+    Returns:
+        list of list of int: per group the indices of the devices to use
+    """
+    if cl_device_ind is None:
+        devices = get_cl_devices()
+        used_devices = mot.configuration.get_load_balancer().get_used_cl_environments(devices)
+        cl_device_ind = [ind for ind, device in enumerate(devices) if device in used_devices]
+
+    if len(cl_device_ind) >= nmr_groups:
+        return [list(cl_device_ind[ind::nmr_groups]) for ind in range(nmr_groups)]
+    return [[cl_device_ind[ind % len(cl_device_ind)]] for ind in range(nmr_groups)]
+
+
+def _get_spawn_context():
+    """Get the multiprocessing context for the batch fit worker processes.
+
+    We never fall back to forking, since the forked workers would inherit the OpenCL state of the main process.
+
+    Returns:
+        the spawn context, only available in Python 3.4 and up
+
+    Raises:
+        RuntimeError: if the spawn start method is not available
+    """
+    if not hasattr(multiprocessing, 'get_context'):
+        raise RuntimeError('Processing subjects in parallel requires the spawn start method of multiprocessing, '
+                           'which is not available in this Python version (Python 3.4 and up is required).')
+    return multiprocessing.get_context('spawn')
+
+
+def _get_subject_log_path(subject_info):
+    """Get the path to the log file of a subject processed by a batch fit worker process."""
+    return os.path.join(subject_info.output_dir, 'batch_fit.log')
+
+
+_worker_cl_device_ind = None
+
+
+def _init_batch_fit_worker(devices_queue, config_dict):
+    """Initialize a batch fit worker process.
+
+    This claims a group of devices for this worker and applies the configuration of the main process.
+
+    Args:
+        devices_queue (multiprocessing.Queue): the queue with the device groups, we claim one group
+        config_dict (dict): the configuration of the main process
+    """
+    global _worker_cl_device_ind
+    SetConfigDict(config_dict).apply()
+
+    _worker_cl_device_ind = devices_queue.get()
+    devices = get_cl_devices()
+    mot.configuration.set_cl_environments([devices[ind] for ind in _worker_cl_device_ind])
+
+
+def _run_batch_fit_worker(runner_kwargs, subject_info):
+    """Run the batch fitting of one subject in a worker process, using the devices claimed by this worker.
+
+    Args:
+        runner_kwargs (dict): the keyword arguments for the :class:`_BatchFitRunner`, except the devices
+        subject_info (SubjectInfo): the subject to process
+    """
+    runner = _BatchFitRunner(cl_device_ind=_worker_cl_device_ind, **runner_kwargs)
+
+    log_path = _get_subject_log_path(subject_info)
+    if not os.path.isdir(os.path.dirname(log_path)):
+        os.makedirs(os.path.dirname(log_path))
+
+    handler = logging.FileHandler(log_path)
+    handler.setFormatter(logging.Formatter('[%(asctime)s] [%(levelname)s] [%(name)s] [%(funcName)s] - %(message)s'))
+    loggers = [logging.getLogger('mdt'), logging.getLogger('mot')]
+    for logger in loggers:
+        logger.addHandler(handler)
+    try:
+        logging.getLogger(__name__).info('Processing subject {} using the devices {}'.format(
+            subject_info.subject_id, _worker_cl_device_ind))
+        runner(subject_info)
+    except Exception:
+        logging.getLogger(__name__).exception('Processing subject {} failed.'.format(subject_info.subject_id))
+        raise
+    finally:
+        for logger in loggers:
+            logger.removeHandler(handler)
+        handler.close()
+
+
+def _get_model_name(model):
+    """Get the name of the given model, which can be given by name or as a model object."""
+    if isinstance(model, string_types):
+        return model
+    return model.name
+
+
+class _ProblemDataPrefetcher(object):
+
+    def __init__(self, subjects, load_function, max_memory, max_prefetched=1):
+        """Iterate over the subjects while loading the problem data of the next subjects in a background thread.
+
+        The prefetched problem data is kept in a staging buffer bounded by the number of subjects and by memory. Since
+        the size of the data of a subject is only known after loading, we use the size of the previously loaded
+        subject as estimate. If that does not fit in the remaining memory we only load the next subject when it is
+        requested. Loading errors are raised when the failed subject is requested.
+
+        Args:
+            subjects (list of SubjectInfo): the subjects to iterate over
+            load_function (func): the function to load the problem data of a subject, may return None
+            max_memory (int): the maximum size in bytes of the problem data in the staging buffer
+            max_prefetched (int): the maximum number of subjects in the staging buffer
+        """
+        self._subjects = subjects
+        self._load_function = load_function
+        self._max_memory = max_memory
+        self._max_prefetched = max_prefetched
+        self._buffer = deque()
+        self._staged_memory = 0
+        self._consumer_waiting = False
+        self._stopped = False
+        self._condition = threading.Condition()
+
+    def __iter__(self):
+        """Yields per subject a tuple with the subject info and the loaded problem data."""
+        self._stopped = False
+        thread = threading.Thread(target=self._load_all)
+        thread.daemon = True
+        thread.start()
+
+        try:
+            for _ in range(len(self._subjects)):
+                with self._condition:
+                    self._consumer_waiting = True
+                    self._condition.notify_all()
+                    while not self._buffer:
+                        self._condition.wait()
+                    self._consumer_waiting = False
+
+                    subject, problem_data, nmr_bytes, exc_info = self._buffer.popleft()
+                    self._staged_memory -= nmr_bytes
+                    self._condition.notify_all()
+
+                if exc_info is not None:
+                    six.reraise(*exc_info)
+                yield subject, problem_data
+        finally:
+            with self._condition:
+                self._stopped = True
+                self._condition.notify_all()
+
+    def _load_all(self):
+        """Load the problem data of all subjects, run in the background thread."""
+        estimated_memory = 0
+        for subject in self._subjects:
+            with self._condition:
+                while not (self._stopped or (self._consumer_waiting and not self._buffer) or
+                           (len(self._buffer) < self._max_prefetched and
+                            self._staged_memory + estimated_memory <= self._max_memory)):
+                    self._condition.wait()
+                if self._stopped:
+                    return
+
+            problem_data, exc_info = None, None
+            try:
+                problem_data = self._load_function(subject)
+            except Exception:
+                exc_info = sys.exc_info()
+
+            nmr_bytes = _get_problem_data_memory_size(problem_data)
+            if problem_data is not None:
+                estimated_memory = nmr_bytes
+
+            with self._condition:
+                self._buffer.append((subject, problem_data, nmr_bytes, exc_info))
+                self._staged_memory += nmr_bytes
+                self._condition.notify_all()
+
+            if exc_info is not None:
+                return
+
+
+def _get_problem_data_memory_size(problem_data):
+    """Get the (approximate) number of bytes used by the volumes of the given problem data.
+
+    Args:
+        problem_data (DMRIProblemData): the problem data, can be None
+
+    Returns:
+        int: the number of bytes of the DWI volume, mask and gradient deviations
+    """
+    if problem_data is None:
+        return 0
+
+    nmr_bytes = 0
+    for volume in [problem_data.dwi_volume, problem_data.mask, problem_data.gradient_deviations]:
+        if isinstance(volume, ScaledVolume):
+            volume = volume.data
+        nmr_bytes += getattr(volume, 'nbytes', 0)
+    return nmr_bytes
+
 
 class _BatchFitRunner(object):
 
-    def __init__(self, models_to_fit, recalculate, cascade_subdir, cl_device_ind, double_precision, tmp_results_dir):
+    def __init__(self, models_to_fit, recalculate, cascade_subdir, cl_device_ind, double_precision, tmp_results_dir,
+                 jobs_db=None, retry_failed=True):
         self._models_to_fit = models_to_fit
         self._recalculate = recalculate
         self._cascade_subdir = cascade_subdir
@@ -139,33 +454,50 @@ class _BatchFitRunner(object):
         self._double_precision = double_precision
         self._logger = logging.getLogger(__name__)
         self._tmp_results_dir = tmp_results_dir
+        self._jobs_db = jobs_db
+        self._retry_failed = retry_failed
 
-    def __call__(self, subject_info):
+    def __call__(self, subject_info, problem_data=None):
         """Run the batch fitting on the given subject.
 
         This is a module level function to allow for python multiprocessing to work.
 
         Args:
             subject_info (SubjectInfo): the subject information
+            problem_data (DMRIProblemData): the (prefetched) problem data of the subject, if None we load it here
         """
         output_dir = subject_info.output_dir
 
-        if all(model_output_exists(model, output_dir) for model in self._models_to_fit) and not self._recalculate:
+        if self.is_done(subject_info):
             self._logger.info('Skipping subject {0}, output exists'.format(subject_info.subject_id))
             return
 
-        self._logger.info('Loading the data (DWI, mask and protocol) of subject {0}'.format(subject_info.subject_id))
-        problem_data = subject_info.get_problem_data()
+        if problem_data is None:
+            problem_data = self.load_problem_data(subject_info)
+
+        fingerprint = subject_info.get_input_fingerprint()
 
         with self._timer(subject_info.subject_id):
             for model in self._models_to_fit:
+                model_name = _get_model_name(model)
+
+                job_status = self._get_job_status(subject_info, model, fingerprint)
+                if job_status == 'done':
+                    self._logger.info('Skipping model {0} on subject {1}, done according to the batch '
+                                      'jobs database'.format(model_name, subject_info.subject_id))
+                    continue
+                if job_status == 'stale':
+                    self._logger.info('The input of subject {0} changed since fitting model {1}, '
+                                      'recalculating.'.format(subject_info.subject_id, model_name))
+
                 self._logger.info('Going to fit model {0} on subject {1}'.format(model, subject_info.subject_id))
+                self._set_job_running(subject_info, model_name)
                 try:
                     model_fit = ModelFit(model,
                                          problem_data,
                                          output_dir,
-                                         recalculate=self._recalculate,
-                                         only_recalculate_last=True,
+                                         recalculate=self._recalculate or job_status == 'stale',
+                                         only_recalculate_last=job_status != 'stale',
                                          cascade_subdir=self._cascade_subdir,
                                          cl_device_ind=self._cl_device_ind,
                                          double_precision=self._double_precision,
@@ -174,8 +506,95 @@ class _BatchFitRunner(object):
                 except InsufficientProtocolError as ex:
                     self._logger.info('Could not fit model {0} on subject {1} '
                                       'due to protocol problems. {2}'.format(model, subject_info.subject_id, ex))
+                    self._set_job_finished(subject_info, model_name, BatchJobsDatabase.SKIPPED, fingerprint, str(ex))
+                except Exception:
+                    self._set_job_finished(subject_info, model_name, BatchJobsDatabase.FAILED, fingerprint,
+                                           traceback.format_exc())
+                    raise
                 else:
                     self._logger.info('Done fitting model {0} on subject {1}'.format(model, subject_info.subject_id))
+                    self._set_job_finished(subject_info, model_name, BatchJobsDatabase.DONE, fingerprint)
+
+    def is_done(self, subject_info):
+        """Check if we can skip the given subject since all the models are fitted.
+
+        If we have a jobs database this uses the state of the jobs in the database, see :meth:`_get_job_status`.
+        Else, this checks if the output of every model exists.
+
+        Args:
+            subject_info (SubjectInfo): the subject information
+
+        Returns:
+            boolean: true if all the models are done and we do not recalculate
+        """
+        if self._recalculate:
+            return False
+
+        if self._jobs_db is None:
+            return all(model_output_exists(model, subject_info.output_dir) for model in self._models_to_fit)
+
+        fingerprint = subject_info.get_input_fingerprint()
+        return all(self._get_job_status(subject_info, model, fingerprint) == 'done' for model in self._models_to_fit)
+
+    def load_problem_data(self, subject_info):
+        """Load the problem data of the given subject in the storage data type of this runner.
+
+        Args:
+            subject_info (SubjectInfo): the subject information
+
+        Returns:
+            DMRIProblemData: the problem data of the subject
+        """
+        self._logger.info('Loading the data (DWI, mask and protocol) of subject {0}'.format(subject_info.subject_id))
+        return subject_info.get_problem_data(dtype=get_storage_dtype(self._double_precision))
+
+    def _get_job_status(self, subject_info, model, fingerprint):
+        """Get the status of fitting the given model on the given subject.
+
+        A job is done if it finished (or could not be fitted due to the protocol) with the same input fingerprint,
+        or if it failed and we do not retry failed jobs. If it finished with a different input fingerprint, the job
+        is stale. Pending jobs are done if their output exists (for example from before the jobs database).
+
+        Args:
+            subject_info (SubjectInfo): the subject information
+            model (str or model): the model to fit
+            fingerprint (str): the current fingerprint of the input data of the subject
+
+        Returns:
+            str: one of 'done' (skip the job), 'stale' (recalculate the job) or 'todo' (run the job)
+        """
+        if self._recalculate or self._jobs_db is None:
+            return 'todo'
+
+        job = self._jobs_db.get_job(subject_info.subject_id, _get_model_name(model))
+
+        if job is not None and job['state'] in (BatchJobsDatabase.DONE, BatchJobsDatabase.SKIPPED):
+            if job['fingerprint'] == fingerprint:
+                return 'done'
+            return 'stale'
+
+        if job is not None and job['state'] == BatchJobsDatabase.FAILED and not self._retry_failed:
+            return 'done'
+
+        if (job is None or job['state'] == BatchJobsDatabase.PENDING) \
+                and model_output_exists(model, subject_info.output_dir):
+            self._jobs_db.set_finished(subject_info.subject_id, _get_model_name(model), BatchJobsDatabase.DONE,
+                                       fingerprint=fingerprint)
+            return 'done'
+
+        return 'todo'
+
+    def _set_job_running(self, subject_info, model_name):
+        if self._jobs_db is not None:
+            device = 'default'
+            if self._cl_device_ind is not None:
+                device = ','.join(map(str, self._cl_device_ind))
+            self._jobs_db.set_running(subject_info.subject_id, model_name, device=device)
+
+    def _set_job_finished(self, subject_info, model_name, state, fingerprint, error=None):
+        if self._jobs_db is not None:
+            self._jobs_db.set_finished(subject_info.subject_id, model_name, state, fingerprint=fingerprint,
+                                       error=error)
 
     @contextmanager
     def _timer(self, subject_id):
@@ -307,24 +726,51 @@ class ModelFit(object):
 
                 optimizer = self._optimizer or get_optimizer_for_model(model_names)
 
+                refit_optimizer = None
+                if refit_failed_voxels():
+                    refit_optimizer = get_refit_optimizer()
+
                 if self._cl_device_indices is not None:
                     all_devices = get_cl_devices()
-                    optimizer.cl_environments = [all_devices[ind] for ind in self._cl_device_indices]
-                    optimizer.load_balancer = EvenDistribution()
+                    for routine in filter(None, [optimizer, refit_optimizer]):
+                        routine.cl_environments = [all_devices[ind] for ind in self._cl_device_indices]
+                        routine.load_balancer = EvenDistribution()
 
                 processing_strategy = get_processing_strategy('optimization', model_names=model_names)
                 processing_strategy.set_tmp_dir(self._tmp_results_dir)
 
+                include, exclude = get_output_maps_selection(model_names)
+
                 fitter = SingleModelFit(model, self._problem_data, self._output_folder, optimizer, processing_strategy,
-                                        recalculate=recalculate)
+                                        recalculate=recalculate, refit_optimizer=refit_optimizer,
+                                        output_maps_include=include, output_maps_exclude=exclude)
                 results = fitter.run()
 
         return results
 
 
+def _get_refit_improvements(old_mse, new_mse):
+    """Get which of the refitted voxels are improved by the refit.
+
+    A refit improves a voxel if it lowers the mean squared error, or if it gives a finite error where the original
+    error is not finite. A refit with a non-finite error never improves a voxel.
+
+    Args:
+        old_mse (ndarray): the mean squared errors of the original fit
+        new_mse (ndarray): the mean squared errors of the refit
+
+    Returns:
+        ndarray: boolean array, True for the voxels improved by the refit
+    """
+    old_mse = np.asarray(old_mse)
+    new_mse = np.asarray(new_mse)
+    return (new_mse < old_mse) | (np.logical_not(np.isfinite(old_mse)) & np.isfinite(new_mse))
+
+
 class SingleModelFit(object):
 
-    def __init__(self, model, problem_data, output_folder, optimizer, processing_strategy, recalculate=False):
+    def __init__(self, model, problem_data, output_folder, optimizer, processing_strategy, recalculate=False,
+                 refit_optimizer=None, refit_return_codes=None, output_maps_include=None, output_maps_exclude=None):
         """Fits a composite model.
 
          This does not accept cascade models. Please use the more general ModelFit class for all models,
@@ -339,6 +785,14 @@ class SingleModelFit(object):
              processing_strategy (:class:`~mdt.processing_strategies.ModelProcessingStrategy`): the processing strategy
                 to use
              recalculate (boolean): If we want to recalculate the results if they are already present.
+             refit_optimizer (:class:`mot.cl_routines.optimizing.base.AbstractOptimizer`): if given, we refit
+                the voxels with a return code in ``refit_return_codes`` using this optimizer after the first fit.
+                The refitted values are used for the voxels where the refit lowered the mean squared error.
+             refit_return_codes (list of int): the optimizer return codes of the voxels we want to refit, if not
+                given we use the return codes from the configuration.
+             output_maps_include (list of str): regexes of the result maps to write, if empty we write all maps
+             output_maps_exclude (list of str): regexes of the result maps we do not want to write. The optimized
+                parameter maps, the return codes and (when refitting) the errors are always written.
          """
         self.recalculate = recalculate
 
@@ -349,6 +803,15 @@ class SingleModelFit(object):
         self._optimizer = optimizer
         self._logger = logging.getLogger(__name__)
         self._processing_strategy = processing_strategy
+        self._refit_optimizer = refit_optimizer
+        self._refit_return_codes = refit_return_codes
+        if self._refit_return_codes is None:
+            self._refit_return_codes = get_refit_return_codes()
+
+        required_maps = list(self._model.get_optimization_output_param_names()) + ['ReturnCodes']
+        if self._refit_optimizer is not None:
+            required_maps.append('Errors.mse')
+        self._output_maps_selection = OutputMapsSelection(output_maps_include, output_maps_exclude, required_maps)
 
         if not self._model.is_protocol_sufficient(problem_data.protocol):
             raise InsufficientProtocolError(
@@ -359,30 +822,169 @@ class SingleModelFit(object):
         """Fits the composite model."""
         with per_model_logging_context(self._output_path):
             self._model.set_problem_data(self._problem_data)
-
-            if self.recalculate:
-                if os.path.exists(self._output_path):
-                    list(map(os.remove, glob.glob(os.path.join(self._output_path, '*.nii*'))))
-            else:
-                if model_output_exists(self._model, self._output_folder):
-                    maps = get_all_image_data(self._output_path)
+            fingerprint = get_model_fit_fingerprint(self._model.name, self._problem_data, self._optimizer,
+                                                    refit_optimizer=self._refit_optimizer,
+                                                    refit_return_codes=self._refit_return_codes,
+                                                    output_maps_selection=self._output_maps_selection)
+
+            recalculate = self.recalculate
+            if not recalculate:
+                if model_output_exists(self._model, self._output_folder, fingerprint=fingerprint):
+                    maps = get_all_image_data(self._output_path, prefetch=get_fitting_results_prefetch(self._model))
                     self._logger.info('Not recalculating {} model'.format(self._model.name))
                     return create_roi(maps, self._problem_data.mask)
 
-            if not os.path.exists(self._output_path):
+                manifest = load_output_manifest(self._output_path)
+                if manifest is not None and manifest.get('fingerprint') != fingerprint:
+                    self._logger.info('The input of the {} model changed since the last fit, '
+                                      'recalculating.'.format(self._model.name))
+                    recalculate = True
+
+            if os.path.exists(self._output_path):
+                remove_output_manifest(self._output_path)
+                if recalculate:
+                    list(map(os.remove, glob.glob(os.path.join(self._output_path, '*.nii*'))))
+            else:
                 os.makedirs(self._output_path)
 
-            with self._logging():
+            with self._logging(), self._output_maps_selection_context():
                 results = self._processing_strategy.run(
-                    self._model, self._problem_data, self._output_path, self.recalculate,
+                    self._model, self._problem_data, self._output_path, recalculate,
                     SimpleModelProcessingWorkerGenerator(lambda *args: FittingProcessingWorker(self._optimizer, *args)))
+
+                if self._refit_optimizer is not None:
+                    results = self._refit_failed_voxels(results, recalculate)
+
                 self._write_protocol()
 
+            write_output_manifest(self._output_path, self._model.name, fingerprint, optimizer=self._optimizer)
+
         return results
 
+    def _refit_failed_voxels(self, results, recalculate):
+        """Refit the voxels with a failed return code using the refit optimizer and merge the results.
+
+        This runs the processing strategy a second time, with the model's ``problems_to_analyze`` set to the
+        failed voxels, writing to a ``refit`` subdirectory of the output. Afterwards we merge the refitted values
+        into the output maps for the voxels improved by the refit (see :func:`_get_refit_improvements`) and remove the
+        subdirectory.
+
+        Args:
+            results (dict): the results of the first fit, as ROI arrays
+            recalculate (boolean): if we want to recalculate the refit results if they are already present
+
+        Returns:
+            dict: the merged results, as ROI arrays
+        """
+        return_codes = np.squeeze(results['ReturnCodes'])
+        failed_indices = np.where(np.in1d(return_codes, self._refit_return_codes))[0]
+
+        if self._model.problems_to_analyze is not None:
+            failed_indices = np.intersect1d(failed_indices, self._model.problems_to_analyze)
+
+        if not len(failed_indices):
+            self._logger.info('No voxels to refit.')
+            return results
+
+        self._logger.info('Refitting {} voxels with return codes in {}.'.format(len(failed_indices),
+                                                                                self._refit_return_codes))
+        refit_output_path = os.path.join(self._output_path, 'refit')
+
+        old_problems_to_analyze = self._model.problems_to_analyze
+        self._model.problems_to_analyze = failed_indices
+        try:
+            refit_results = self._processing_strategy.run(
+                self._model, self._problem_data, refit_output_path, recalculate,
+                SimpleModelProcessingWorkerGenerator(
+                    lambda *args: FittingProcessingWorker(self._refit_optimizer, *args)))
+        finally:
+            self._model.problems_to_analyze = old_problems_to_analyze
+
+        improved_indices = failed_indices
+        if 'Errors.mse' in results and 'Errors.mse' in refit_results:
+            old_mse = np.squeeze(results['Errors.mse'])[failed_indices]
+            new_mse = np.squeeze(refit_results['Errors.mse'])[failed_indices]
+            improved_indices = failed_indices[_get_refit_improvements(old_mse, new_mse)]
+
+        self._logger.info('The refit improved {} of the {} refitted voxels.'.format(len(improved_indices),
+                                                                                    len(failed_indices)))
+
+        if len(improved_indices):
+            improved_roi = np.zeros(len(return_codes), dtype=bool)
+            improved_roi[improved_indices] = True
+            self._merge_refit_maps(refit_output_path,
+                                   restore_volumes(improved_roi, self._problem_data.mask, with_volume_dim=False))
+
+        refit_performance_path = os.path.join(refit_output_path, 'performance.json')
+        if os.path.isfile(refit_performance_path):
+            with open(refit_performance_path, 'r') as f:
+                self._update_performance_info({'refit': json.load(f)})
+
+        shutil.rmtree(refit_output_path)
+        return create_roi(get_all_image_data(self._output_path, prefetch=get_fitting_results_prefetch(self._model)),
+                          self._problem_data.mask)
+
+    def _merge_refit_maps(self, refit_output_path, improved_mask):
+        """Merge the refitted maps into the output maps for the voxels in the given mask.
+
+        Args:
+            refit_output_path (str): the directory with the refitted maps
+            improved_mask (ndarray): the 3d volume mask with the voxels for which we use the refitted values
+        """
+        for refit_path, map_name, _ in yield_nifti_info(refit_output_path):
+            if map_name == 'UsedMask':
+                continue
+
+            output_path = nifti_filepath_resolution(os.path.join(self._output_path, map_name))
+            output_nifti = load_nifti(output_path)
+            header = output_nifti.get_header()
+            data = np.array(output_nifti.get_data())
+            del output_nifti
+
+            data[improved_mask] = load_nifti(refit_path).get_data()[improved_mask]
+            write_nifti(data, header, output_path)
+
+    def _update_performance_info(self, info):
+        """Add the given information to the ``performance.json`` file in the output folder.
+
+        The processing worker writes the per chunk performance statistics to this file, this adds the
+        information about the model fit as a whole.
+
+        Args:
+            info (dict): the items to add to the performance information
+        """
+        performance_path = os.path.join(self._output_path, 'performance.json')
+
+        content = {}
+        if os.path.isfile(performance_path):
+            with open(performance_path, 'r') as f:
+                content = json.load(f)
+
+        content.update(info)
+
+        with open(performance_path, 'w') as f:
+            json.dump(content, f, indent=4, sort_keys=True)
+
     def _write_protocol(self):
         write_protocol(self._problem_data.protocol, os.path.join(self._output_path, 'used_protocol.prtcl'))
 
+    @contextmanager
+    def _output_maps_selection_context(self):
+        """Set the output maps selection on the model during the processing."""
+        if self._output_maps_selection.selects_all():
+            yield
+            return
+
+        self._logger.info('Writing only the selected output maps (include: {}, exclude: {}).'.format(
+            self._output_maps_selection.include, self._output_maps_selection.exclude))
+
+        old_selection = self._model.output_maps_selection
+        self._model.output_maps_selection = self._output_maps_selection
+        try:
+            yield
+        finally:
+            self._model.output_maps_selection = old_selection
+
     @contextmanager
     def _logging(self):
         """Adds logging information around the processing."""
@@ -394,3 +996,10 @@ class SingleModelFit(object):
         run_time = timeit.default_timer() - minimize_start_time
         run_time_str = time.strftime('%H:%M:%S', time.gmtime(run_time))
         self._logger.info('Fitted {0} model with runtime {1} (h:m:s).'.format(self._model.name, run_time_str))
+
+        self._update_performance_info({'model': self._model.name,
+                                       'mdt_version': __version__,
+                                       'double_precision': self._model.double_precision,
+                                       'nmr_voxels_in_mask': int(np.count_nonzero(self._problem_data.mask)),
+                                       'nmr_inst_per_problem': self._problem_data.get_nmr_inst_per_problem(),
+                                       'fit_time': run_time})
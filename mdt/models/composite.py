@@ -44,11 +44,15 @@ class DMRICompositeModel(SampleModelBuilder, DMRIOptimizable):
         Attributes:
             required_nmr_shells (int): Define the minimum number of unique shells necessary for this model.
                 The default is false, which means that we don't check for this.
+            output_maps_selection (:class:`~mdt.utils.OutputMapsSelection`): if set, the selection of the result
+                maps to compute and write. Maps that are not selected are not written and, where possible,
+                not computed. If None (the default) we compute and write all the maps.
         """
         self._add_default_weights_dependency = add_default_weights_dependency
         super(DMRICompositeModel, self).__init__(model_name, model_tree, evaluation_model, signal_noise_model,
                                                  problem_data=problem_data)
         self.required_nmr_shells = False
+        self.output_maps_selection = None
         self._logger = logging.getLogger(__name__)
         self._original_problem_data = None
 
@@ -167,6 +171,10 @@ class DMRICompositeModel(SampleModelBuilder, DMRIOptimizable):
     def _add_finalizing_result_maps(self, results_dict):
         super(DMRICompositeModel, self)._add_finalizing_result_maps(results_dict)
 
+        if self.output_maps_selection is not None:
+            if not any(map(self.output_maps_selection.is_selected, ['LogLikelihood', 'BIC', 'AIC', 'AICc'])):
+                return
+
         log_likelihood_calc = LogLikelihoodCalculator()
         log_likelihoods = log_likelihood_calc.calculate(self, results_dict)
 
@@ -198,9 +206,7 @@ class DMRICompositeModel(SampleModelBuilder, DMRIOptimizable):
             self._logger.info('Using {} out of {} volumes, indices: {}'.format(
                 len(indices), protocol.length, str(indices).replace('\n', '').replace('[  ', '[')))
 
-            new_protocol = protocol.get_new_protocol_with_indices(indices)
-            new_dwi_volume = problem_data.dwi_volume[..., indices]
-            return problem_data.copy_with_updates(new_protocol, new_dwi_volume)
+            return problem_data.get_volume_subset(indices)
         else:
             self._logger.info('No model protocol options to apply, using original protocol.')
         return problem_data
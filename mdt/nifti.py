@@ -1,7 +1,18 @@
+import atexit
 import glob
+import gzip
+import hashlib
+import logging
 import os
+import shutil
+import tempfile
+import threading
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 import numpy as np
 import nibabel as nib
+from nibabel.openers import Opener
+from mdt.configuration import use_nifti_cache, get_nifti_cache_dir, get_nifti_cache_max_size
 from mdt.deferred_mappings import DeferredActionDict
 
 __author__ = 'Robbert Harms'
@@ -17,6 +28,9 @@ def load_nifti(nifti_volume):
     This will apply path resolution if a filename without extension is given. See the function
     :func:`nifti_filepath_resolution` for details.
 
+    If the nifti cache is enabled in the configuration, compressed volumes are loaded from their decompressed copy in
+    the cache, see :class:`DecompressedNiftiCache`.
+
     Args:
         nifti_volume (string): The filename of the volume to use.
 
@@ -24,54 +38,131 @@ def load_nifti(nifti_volume):
         :class:`nibabel.nifti1.Nifti1Image`
     """
     path = nifti_filepath_resolution(nifti_volume)
-    return nib.load(path)
+    return nib.load(_get_cached_path(path))
 
 
-def load_all_niftis(directory, map_names=None):
+def load_all_niftis(directory, map_names=None, nmr_workers=None):
     """Loads all niftis in the given directory.
 
     If map_names is given we will only load the given maps. Else, we load all .nii and .nii.gz files in the
     given directory. The map name is the filename of a nifti without the extension.
 
+    The niftis are opened in parallel using a pool of threads.
+
     Args:
         directory (str): the directory from which we want to load the niftis
         map_names (list of str): the names of the maps we want to use. If given, we only use and return these maps.
+        nmr_workers (int): the number of threads to use, defaults to one per CPU core
 
     Returns:
         dict: A dictionary with the loaded nibabel proxies (see :func:`load_nifti`).
             The keys of the dictionary are the filenames without the extension of the .nii(.gz) files
             in the given directory.
     """
-    maps_paths = {}
+    maps_paths = _get_nifti_paths(directory, map_names)
+    if not maps_paths:
+        return {}
 
-    for path, map_name, _ in yield_nifti_info(directory):
-        if not map_names or map_name in map_names:
-            maps_paths.update({map_name: path})
+    pool = ThreadPool(min(len(maps_paths), nmr_workers or cpu_count()))
+    try:
+        return dict(zip(maps_paths.keys(), pool.map(load_nifti, maps_paths.values())))
+    finally:
+        pool.close()
+        pool.join()
 
-    return {k: load_nifti(v) for k, v in maps_paths.items()}
 
-
-def get_all_image_data(directory, map_names=None, deferred=True):
+def get_all_image_data(directory, map_names=None, deferred=True, nmr_workers=None, prefetch=None):
     """Get the data of all the nifti volumes in the given directory.
 
     If map_names is given we will only load the given map names. Else, we load all .nii and .nii.gz files in the
     given directory.
 
+    The volumes are read (and decompressed) in parallel using a pool of threads. If deferred is set, this returns
+    directly while the volumes are read in the background, requesting a volume from the returned dictionary waits
+    until that volume is loaded. Without map names, only the maps in ``prefetch`` are read in the background, the
+    other volumes are only read when first requested, such that callers using only a few of the maps do not pay
+    for reading all of them.
+
     Args:
         directory (str): the directory from which we want to read a number of maps
         map_names (list of str): the names of the maps we want to use. If given, we only use and return these maps.
         deferred (boolean): if True we return an deferred loading dictionary instead of a dictionary with the values
             loaded as arrays.
+        nmr_workers (int): the number of threads to use, defaults to one per CPU core
+        prefetch (list of str): with deferred loading and no map names, the names of the maps we read in the
+            background directly. Names of maps that do not exist are ignored.
 
     Returns:
         dict: A dictionary with the volumes. The keys of the dictionary are the filenames
             without the extension of the .nii(.gz) files in the given directory.
     """
-    proxies = load_all_niftis(directory, map_names=map_names)
-    if deferred:
-        return DeferredActionDict(lambda _, item: item.get_data(), proxies)
+    maps_paths = _get_nifti_paths(directory, map_names)
+
+    if deferred and not map_names:
+        loading = _read_in_background({map_name: maps_paths[map_name] for map_name in prefetch or []
+                                       if map_name in maps_paths}, nmr_workers)
     else:
-        return {k: v.get_data() for k, v in proxies.items()}
+        loading = _read_in_background(maps_paths, nmr_workers)
+
+    if not deferred:
+        return {k: v.get() for k, v in loading.items()}
+
+    def get_data(map_name, path):
+        if map_name in loading:
+            return loading[map_name].get()
+        return _load_image_data(path)
+
+    return DeferredActionDict(get_data, maps_paths)
+
+
+def _read_in_background(maps_paths, nmr_workers=None):
+    """Start reading the data of the given niftis in a pool of threads.
+
+    The pool is joined in a background thread, such that the worker threads are cleaned up after reading all the
+    niftis without blocking the caller.
+
+    Args:
+        maps_paths (dict): per map name the path to the nifti file
+        nmr_workers (int): the number of threads to use, defaults to one per CPU core
+
+    Returns:
+        dict: per map name the asynchronous result with the data
+    """
+    if not maps_paths:
+        return {}
+
+    pool = ThreadPool(min(len(maps_paths), nmr_workers or cpu_count()))
+    try:
+        loading = {map_name: pool.apply_async(_load_image_data, (path,)) for map_name, path in maps_paths.items()}
+    finally:
+        pool.close()
+
+    joiner = threading.Thread(target=pool.join)
+    joiner.daemon = True
+    joiner.start()
+    return loading
+
+
+def _get_nifti_paths(directory, map_names=None):
+    """Get the paths of the niftis in the given directory, optionally only of the given maps.
+
+    Args:
+        directory (str): the directory with the niftis
+        map_names (list of str): if given, only return the paths of these maps
+
+    Returns:
+        dict: per map name the path to the nifti file
+    """
+    maps_paths = {}
+    for path, map_name, _ in yield_nifti_info(directory):
+        if not map_names or map_name in map_names:
+            maps_paths.update({map_name: path})
+    return maps_paths
+
+
+def _load_image_data(path):
+    """Load the data of the nifti at the given path, used for the (parallel) loading in :func:`get_all_image_data`."""
+    return load_nifti(path).get_data()
 
 
 def write_nifti(data, header, output_fname, affine=None, **kwargs):
@@ -118,6 +209,465 @@ def write_all_as_nifti(volumes, directory, nifti_header, overwrite_volumes=True,
             write_nifti(volume, nifti_header, full_filename)
 
 
+def create_nifti_memmap(file_path, nifti_header, shape, dtype):
+    """Preallocate an uncompressed nifti file and return a writable memory map to its data.
+
+    This writes the header (based on the given header) and allocates the space for the data, such that results
+    can be written directly into the final nifti file. The data is stored directly after the header (a data offset
+    of 352 bytes), hence the nifti extensions of the given header are not copied. The data scaling is reset.
+    Boolean data is stored as unsigned 8 bit integers.
+
+    Args:
+        file_path (str): the path to the .nii file to create, this overwrites existing files
+        nifti_header (nibabel header): the header to base the new header on, for the spatial information
+        shape (tuple): the shape of the data
+        dtype (np.dtype): the data type of the data
+
+    Returns:
+        np.memmap: a writable memory map to the data of the nifti file
+    """
+    dtype = np.dtype(dtype)
+    if dtype == np.bool_:
+        dtype = np.dtype(np.uint8)
+
+    header = _get_data_header(nifti_header)
+    header.set_data_shape(shape)
+    header.set_data_dtype(dtype)
+    header.set_slope_inter(None, None)
+
+    dtype = header.get_data_dtype()
+    nmr_bytes = int(np.prod(shape)) * dtype.itemsize
+
+    with open(file_path, 'wb') as f:
+        header.write_to(f)
+        f.write(b'\x00' * (352 - f.tell()))
+        if nmr_bytes:
+            f.seek(352 + nmr_bytes - 1)
+            f.write(b'\x00')
+
+    return open_nifti_memmap(file_path)
+
+
+def _get_data_header(nifti_header):
+    """Copy the given header for a file with the data stored directly after the header, at a data offset of 352 bytes.
+
+    The nifti extensions are not copied, they would not fit before the data offset.
+
+    Args:
+        nifti_header (nibabel header): the header to copy
+
+    Returns:
+        nib.Nifti1Header: the copied header
+    """
+    header = nib.Nifti1Header.from_header(nifti_header)
+    del header.extensions[:]
+    header['vox_offset'] = 352
+    return header
+
+
+def open_nifti_memmap(file_path, mode='r+'):
+    """Open a memory map to the data of an uncompressed nifti file.
+
+    This does not apply the data scaling, use this only for files without scaling, like the files created with
+    :func:`create_nifti_memmap`.
+
+    Args:
+        file_path (str): the path to the .nii file
+        mode (str): the mode for opening the memory map, one of 'r', 'r+' or 'c'
+
+    Returns:
+        np.memmap: a memory map to the data of the nifti file
+    """
+    with open(file_path, 'rb') as f:
+        header = nib.Nifti1Header.from_fileobj(f)
+    return np.memmap(file_path, dtype=header.get_data_dtype(), mode=mode, offset=int(header['vox_offset']),
+                     shape=header.get_data_shape(), order='F')
+
+
+def load_nifti_data(nifti_volume, dtype=None):
+    """Load the data of a nifti file in the given storage data type.
+
+    Floating point data is read in a single pass over the (possibly compressed) file and converted to the given data
+    type one volume (or slice) at the time, such that we never hold the data in two data types at once. Integer data
+    is kept in its compact integer type and is scaled (with the nifti ``scl_slope`` and ``scl_inter``) and converted
+    lazily, using a :class:`ScaledVolume`.
+
+    This will apply path resolution if a filename without extension is given, see :func:`nifti_filepath_resolution`.
+
+    Args:
+        nifti_volume (str): the filename of the volume to load
+        dtype (np.dtype): the storage data type, if None we use the data type of the data (after scaling)
+
+    Returns:
+        tuple: (data, header), the data as an ndarray or :class:`ScaledVolume` and the nifti header of the volume
+    """
+    nifti = load_nifti(nifti_volume)
+    header = nifti.header
+    slope, inter = _get_slope_inter(nifti.dataobj.slope, nifti.dataobj.inter)
+    raw_dtype = header.get_data_dtype()
+
+    if np.issubdtype(raw_dtype, np.integer) and (slope is not None or dtype is not None):
+        return ScaledVolume(np.asanyarray(nifti.dataobj.get_unscaled()), slope, inter, dtype=dtype), header
+
+    if dtype is None or np.dtype(dtype) == raw_dtype and slope is None:
+        return nifti.get_data(), header
+
+    data = np.empty(nifti.shape, dtype=dtype, order='F')
+    volume_shape = nifti.shape[:-1]
+    volume_size = int(np.prod(volume_shape)) * raw_dtype.itemsize
+
+    with Opener(nifti.get_filename()) as f:
+        f.seek(nifti.dataobj.offset)
+        for ind in range(nifti.shape[-1]):
+            volume = np.frombuffer(f.read(volume_size), dtype=raw_dtype).reshape(volume_shape, order='F')
+            data[..., ind] = volume
+            if slope is not None:
+                data[..., ind] *= slope
+            if inter is not None:
+                data[..., ind] += inter
+    return data, header
+
+
+def load_nifti_memmap(nifti_volume, tmp_dir=None, dtype=None):
+    """Load a read-only memory map to the data of a nifti file, for lazy reading of the data.
+
+    Uncompressed nifti files are memory mapped directly. Compressed (.nii.gz) files are decompressed once, in a
+    single streaming pass, to a temporary uncompressed nifti file which is then memory mapped. The temporary file is
+    removed when the memory map is closed (or, on Windows, at exit). If the nifti cache is enabled, we memory map the
+    decompressed copy in the cache instead, see :class:`DecompressedNiftiCache`.
+
+    If the data is scaled (using the nifti ``scl_slope`` and ``scl_inter``) or is not of the given data type, we
+    return a :class:`ScaledVolume` on the memory map, which applies the scaling and conversion lazily.
+
+    This will apply path resolution if a filename without extension is given, see :func:`nifti_filepath_resolution`.
+
+    Args:
+        nifti_volume (str): the filename of the volume to load
+        tmp_dir (str): the directory for the temporary uncompressed file, defaults to the system temporary directory
+        dtype (np.dtype): the storage data type, if None we use the data type of the data (after scaling)
+
+    Returns:
+        tuple: (data, header), the memory map (or :class:`ScaledVolume`) and the nifti header of the volume
+    """
+    path = _get_cached_path(nifti_filepath_resolution(nifti_volume))
+
+    if path.endswith('.nii'):
+        memmap = open_nifti_memmap(path, mode='r')
+    else:
+        if tmp_dir and not os.path.isdir(tmp_dir):
+            os.makedirs(tmp_dir)
+        fd, tmp_path = tempfile.mkstemp(suffix='.nii', prefix='mdt_', dir=tmp_dir or None)
+        with os.fdopen(fd, 'wb') as f_out:
+            with gzip.open(path, 'rb') as f_in:
+                shutil.copyfileobj(f_in, f_out, 16 * 1024 ** 2)
+
+        memmap = open_nifti_memmap(tmp_path, mode='r')
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            atexit.register(_remove_if_exists, tmp_path)
+
+    with open(path, 'rb') as f:
+        header = nib.Nifti1Header.from_fileobj(gzip.GzipFile(fileobj=f) if path.endswith('.gz') else f)
+
+    slope, inter = _get_slope_inter(*header.get_slope_inter())
+    if slope is not None or (dtype is not None and np.dtype(dtype) != memmap.dtype):
+        return ScaledVolume(memmap, slope, inter, dtype=dtype), header
+    return memmap, header
+
+
+class ScaledVolume(object):
+
+    def __init__(self, data, slope=None, inter=None, dtype=None):
+        """A volume that is scaled and converted to a data type lazily, only for the parts that are indexed.
+
+        This is used to keep (memory mapped) integer data in its compact type while presenting the scaled values,
+        ``data * slope + inter``, in the storage data type. Indexing, like ``volume[..., 0]``, only scales and converts
+        the selected elements.
+
+        Args:
+            data (ndarray): the raw data, for example a memory map
+            slope (float): the scaling slope, None for no slope
+            inter (float): the scaling intercept, None for no intercept
+            dtype (np.dtype): the data type of the scaled data, defaults to float64 for scaled data
+                and else to the data type of the raw data
+        """
+        self.data = data
+        self.slope = slope
+        self.inter = inter
+        if dtype is None:
+            dtype = np.float64 if (slope is not None or inter is not None) else data.dtype
+        self.dtype = np.dtype(dtype)
+        self.shape = data.shape
+        self.ndim = data.ndim
+
+    def scale(self, values):
+        """Scale and convert the given raw values.
+
+        Args:
+            values (ndarray): values read from the raw data
+
+        Returns:
+            ndarray: the scaled values in the data type of this volume
+        """
+        values = np.asarray(values).astype(self.dtype)
+        if self.slope is not None:
+            values *= self.slope
+        if self.inter is not None:
+            values += self.inter
+        return values
+
+    def __getitem__(self, item):
+        return self.scale(self.data[item])
+
+    def __array__(self, dtype=None, copy=None):
+        values = self.scale(self.data)
+        if dtype is not None:
+            return values.astype(dtype, copy=False)
+        return values
+
+
+class DecompressedNiftiCache(object):
+
+    def __init__(self, cache_dir, max_size):
+        """An on-disk cache of decompressed .nii.gz files.
+
+        This stores an uncompressed, memory mappable, copy of compressed nifti files, such that repeated loading of
+        the same volume does not need to decompress the volume again. Volumes are identified by their path, size,
+        modification time and a content hash (of the first and last megabyte of the compressed file, the last bytes
+        of a gzip file contain the CRC32 checksum of the uncompressed data).
+
+        If the total size of the cache would grow beyond the maximum size, we remove the least recently used
+        volumes first. Volumes larger than the maximum size are not cached.
+
+        Args:
+            cache_dir (str): the directory for the cached volumes
+            max_size (int): the maximum number of bytes of all the cached volumes together
+        """
+        self._cache_dir = cache_dir
+        self._max_size = max_size
+        self._logger = logging.getLogger(__name__)
+
+    def get(self, nifti_path):
+        """Get the path to the decompressed copy of the given .nii.gz file, decompressing it if it is not cached.
+
+        Args:
+            nifti_path (str): the path to a .nii.gz file
+
+        Returns:
+            str or None: the path to the decompressed .nii file, or None if the volume does not fit in the cache.
+        """
+        nifti_path = os.path.abspath(nifti_path)
+        source_key = hashlib.sha1(nifti_path.encode('utf8')).hexdigest()[:16]
+        cached_path = os.path.join(self._cache_dir, '{}_{}.nii'.format(source_key, self._get_content_key(nifti_path)))
+
+        if os.path.isfile(cached_path):
+            os.utime(cached_path, None)
+            return cached_path
+
+        nmr_bytes = self._get_decompressed_size(nifti_path)
+        if nmr_bytes > self._max_size:
+            return None
+
+        if not os.path.isdir(self._cache_dir):
+            os.makedirs(self._cache_dir)
+
+        for stale_path in glob.glob(os.path.join(self._cache_dir, source_key + '_*.nii')):
+            _remove_if_exists(stale_path)
+        self._remove_least_recently_used(self._max_size - nmr_bytes)
+
+        self._logger.info('Adding {} to the nifti cache.'.format(nifti_path))
+        tmp_path = '{}.{}.tmp'.format(cached_path, os.getpid())
+        with gzip.open(nifti_path, 'rb') as f_in:
+            with open(tmp_path, 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out, 16 * 1024 ** 2)
+
+        try:
+            os.rename(tmp_path, cached_path)
+        except OSError:
+            _remove_if_exists(tmp_path)
+            if not os.path.isfile(cached_path):
+                raise
+        return cached_path
+
+    def _get_content_key(self, nifti_path, block_size=1024 ** 2):
+        """Get the key identifying the content of the given file using its size, modification time and content."""
+        stat = os.stat(nifti_path)
+        content_hash = hashlib.sha1('{}:{}'.format(stat.st_size, stat.st_mtime).encode('utf8'))
+        with open(nifti_path, 'rb') as f:
+            content_hash.update(f.read(block_size))
+            f.seek(max(0, stat.st_size - block_size))
+            content_hash.update(f.read(block_size))
+        return content_hash.hexdigest()
+
+    def _get_decompressed_size(self, nifti_path):
+        """Get the size of the decompressed file using the header, the gzip size field is modulo 4GB."""
+        with gzip.open(nifti_path, 'rb') as f:
+            header = nib.Nifti1Header.from_fileobj(f)
+        return int(header['vox_offset']) + int(np.prod(header.get_data_shape())) * header.get_data_dtype().itemsize
+
+    def _remove_least_recently_used(self, max_size):
+        """Remove the least recently used volumes until the cache is at most the given size."""
+        entries = []
+        for path in glob.glob(os.path.join(self._cache_dir, '*.nii')):
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total_size = sum(entry[1] for entry in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= max_size:
+                break
+            self._logger.info('Removing {} from the nifti cache.'.format(path))
+            _remove_if_exists(path)
+            total_size -= size
+
+
+def _get_cached_path(nifti_path):
+    """Get the path to the decompressed copy of the given nifti file, if the nifti cache is enabled.
+
+    Args:
+        nifti_path (str): the path to a nifti file
+
+    Returns:
+        str: the path to the cached copy or the given path if the file is not compressed, the cache is disabled or
+            the file could not be cached.
+    """
+    if nifti_path.endswith('.nii.gz') and use_nifti_cache():
+        cached_path = DecompressedNiftiCache(get_nifti_cache_dir(), get_nifti_cache_max_size()).get(nifti_path)
+        if cached_path:
+            return cached_path
+    return nifti_path
+
+
+def _get_slope_inter(slope, inter):
+    """Normalize the data scaling of a nifti file, with None for the identity and undefined slope and intercept."""
+    if slope is not None and (not np.isfinite(slope) or slope in (0, 1)):
+        slope = None
+    if inter is not None and (not np.isfinite(inter) or inter == 0):
+        inter = None
+    return slope, inter
+
+
+def _remove_if_exists(path):
+    try:
+        if os.path.exists(path):
+            os.remove(path)
+    except OSError:
+        pass
+
+
+def gzip_nifti(nifti_path, output_path=None, remove_original=True, compression_level=6):
+    """Compress a .nii file to a .nii.gz file in a single streaming pass.
+
+    Args:
+        nifti_path (str): the path to the .nii file to compress
+        output_path (str): the path for the .nii.gz file, defaults to the input path with .gz appended
+        remove_original (boolean): if we want to remove the .nii file after compressing it
+        compression_level (int): the gzip compression level, from 1 (fastest) to 9 (smallest)
+
+    Returns:
+        str: the path to the compressed file
+    """
+    output_path = output_path or nifti_path + '.gz'
+
+    with open(nifti_path, 'rb') as f_in:
+        with gzip.open(output_path, 'wb', compresslevel=compression_level) as f_out:
+            shutil.copyfileobj(f_in, f_out, 16 * 1024 ** 2)
+
+    if remove_original:
+        os.remove(nifti_path)
+
+    return output_path
+
+
+def convert_nifti_dtype(nifti_path, output_path, dtype, remove_original=True, compression_level=6,
+                        block_size=4 * 1024 ** 2):
+    """Write an uncompressed nifti file in another data type, streaming the data block by block.
+
+    The input should be an uncompressed nifti file without data scaling, like the files created with
+    :func:`create_nifti_memmap`. Floating point data stored as an integer type is linearly scaled to the range of that
+    type using the nifti ``scl_slope`` and ``scl_inter``, non-finite values are stored as zero. Other conversions
+    are a direct cast.
+
+    Args:
+        nifti_path (str): the path to the .nii file to convert
+        output_path (str): the path for the output file, if this ends with .gz the output is compressed
+        dtype (np.dtype): the data type for the output file
+        remove_original (boolean): if we want to remove the input file after the conversion
+        compression_level (int): the gzip compression level, from 1 (fastest) to 9 (smallest)
+        block_size (int): the number of elements we convert at once
+
+    Returns:
+        str: the path to the converted file
+    """
+    dtype = np.dtype(dtype)
+
+    with open(nifti_path, 'rb') as f:
+        header = nib.Nifti1Header.from_fileobj(f)
+
+    data = np.memmap(nifti_path, dtype=header.get_data_dtype(), mode='r', offset=int(header['vox_offset']),
+                     shape=(int(np.prod(header.get_data_shape())),))
+
+    def blocks():
+        for ind in range(0, data.shape[0], block_size):
+            yield np.asarray(data[ind:ind + block_size])
+
+    slope, inter = None, None
+    if np.issubdtype(dtype, np.integer) and np.issubdtype(data.dtype, np.floating):
+        slope, inter = _get_packing_slope_inter(blocks(), dtype)
+
+    new_header = _get_data_header(header)
+    new_header.set_data_dtype(dtype)
+    new_header.set_slope_inter(slope, inter)
+
+    if output_path.endswith('.gz'):
+        f_out = gzip.open(output_path, 'wb', compresslevel=compression_level)
+    else:
+        f_out = open(output_path, 'wb')
+
+    try:
+        new_header.write_to(f_out)
+        f_out.write(b'\x00' * (352 - f_out.tell()))
+
+        for block in blocks():
+            if slope is not None:
+                block = np.round((np.where(np.isfinite(block), block, 0) - inter) / slope)
+                block = np.clip(block, np.iinfo(dtype).min, np.iinfo(dtype).max)
+            f_out.write(block.astype(dtype).tobytes())
+    finally:
+        f_out.close()
+
+    if remove_original:
+        os.remove(nifti_path)
+
+    return output_path
+
+
+def _get_packing_slope_inter(blocks, dtype):
+    """Get the nifti scaling with which we store the given floating point data in the given integer type.
+
+    Args:
+        blocks (iterable): the blocks of floating point data
+        dtype (np.dtype): the integer data type
+
+    Returns:
+        tuple: the slope and intercept mapping the range of the integer type to the range of the finite data
+    """
+    minimum, maximum = 0, 0
+    for block in blocks:
+        finite = block[np.isfinite(block)]
+        if finite.size:
+            minimum = min(minimum, float(finite.min()))
+            maximum = max(maximum, float(finite.max()))
+
+    info = np.iinfo(dtype)
+    if maximum == minimum:
+        return 1.0, 0.0
+
+    slope = (maximum - minimum) / (float(info.max) - float(info.min))
+    return slope, minimum - info.min * slope
+
+
 def nifti_filepath_resolution(file_path):
     """Tries to resolve the filename to a nifti based on only the filename.
 
@@ -1,18 +1,33 @@
+import copy
+import errno
 import glob
 import hashlib
+import json
 import logging
 import os
 import shutil
+import socket
+import sqlite3
+import sys
+import threading
 import timeit
 from contextlib import contextmanager
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
+import nibabel as nib
 import numpy as np
 import time
 from numpy.lib.format import open_memmap
+from six.moves import queue
 
-from mdt.nifti import write_all_as_nifti, get_all_image_data
-from mdt.configuration import gzip_optimization_results, gzip_sampling_results
-from mdt.utils import create_roi, load_samples
+import mot.configuration
+from mot.load_balance_strategies import EvenDistribution
+
+from mdt.nifti import get_all_image_data, create_nifti_memmap, open_nifti_memmap, gzip_nifti, convert_nifti_dtype
+from mdt.configuration import gzip_optimization_results, gzip_sampling_results, get_config_dir, \
+    get_gzip_compression_level, get_gzip_nmr_workers, get_output_dtype
+from mdt.utils import create_roi, load_samples, get_mask_index
 
 __author__ = 'Robbert Harms'
 __date__ = "2016-07-29"
@@ -71,21 +86,40 @@ class ModelProcessingStrategy(object):
 
 class SimpleProcessingStrategy(ModelProcessingStrategy):
 
-    def __init__(self, tmp_dir=None, honor_voxels_to_analyze=True):
+    def __init__(self, tmp_dir=None, honor_voxels_to_analyze=True, write_queue_size=2, keep_tmp_results=False):
         """This class is a base class for all model slice fitting strategies that fit the data in chunks/parts.
 
         Args:
             honor_voxels_to_analyze (bool): if set to True, we use the model's voxels_to_analyze setting if set
                 instead of fitting all voxels in the mask
+            write_queue_size (int): the maximum number of chunk results waiting to be written to the temporary
+                storage by the background writer. While the results of one chunk are written, the next chunk is
+                already being processed. Set to 0 to write the results directly after every chunk.
+            keep_tmp_results (boolean): if set to True we do not remove the temporary results after the results are
+                combined. Running the same model again will then combine the stored results without reprocessing.
         """
         super(SimpleProcessingStrategy, self).__init__(tmp_dir=tmp_dir)
         self._honor_voxels_to_analyze = honor_voxels_to_analyze
+        self._write_queue_size = write_queue_size
+        self._keep_tmp_results = keep_tmp_results
+
+    def _get_shared_options(self):
+        """Get the options of this strategy that are shared with the sub-strategies of meta strategies.
+
+        Returns:
+            dict: the keyword arguments for the sub-strategies
+        """
+        return {'tmp_dir': self._tmp_dir,
+                'honor_voxels_to_analyze': self._honor_voxels_to_analyze,
+                'write_queue_size': self._write_queue_size,
+                'keep_tmp_results': self._keep_tmp_results}
 
     @contextmanager
     def _tmp_storage_dir(self, model_output_path, recalculate):
         """Creates a temporary storage dir for the calculations. Removes the dir after calculations.
 
-        Use this manager as a context for running the calculations.
+        Use this manager as a context for running the calculations. If the calculations fail, the dir is kept such that
+        the computations can be resumed. If ``keep_tmp_results`` is set, the dir is also kept after the calculations.
 
         Args:
             model_output_path (str): the output path of the final model results. We use this to create the tmp_dir.
@@ -94,7 +128,11 @@ class SimpleProcessingStrategy(ModelProcessingStrategy):
         tmp_storage_dir = self._get_tmp_results_dir(model_output_path)
         self._prepare_tmp_storage_dir(tmp_storage_dir, recalculate)
         yield tmp_storage_dir
-        shutil.rmtree(tmp_storage_dir)
+
+        if self._keep_tmp_results:
+            self._logger.info('Keeping the temporary results in {}.'.format(tmp_storage_dir))
+        else:
+            shutil.rmtree(tmp_storage_dir)
 
     def _get_tmp_results_dir(self, model_output_path):
         """Get the temporary results dir we need to use for processing.
@@ -157,6 +195,8 @@ class ChunksProcessingStrategy(SimpleProcessingStrategy):
 
             worker = worker_generator.create_worker(model, problem_data, output_path,
                                                     tmp_storage_dir, self._honor_voxels_to_analyze)
+            worker.set_write_queue_size(self._write_queue_size)
+            worker.set_keep_tmp_results(self._keep_tmp_results)
 
             total_roi_indices = worker.get_voxels_to_compute()
             if len(total_roi_indices):
@@ -168,6 +208,8 @@ class ChunksProcessingStrategy(SimpleProcessingStrategy):
 
                     voxels_processed += len(chunk_indices)
 
+            worker.flush()
+
             self._logger.info('Computed all voxels, now creating nifti\'s')
             return_data = worker.combine()
 
@@ -183,7 +225,7 @@ class ChunksProcessingStrategy(SimpleProcessingStrategy):
 
     def _run_on_chunk(self, problem_data, worker, voxel_indices, voxels_to_process, voxels_processed, start_time):
         """Run the worker on the given chunk."""
-        total_nmr_voxels = np.count_nonzero(problem_data.mask)
+        total_nmr_voxels = get_mask_index(problem_data.mask).nmr_voxels
         total_processed = (total_nmr_voxels - len(voxels_to_process)) + voxels_processed
 
         run_time = timeit.default_timer() - start_time
@@ -204,6 +246,885 @@ class ChunksProcessingStrategy(SimpleProcessingStrategy):
         worker.process(voxel_indices)
 
 
+class QueuedChunksProcessingStrategy(ChunksProcessingStrategy):
+
+    def __init__(self, cl_environments=None, **kwargs):
+        """Process the chunks concurrently using one worker per OpenCL device.
+
+        All the chunks from the chunks generator are put in a queue. Every device (or CPU OpenCL context) gets its
+        own processing worker, running in its own thread, which takes the next chunk from the queue as soon as it has
+        finished the previous one. This keeps all devices busy, even if the computation time differs per chunk.
+
+        Args:
+            cl_environments (list of CLEnvironment): the CL environments to use, every environment gets its own worker.
+                If not set we use the CL environments selected by the load balancer of the current MOT runtime
+                configuration.
+        """
+        super(QueuedChunksProcessingStrategy, self).__init__(**kwargs)
+        self._cl_environments = cl_environments
+
+    def run(self, model, problem_data, output_path, recalculate, worker_generator):
+        """Compute all the chunks using one worker thread per device"""
+        start_time = timeit.default_timer()
+
+        with self._tmp_storage_dir(output_path, recalculate) as tmp_storage_dir:
+            worker = worker_generator.create_worker(model, problem_data, output_path,
+                                                    tmp_storage_dir, self._honor_voxels_to_analyze)
+            worker.set_write_queue_size(self._write_queue_size)
+            worker.set_keep_tmp_results(self._keep_tmp_results)
+
+            total_roi_indices = worker.get_voxels_to_compute()
+            if len(total_roi_indices):
+                chunks = queue.Queue()
+                for chunk_indices in self._chunks_generator(model, problem_data, output_path, worker,
+                                                            total_roi_indices):
+                    chunks.put(chunk_indices)
+
+                cl_environments = self._cl_environments or get_used_cl_environments()
+                self._logger.info('Processing {} chunks using {} device(s).'.format(chunks.qsize(),
+                                                                                    len(cl_environments)))
+
+                progress = _ChunksProgress()
+                threads = []
+                for cl_environment in cl_environments:
+                    device_worker = worker.get_device_worker([cl_environment])
+                    thread = threading.Thread(target=self._process_chunks_queue,
+                                              args=(device_worker, chunks, problem_data, total_roi_indices,
+                                                    progress, start_time))
+                    thread.daemon = True
+                    thread.start()
+                    threads.append(thread)
+
+                for thread in threads:
+                    thread.join()
+
+                if progress.errors:
+                    raise progress.errors[0]
+
+            worker.flush()
+
+            self._logger.info('Computed all voxels, now creating nifti\'s')
+            return_data = worker.combine()
+
+        return return_data
+
+    def _process_chunks_queue(self, device_worker, chunks, problem_data, total_roi_indices, progress, start_time):
+        """Process chunks from the queue until the queue is empty or until one of the other workers failed.
+
+        Args:
+            device_worker (ModelProcessingWorker): the worker for the device processed by this thread
+            chunks (queue.Queue): the queue with the roi indices per chunk
+            problem_data (:class:`~mdt.utils.DMRIProblemData`): the problem data, used for the progress logging
+            total_roi_indices (ndarray): all the roi indices we are processing, used for the progress logging
+            progress (_ChunksProgress): the progress shared between all device workers
+            start_time (float): the start time of the processing, used for the progress logging
+        """
+        while not progress.errors:
+            try:
+                chunk_indices = chunks.get_nowait()
+            except queue.Empty:
+                return
+
+            voxels_processed = progress.claim(len(chunk_indices))
+
+            try:
+                with self._selected_indices(device_worker.model, chunk_indices):
+                    self._run_on_chunk(problem_data, device_worker, chunk_indices, total_roi_indices,
+                                       voxels_processed, start_time)
+            except Exception as exc:
+                self._logger.exception('Processing a chunk failed, stopping all device workers.')
+                progress.errors.append(exc)
+
+
+class _ChunksProgress(object):
+
+    def __init__(self):
+        """Keeps track of the number of voxels processed by concurrent device workers."""
+        self.errors = []
+        self._voxels_processed = 0
+        self._lock = threading.Lock()
+
+    def claim(self, nmr_voxels):
+        """Register the processing of the given number of voxels.
+
+        Args:
+            nmr_voxels (int): the number of voxels in the chunk that is about to be processed
+
+        Returns:
+            int: the number of voxels processed (or being processed) before this chunk.
+        """
+        with self._lock:
+            voxels_processed = self._voxels_processed
+            self._voxels_processed += nmr_voxels
+        return voxels_processed
+
+
+class ShardedChunksProcessingStrategy(ChunksProcessingStrategy):
+
+    def __init__(self, claim_timeout=3600, poll_interval=5, **kwargs):
+        """Process the chunks (shards) of one model using multiple independent processes.
+
+        Every process running the same model with the same output path uses the same temporary storage directory (see
+        :meth:`_get_tmp_results_dir`). The processes claim chunks from a sqlite coordinator in that directory and
+        write their results to the shared temporary storage. The process that finishes the last chunk combines the
+        results, the other processes wait for the combined results. Each process can use its own devices.
+
+        Chunks claimed by a process that died are claimed again, on the same host as soon as the process is no longer
+        running, on other hosts after the claim timeout.
+
+        Args:
+            claim_timeout (int): the number of seconds after which a claimed chunk (or a started combine) of another
+                host is considered stale and can be claimed again.
+            poll_interval (int): the number of seconds between checks while waiting for the other processes
+        """
+        super(ShardedChunksProcessingStrategy, self).__init__(**kwargs)
+        self._claim_timeout = claim_timeout
+        self._poll_interval = poll_interval
+
+    def run(self, model, problem_data, output_path, recalculate, worker_generator):
+        """Compute the chunks claimed by this process and combine if we finish the last chunk"""
+        start_time = timeit.default_timer()
+
+        tmp_storage_dir = self._get_tmp_results_dir(output_path)
+        if not os.path.exists(tmp_storage_dir):
+            try:
+                os.makedirs(tmp_storage_dir)
+            except OSError:
+                if not os.path.isdir(tmp_storage_dir):
+                    raise
+
+        coordinator = ShardsCoordinator(os.path.join(tmp_storage_dir, 'shards.sqlite'),
+                                        claim_timeout=self._claim_timeout)
+        coordinator.start(recalculate, lambda: clear_tmp_storage(tmp_storage_dir, coordinator.get_paths()))
+
+        worker = worker_generator.create_worker(model, problem_data, output_path,
+                                                tmp_storage_dir, self._honor_voxels_to_analyze)
+        worker.set_write_queue_size(self._write_queue_size)
+        worker.set_keep_tmp_results(self._keep_tmp_results)
+        worker.set_write_lock(coordinator.get_write_lock())
+        worker.set_protected_paths(coordinator.get_paths())
+
+        coordinator.add_shards(lambda: self._chunks_generator(model, problem_data, output_path, worker,
+                                                              worker.get_voxels_to_compute()))
+        total_roi_indices = coordinator.get_all_roi_indices()
+
+        while True:
+            shard = coordinator.claim()
+            if shard is not None:
+                shard_id, chunk_indices = shard
+                with self._selected_indices(model, chunk_indices):
+                    self._run_on_chunk(problem_data, worker, chunk_indices, total_roi_indices,
+                                       coordinator.get_nmr_voxels_done(), start_time)
+                worker.add_write_callback(coordinator.mark_done, shard_id)
+                continue
+
+            worker.flush()
+
+            status = coordinator.get_combine_status()
+            if status == ShardsCoordinator.COMBINE:
+                self._logger.info('Computed all voxels, now creating nifti\'s')
+                return_data = worker.combine()
+                coordinator.set_combined()
+
+                if self._keep_tmp_results:
+                    self._logger.info('Keeping the temporary results in {}.'.format(tmp_storage_dir))
+                else:
+                    clear_tmp_storage(tmp_storage_dir, coordinator.get_paths())
+                return return_data
+
+            if status == ShardsCoordinator.COMBINED:
+                self._logger.info('The results were combined by another process.')
+                worker.close()
+                return worker.load_results()
+
+            time.sleep(self._poll_interval)
+
+
+class ShardsCoordinator(object):
+
+    COMBINE = 'combine'
+    COMBINED = 'combined'
+    WAIT = 'wait'
+
+    def __init__(self, db_path, claim_timeout=3600):
+        """Coordinates the processing of chunks (shards) of a model by multiple processes using a sqlite database.
+
+        Every process has a unique owner name made from the host name and the process id.
+
+        Args:
+            db_path (str): the path to the sqlite database, shared by all processes
+            claim_timeout (int): the number of seconds after which a claim of another host is considered stale
+        """
+        self._db_path = db_path
+        self._lock_path = os.path.splitext(db_path)[0] + '.lock.sqlite'
+        self._claim_timeout = claim_timeout
+        self._hostname = socket.gethostname()
+        self._owner = '{}:{}'.format(self._hostname, os.getpid())
+
+    def get_paths(self):
+        """Get the paths of the files used by this coordinator.
+
+        Returns:
+            list of str: the paths of the files used by this coordinator
+        """
+        return [self._db_path, self._db_path + '-journal', self._lock_path, self._lock_path + '-journal']
+
+    def get_write_lock(self):
+        """Get a lock to serialize the writing to the temporary storage over all the processes.
+
+        Returns:
+            InterProcessLock: the lock
+        """
+        return InterProcessLock(self._lock_path, timeout=self._claim_timeout)
+
+    def start(self, recalculate, clear_function):
+        """Start or join the processing.
+
+        If the previous results were combined, or if we want to recalculate while no processing is in progress, we
+        call the clear function and start over. If there is no database yet we start without clearing, such that the
+        completed chunks in the temporary storage are reused. Else, we join the processing in progress.
+
+        Args:
+            recalculate (boolean): if we want to throw away the temporary results, only done if no other process
+                is processing the model.
+            clear_function (callable): function to clear the temporary storage
+        """
+        with self._transaction() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS shards (id INTEGER PRIMARY KEY, roi_ranges TEXT, '
+                         'nmr_voxels INTEGER, state TEXT, owner TEXT, claimed_at REAL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            conn.execute('CREATE TABLE IF NOT EXISTS processes (owner TEXT PRIMARY KEY, heartbeat REAL)')
+
+            state = self._get_meta(conn, 'state')
+            if state in (None, self.COMBINED) or (recalculate and not self._is_active(conn)):
+                if state is not None or recalculate:
+                    clear_function()
+                conn.execute('DELETE FROM shards')
+                conn.execute('DELETE FROM meta')
+                conn.execute('DELETE FROM processes')
+                self._set_meta(conn, 'state', 'processing')
+
+            self._heartbeat(conn)
+
+    def add_shards(self, chunks_generator_function):
+        """Add the shards to the database if no shards are defined yet.
+
+        Args:
+            chunks_generator_function (callable): function returning an iterator over the chunks
+        """
+        with self._transaction() as conn:
+            if conn.execute('SELECT COUNT(*) FROM shards').fetchone()[0]:
+                return
+            for chunk in chunks_generator_function():
+                conn.execute('INSERT INTO shards (roi_ranges, nmr_voxels, state) VALUES (?, ?, ?)',
+                             (json.dumps(ChunksManifest._to_ranges(chunk)), len(chunk), 'pending'))
+
+    def get_all_roi_indices(self):
+        """Get the ROI indices of all the shards.
+
+        Returns:
+            ndarray: the ROI indices of all the shards
+        """
+        with self._transaction() as conn:
+            rows = conn.execute('SELECT roi_ranges FROM shards ORDER BY id').fetchall()
+        return np.concatenate([np.array([], dtype=np.int64)] + [self._from_ranges(row[0]) for row in rows])
+
+    def get_nmr_voxels_done(self):
+        """Get the number of voxels in the shards that are done or being processed.
+
+        Returns:
+            int: the number of voxels done or claimed
+        """
+        with self._transaction() as conn:
+            return conn.execute('SELECT COALESCE(SUM(nmr_voxels), 0) FROM shards '
+                                'WHERE state != ?', ('pending',)).fetchone()[0]
+
+    def claim(self):
+        """Claim the next pending (or stale) shard.
+
+        Returns:
+            tuple: (shard_id, roi_indices) or None if there are no shards left to claim
+        """
+        with self._transaction() as conn:
+            self._heartbeat(conn)
+            rows = conn.execute('SELECT id, roi_ranges, state, owner, claimed_at FROM shards '
+                                'WHERE state != ? ORDER BY id', ('done',)).fetchall()
+            for shard_id, roi_ranges, state, owner, claimed_at in rows:
+                if state == 'pending' or self._is_stale(owner, claimed_at):
+                    conn.execute('UPDATE shards SET state = ?, owner = ?, claimed_at = ? WHERE id = ?',
+                                 ('claimed', self._owner, time.time(), shard_id))
+                    return shard_id, self._from_ranges(roi_ranges)
+        return None
+
+    def mark_done(self, shard_id):
+        """Mark the given shard as done, all its results should be written before calling this.
+
+        Args:
+            shard_id (int): the id of the shard
+        """
+        with self._transaction() as conn:
+            conn.execute('UPDATE shards SET state = ? WHERE id = ?', ('done', shard_id))
+
+    def get_combine_status(self):
+        """Check if we should combine the results.
+
+        If all shards are done and no other process is combining, this process becomes the combining process.
+
+        Returns:
+            str: one of COMBINE (this process should combine), COMBINED (the results are combined by another
+                process) or WAIT (other processes are still processing or combining).
+        """
+        with self._transaction() as conn:
+            state = self._get_meta(conn, 'state')
+            if state == self.COMBINED:
+                return self.COMBINED
+
+            if conn.execute('SELECT COUNT(*) FROM shards WHERE state != ?', ('done',)).fetchone()[0]:
+                return self.WAIT
+
+            if state == 'combining':
+                combiner = self._get_meta(conn, 'combiner')
+                if not self._is_stale(combiner, float(self._get_meta(conn, 'combine_started'))):
+                    return self.WAIT
+
+            self._set_meta(conn, 'state', 'combining')
+            self._set_meta(conn, 'combiner', self._owner)
+            self._set_meta(conn, 'combine_started', time.time())
+            return self.COMBINE
+
+    def set_combined(self):
+        """Mark the results as combined."""
+        with self._transaction() as conn:
+            self._set_meta(conn, 'state', self.COMBINED)
+
+    def _heartbeat(self, conn):
+        """Register this process as taking part in the processing."""
+        conn.execute('INSERT OR REPLACE INTO processes (owner, heartbeat) VALUES (?, ?)', (self._owner, time.time()))
+
+    def _is_active(self, conn):
+        """Check if other processes are processing or combining."""
+        rows = conn.execute('SELECT owner, heartbeat FROM processes WHERE owner != ?', (self._owner,)).fetchall()
+        if any(not self._is_stale(owner, heartbeat) for owner, heartbeat in rows):
+            return True
+
+        if self._get_meta(conn, 'state') == 'combining':
+            return not self._is_stale(self._get_meta(conn, 'combiner'),
+                                      float(self._get_meta(conn, 'combine_started')))
+        return False
+
+    def _is_stale(self, owner, claimed_at):
+        """Check if the claim of the given owner is stale.
+
+        Claims of processes on this host are stale if the process is no longer running, claims of other hosts
+        (and all claims on Windows) are stale after the claim timeout.
+        """
+        hostname, pid = owner.rsplit(':', 1)
+        if hostname == self._hostname and os.name != 'nt':
+            if int(pid) == os.getpid():
+                return False
+            try:
+                os.kill(int(pid), 0)
+            except OSError as exc:
+                return exc.errno == errno.ESRCH
+            return False
+        return time.time() - claimed_at > self._claim_timeout
+
+    @staticmethod
+    def _from_ranges(roi_ranges):
+        ranges = json.loads(roi_ranges)
+        if not ranges:
+            return np.array([], dtype=np.int64)
+        return np.concatenate([np.arange(start, end) for start, end in ranges])
+
+    @staticmethod
+    def _get_meta(conn, key):
+        row = conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        if row:
+            return row[0]
+        return None
+
+    @staticmethod
+    def _set_meta(conn, key, value):
+        conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, str(value)))
+
+    @contextmanager
+    def _transaction(self):
+        """Create an exclusive transaction on the database."""
+        conn = sqlite3.connect(self._db_path, timeout=self._claim_timeout, isolation_level=None)
+        try:
+            conn.execute('BEGIN EXCLUSIVE')
+            try:
+                yield conn
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+
+class InterProcessLock(object):
+
+    def __init__(self, lock_path, timeout=3600):
+        """A lock shared by all threads and processes using the same lock file, based on a sqlite transaction.
+
+        Args:
+            lock_path (str): the path to the lock file
+            timeout (int): the maximum number of seconds to wait for the lock
+        """
+        self._lock_path = lock_path
+        self._timeout = timeout
+        self._thread_lock = threading.Lock()
+        self._conn = None
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        try:
+            self._conn = sqlite3.connect(self._lock_path, timeout=self._timeout, isolation_level=None)
+            self._conn.execute('BEGIN EXCLUSIVE')
+        except Exception:
+            self._thread_lock.release()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            self._conn.execute('COMMIT')
+            self._conn.close()
+            self._conn = None
+        finally:
+            self._thread_lock.release()
+
+
+def yield_voxel_ranges(roi_indices, nmr_voxels):
+    """Divide the given ROI indices into consecutive chunks of the given number of voxels.
+
+    This is the chunks generator of the voxel range processing strategies, the last chunk holds the remaining voxels.
+
+    Args:
+        roi_indices (ndarray): the ROI indices of the voxels to divide
+        nmr_voxels (int): the number of voxels per chunk
+
+    Yields:
+        ndarray: the roi indices per chunk
+    """
+    for ind_start in range(0, len(roi_indices), nmr_voxels):
+        ind_end = min(len(roi_indices), ind_start + nmr_voxels)
+        yield roi_indices[ind_start:ind_end]
+
+
+def estimate_voxel_memory(model):
+    """Estimate the memory needed per voxel for processing the given model.
+
+    This is a rough estimate based on the number of observations per voxel, the number of estimable parameters, the
+    number of output maps and the precision of the model. On the device we count the observations, the model
+    evaluations, the Jacobian and the parameter workspace of the optimization routine. On the host we count the
+    observations, the result maps and the extra output maps like the covariance matrix.
+
+    Args:
+        model (:class:`~mdt.models.composite.DMRICompositeModel`): the model to estimate, with the problem data set
+
+    Returns:
+        tuple: (host_bytes, device_bytes), the estimated memory needed per voxel on the host and on the device
+    """
+    float_size = 8 if model.double_precision else 4
+    nmr_inst = model.get_nmr_inst_per_problem()
+    nmr_params = model.get_nmr_estimable_parameters()
+    nmr_maps = len(model.get_optimization_output_param_names())
+
+    device_bytes = float_size * (nmr_inst * (2 + nmr_params) + nmr_params * (nmr_params + 4))
+    host_bytes = float_size * 2 * nmr_inst + 8 * (nmr_maps + nmr_params ** 2 + 10)
+    return host_bytes, device_bytes
+
+
+def get_available_host_memory():
+    """Get the amount of memory available on the host.
+
+    On Linux this uses the MemAvailable field of /proc/meminfo, else we use the number of available physical pages
+    if the operating system supports that.
+
+    Returns:
+        int: the number of available bytes, or None if it could not be determined.
+    """
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def get_peak_memory_usage():
+    """Get the peak resident memory usage (maximum resident set size) of the current process.
+
+    Returns:
+        float: the peak memory usage in MB, or None if this is not supported on this operating system.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return max_rss / 1024.0 ** 2
+    return max_rss / 1024.0
+
+
+def get_used_cl_environments():
+    """Get the CL environments selected by the load balancer of the current MOT runtime configuration.
+
+    Returns:
+        list of CLEnvironment: the CL environments that will be used for the computations
+    """
+    return mot.configuration.get_load_balancer().get_used_cl_environments(mot.configuration.get_cl_environments())
+
+
+def get_device_memory(cl_environments=None):
+    """Get the global memory and the maximum buffer size of the smallest of the given devices.
+
+    Args:
+        cl_environments (list of CLEnvironment): the CL environments to inspect, if not given we use the
+            CL environments selected by the load balancer of the current MOT runtime configuration.
+
+    Returns:
+        tuple: (global_mem_size, max_mem_alloc_size) in bytes, the minimum over all the given devices
+    """
+    cl_environments = cl_environments or get_used_cl_environments()
+    return (min(env.device.global_mem_size for env in cl_environments),
+            min(env.device.max_mem_alloc_size for env in cl_environments))
+
+
+def get_memory_limited_nmr_voxels(model, memory_fraction=0.5, host_memory=None, device_memory=None):
+    """Get the maximum number of voxels we can process at once within the given memory budget.
+
+    This uses :func:`estimate_voxel_memory` to estimate the memory needed per voxel and returns the largest number of
+    voxels that fits in the host memory, the global device memory and the maximum buffer size of the devices.
+
+    Args:
+        model (:class:`~mdt.models.composite.DMRICompositeModel`): the model to process, with the problem data set
+        memory_fraction (float): the fraction of the available host and device memory we may use
+        host_memory (int): the host memory we may use in MB, if not set we use the memory fraction of the
+            memory currently available on the host.
+        device_memory (int): the device memory we may use in MB, if not set we use the memory fraction of the
+            global memory of the smallest device in use.
+
+    Returns:
+        int: the maximum number of voxels we can process at once
+    """
+    host_bytes, device_bytes = estimate_voxel_memory(model)
+    global_mem_size, max_mem_alloc_size = get_device_memory()
+    float_size = 8 if model.double_precision else 4
+
+    limits = [max_mem_alloc_size // (float_size * model.get_nmr_inst_per_problem())]
+
+    if device_memory:
+        limits.append(device_memory * 1024 ** 2 // device_bytes)
+    else:
+        limits.append(int(global_mem_size * memory_fraction) // device_bytes)
+
+    if host_memory:
+        limits.append(host_memory * 1024 ** 2 // host_bytes)
+    else:
+        available_host_memory = get_available_host_memory()
+        if available_host_memory is not None:
+            limits.append(int(available_host_memory * memory_fraction) // host_bytes)
+
+    return int(min(limits))
+
+
+class ChunkSizeTuningCache(object):
+
+    def __init__(self, cache_file=None):
+        """A small on-disk cache with the best performing chunk sizes found by the adaptive processing strategies.
+
+        The chunk sizes are stored per model name, protocol length and the devices in use.
+
+        Args:
+            cache_file (str): the path to the cache file, defaults to a file in the MDT configuration directory
+        """
+        self._cache_file = cache_file or os.path.join(get_config_dir(), 'chunk_size_tuning.json')
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_key(model, cl_environments=None):
+        """Get the key in the cache for the given model processed on the given devices.
+
+        Args:
+            model (:class:`~mdt.models.composite.DMRICompositeModel`): the model, with the problem data set
+            cl_environments (list of CLEnvironment): the CL environments in use, if not given we use the
+                CL environments selected by the load balancer of the current MOT runtime configuration.
+
+        Returns:
+            str: the key for the cache
+        """
+        cl_environments = cl_environments or get_used_cl_environments()
+        devices = ', '.join(sorted(str(env) for env in cl_environments))
+        return '{} | {} | {} | {}'.format(model.name, model.get_nmr_inst_per_problem(),
+                                          'double' if model.double_precision else 'single', devices)
+
+    def get(self, key):
+        """Get the tuned chunk size for the given key.
+
+        Args:
+            key (str): the key, see :meth:`get_key`
+
+        Returns:
+            int: the tuned chunk size, or None if not available
+        """
+        return self._load().get(key)
+
+    def set(self, key, chunk_size):
+        """Store the tuned chunk size for the given key.
+
+        Args:
+            key (str): the key, see :meth:`get_key`
+            chunk_size (int): the chunk size to store
+        """
+        with self._lock:
+            content = self._load()
+            content[key] = int(chunk_size)
+
+            if not os.path.exists(os.path.dirname(self._cache_file)):
+                os.makedirs(os.path.dirname(self._cache_file))
+
+            tmp_file = '{}.{}.tmp'.format(self._cache_file, os.getpid())
+            with open(tmp_file, 'w') as f:
+                json.dump(content, f, indent=4, sort_keys=True)
+
+            if os.path.exists(self._cache_file) and os.name == 'nt':
+                os.remove(self._cache_file)
+            os.rename(tmp_file, self._cache_file)
+
+    def _load(self):
+        if not os.path.isfile(self._cache_file):
+            return {}
+        try:
+            with open(self._cache_file, 'r') as f:
+                return json.load(f)
+        except ValueError:
+            return {}
+
+
+class ThroughputTuner(object):
+
+    def __init__(self, chunk_size, step_factor, bounded, min_step_factor=1.05):
+        """Simple hill climbing on the chunk size to find the size with the best throughput.
+
+        Args:
+            chunk_size (int): the initial chunk size
+            step_factor (float): the initial factor with which we change the chunk size
+            bounded (func): function to bound the chunk size within the limits
+            min_step_factor (float): if the step factor drops below this value we stop tuning
+        """
+        self.chunk_size = chunk_size
+        self.best_chunk_size = None
+        self._best_throughput = None
+        self._step_factor = step_factor
+        self._min_step_factor = min_step_factor
+        self._bounded = bounded
+        self._growing = True
+        self._previous_throughput = None
+
+    def add_measurement(self, chunk_size, run_time):
+        """Add the run time of a full chunk and update the next chunk size.
+
+        Args:
+            chunk_size (int): the size of the processed chunk
+            run_time (float): the time in seconds it took to process the chunk
+        """
+        throughput = chunk_size / max(run_time, 1e-6)
+
+        if self._best_throughput is None or throughput > self._best_throughput:
+            self._best_throughput = throughput
+            self.best_chunk_size = chunk_size
+
+        if self._step_factor < self._min_step_factor:
+            self.chunk_size = self.best_chunk_size
+            return
+
+        if self._previous_throughput is not None and throughput < self._previous_throughput:
+            self._growing = not self._growing
+            self._step_factor = self._step_factor ** 0.5
+        self._previous_throughput = throughput
+
+        if self._growing:
+            next_size = self._bounded(chunk_size * self._step_factor)
+        else:
+            next_size = self._bounded(chunk_size / self._step_factor)
+
+        if next_size == chunk_size:
+            self._growing = not self._growing
+            self._step_factor = self._step_factor ** 0.5
+            next_size = self.best_chunk_size
+
+        self.chunk_size = next_size
+
+
+class ChunksManifest(object):
+
+    def __init__(self, manifest_path, mask, clear_function=None):
+        """An append-only manifest of the chunks that are completely written to the storage.
+
+        Every line in the manifest is a JSON record with the ROI indices of one completed chunk, stored as ranges. A
+        chunk should only be added after all its results are flushed to disk. Since the manifest is only appended
+        to and every addition is synced to disk, a crash can at most leave an incomplete last line, which is ignored.
+
+        The first record holds a hash of the mask. If the mask changed, the results in the storage no longer match
+        the ROI indices, hence we then clear the storage (including the manifest) and start over.
+
+        This class only serializes the access over the threads of one process. If multiple processes use the same
+        manifest, the calls to :meth:`add` and :meth:`get_done_roi_indices` should be guarded by an inter-process lock,
+        like the write lock of the :class:`ModelProcessingWorker`.
+
+        Args:
+            manifest_path (str): the path to the manifest file
+            mask (ndarray): the mask in use, the ROI indices index this mask
+            clear_function (callable): the function to clear the storage if the mask changed, defaults to removing
+                all the files in the directory of the manifest (see :func:`clear_tmp_storage`).
+        """
+        self._logger = logging.getLogger(__name__)
+        self._manifest_path = manifest_path
+        self._mask_hash = hashlib.md5(np.packbits(np.asarray(mask, dtype=bool)).tobytes()).hexdigest()
+        self._lock = threading.Lock()
+        self._clear_function = clear_function or (lambda: clear_tmp_storage(os.path.dirname(manifest_path)))
+
+    def add(self, roi_indices):
+        """Mark the given ROI indices as done.
+
+        Args:
+            roi_indices (ndarray): the ROI indices of the chunk that is completely written to disk
+        """
+        with self._lock:
+            records = []
+            prefix = ''
+            if not os.path.isfile(self._manifest_path):
+                records.append({'mask_hash': self._mask_hash})
+            elif not self._ends_with_newline():
+                prefix = '\n'
+            records.append({'roi_ranges': self._to_ranges(roi_indices)})
+
+            with open(self._manifest_path, 'a') as f:
+                f.write(prefix)
+                for record in records:
+                    f.write(json.dumps(record) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+    def get_done_roi_indices(self):
+        """Get all the ROI indices marked as done.
+
+        Returns:
+            ndarray: the ROI indices of all the completed chunks
+        """
+        with self._lock:
+            return self._read_done_roi_indices()
+
+    def _read_done_roi_indices(self):
+        """Read the ROI indices of all the completed chunks from the manifest, see :meth:`get_done_roi_indices`."""
+        if not os.path.isfile(self._manifest_path):
+            return np.array([], dtype=np.int64)
+
+        roi_indices = []
+        mask_changed = False
+        with open(self._manifest_path, 'r') as f:
+            for line_nmr, line in enumerate(f):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    self._logger.warning('Ignoring an incomplete record in the chunks manifest.')
+                    continue
+
+                if line_nmr == 0 and record.get('mask_hash') != self._mask_hash:
+                    mask_changed = True
+                    break
+
+                for start, end in record.get('roi_ranges', []):
+                    roi_indices.append(np.arange(start, end))
+
+        if mask_changed:
+            self._logger.warning('The mask changed since the temporary results were stored, starting over.')
+            self._clear_function()
+            if os.path.isfile(self._manifest_path):
+                os.remove(self._manifest_path)
+            return np.array([], dtype=np.int64)
+
+        if roi_indices:
+            return np.unique(np.concatenate(roi_indices))
+        return np.array([], dtype=np.int64)
+
+    def _ends_with_newline(self):
+        """Check if the manifest ends with a newline, if not the last record is incomplete."""
+        with open(self._manifest_path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() == 0:
+                return True
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b'\n'
+
+    @staticmethod
+    def _to_ranges(roi_indices):
+        """Convert the given indices to a list of [start, end) ranges of consecutive indices."""
+        roi_indices = np.sort(np.asarray(roi_indices, dtype=np.int64))
+        if not len(roi_indices):
+            return []
+        breaks = np.where(np.diff(roi_indices) != 1)[0] + 1
+        starts = np.concatenate(([0], breaks))
+        ends = np.concatenate((breaks, [len(roi_indices)]))
+        return [[int(roi_indices[start]), int(roi_indices[end - 1]) + 1] for start, end in zip(starts, ends)]
+
+
+def clear_tmp_storage(tmp_storage_dir, protected_paths=()):
+    """Remove all the temporary results in the given directory, except for the given files.
+
+    Args:
+        tmp_storage_dir (str): the directory with the temporary results, the directory itself is kept
+        protected_paths (list of str): the paths of the files we do not remove, like those of a shards coordinator
+    """
+    if not os.path.isdir(tmp_storage_dir):
+        return
+
+    for item in os.listdir(tmp_storage_dir):
+        path = os.path.join(tmp_storage_dir, item)
+        if path in protected_paths:
+            continue
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+
+def sync_to_disk(file_path):
+    """Make sure that all the changes to the given file are written to disk.
+
+    Args:
+        file_path (str): the file to sync
+    """
+    with open(file_path, 'rb+') as f:
+        os.fsync(f.fileno())
+
+
+def get_fitting_results_prefetch(model):
+    """Get the names of the result maps of a model fit which we read directly when loading the results.
+
+    These are the maps used after the fit, for example to initialize the next model in a cascade or to refit the
+    failed voxels. See the ``prefetch`` argument of :func:`~mdt.nifti.get_all_image_data`.
+
+    Args:
+        model (:class:`~mdt.models.composite.DMRICompositeModel`): the fitted model
+
+    Returns:
+        list of str: the names of the maps to prefetch
+    """
+    return list(model.get_optimization_output_param_names()) + ['ReturnCodes', 'Errors.mse']
+
+
 class ModelProcessingWorkerCreator(object):
 
     def create_worker(self, model, problem_data, output_dir, tmp_storage_dir, honor_voxels_to_analyze):
@@ -246,8 +1167,103 @@ class ModelProcessingWorker(object):
         self._output_dir = output_dir
         self._tmp_storage_dir = tmp_storage_dir
         self._honor_voxels_to_analyze = honor_voxels_to_analyze
-        self._roi_lookup_path = os.path.join(self._tmp_storage_dir, '_roi_voxel_lookup_table.npy')
-        self._volume_indices = self._create_roi_to_volume_index_lookup_table()
+        self._volume_indices = get_mask_index(self._problem_data.mask).coordinates
+        self._write_lock = threading.Lock()
+        self._results_writer = None
+        self._keep_tmp_results = False
+        self._chunk_timings = {'process': None, 'write': None}
+        self._protected_paths = []
+        self._chunks_manifest = ChunksManifest(os.path.join(self._tmp_storage_dir, 'chunks_manifest.jsonl'),
+                                               self._problem_data.mask, clear_function=self._clear_tmp_storage)
+        self._performance_log_path = os.path.join(self._tmp_storage_dir, 'performance.jsonl')
+
+    @property
+    def model(self):
+        """Get the model processed by this worker.
+
+        Returns:
+            :class:`~mdt.models.composite.DMRICompositeModel`: the model processed by this worker
+        """
+        return self._model
+
+    def get_device_worker(self, cl_environments):
+        """Get a copy of this worker that processes the model of this worker on the given CL environments.
+
+        The copy shares the temporary storage and the background writer with this worker, which allows multiple
+        device workers to process different chunks of the same model concurrently. Writing to the temporary storage
+        is serialized over all the copies.
+
+        The copy gets its own chunk timings and a (shallow) copy of the model. The model is only read during
+        processing, except for its ``problems_to_analyze``, which is set per chunk on the copy.
+
+        Args:
+            cl_environments (list of CLEnvironment): the CL environments the device worker should use
+
+        Returns:
+            ModelProcessingWorker: a copy of this worker for the given device(s)
+        """
+        worker = copy.copy(self)
+        worker._model = copy.copy(self._model)
+        worker._chunk_timings = {'process': None, 'write': None}
+        worker._set_cl_environments(cl_environments)
+        return worker
+
+    def _set_cl_environments(self, cl_environments):
+        """Set the CL environments of the routine used by this worker.
+
+        Args:
+            cl_environments (list of CLEnvironment): the CL environments to use
+        """
+
+    @property
+    def chunk_timings(self):
+        """Get the timings of the last processed chunk.
+
+        Returns:
+            dict: with the keys 'process', the time in seconds the routine (optimizer or sampler) spent on the last
+                chunk, and 'write', the time spent on writing the last chunk results to the temporary storage.
+                The values are None if not yet known. With background writing the write time may be of an earlier
+                chunk than the process time.
+        """
+        return dict(self._chunk_timings)
+
+    def set_write_queue_size(self, queue_size):
+        """Set the number of chunk results that may wait to be written to the temporary storage.
+
+        If larger than zero, the results of every processed chunk are handed to a background writer thread, such
+        that the processing of the next chunk can start while the previous results are still being written. If the
+        queue is full, :meth:`process` blocks until the writer has caught up. Device workers share the writer with
+        the worker they were created from.
+
+        Args:
+            queue_size (int): the maximum number of chunk results in the write queue, set to 0 or None to disable
+                the background writing and write all results directly.
+        """
+        if self._results_writer is not None:
+            self._results_writer.close()
+
+        self._results_writer = None
+        if queue_size:
+            self._results_writer = ResultsWriter(max_queue_size=queue_size)
+
+    def set_keep_tmp_results(self, keep_tmp_results):
+        """Set if the temporary results are kept after combining.
+
+        If set, the temporary nifti files are copied to the output directory instead of moved.
+
+        Args:
+            keep_tmp_results (boolean): if the processing strategy keeps the temporary results after combining
+        """
+        self._keep_tmp_results = keep_tmp_results
+
+    def flush(self):
+        """Wait until all the processed results are written to the temporary storage.
+
+        This is a barrier for the background writing, call this before reading anything from the temporary storage.
+        This will raise the first error that occurred while writing the results, if any.
+        """
+        if self._results_writer is not None:
+            self._results_writer.flush()
 
     def process(self, roi_indices):
         """Process the indicated voxels in the way prescribed by this worker.
@@ -266,130 +1282,434 @@ class ModelProcessingWorker(object):
         """Get the ROI indices of the voxels we need to compute.
 
         This should either return an entire list with all the ROI indices for the given brain mask, or a list
-        with the specific roi indices we want the strategy to compute.
+        with the specific roi indices we want the strategy to compute. The voxels of chunks marked as done in the
+        chunks manifest of the temporary storage are excluded.
 
         Returns:
             ndarray: the list of ROI indices (indexing the current mask) with the voxels we want to compute.
         """
-        if self._honor_voxels_to_analyze and self._model.problems_to_analyze:
-            roi_list = self._model.problems_to_analyze
+        if self._honor_voxels_to_analyze and self._model.problems_to_analyze is not None:
+            roi_list = np.asarray(self._model.problems_to_analyze)
         else:
-            roi_list = np.arange(0, np.count_nonzero(self._problem_data.mask))
+            roi_list = np.arange(0, get_mask_index(self._problem_data.mask).nmr_voxels)
 
-        mask_path = os.path.join(self._tmp_storage_dir, '{}.npy'.format(self._used_mask_name))
-        if os.path.exists(mask_path):
-            return roi_list[np.logical_not(np.squeeze(create_roi(np.load(mask_path, mmap_mode='r'),
-                                                                 self._problem_data.mask)[roi_list]))]
+        with self._write_lock:
+            done_roi_indices = self._chunks_manifest.get_done_roi_indices()
+        if len(done_roi_indices):
+            return roi_list[np.logical_not(np.in1d(roi_list, done_roi_indices))]
         return roi_list
 
+    def add_write_callback(self, callback, *args):
+        """Call the given function after all the results processed up to now are written.
+
+        With background writing this returns directly and the callback is called in the writer thread, else the
+        callback is called directly.
+
+        Args:
+            callback (callable): the function to call
+            *args: the arguments for the callback
+        """
+        self._write_results(callback, *args)
+
+    def set_write_lock(self, write_lock):
+        """Set the lock used to serialize the writing to the temporary storage.
+
+        By default this is a thread lock shared by all the device copies of this worker. Set this to an inter-process
+        lock if multiple processes write to the same temporary storage.
+
+        Args:
+            write_lock: a lock supporting the context manager protocol
+        """
+        self._write_lock = write_lock
+
+    def set_protected_paths(self, protected_paths):
+        """Set the files in the temporary storage that are kept if the worker clears the temporary storage.
+
+        The temporary storage is cleared if the mask changed since the stored results were written. Use this for
+        files shared with other processes, like those of the shards coordinator.
+
+        Args:
+            protected_paths (list of str): the paths of the files to keep
+        """
+        self._protected_paths = list(protected_paths)
+
+    def close(self):
+        """Finish writing and remove the temporary files specific to this worker, without combining the results.
+
+        This is called by :meth:`combine`. Use this directly if another worker combines the results.
+        """
+        self.flush()
+        if self._results_writer is not None:
+            self._results_writer.close()
+            self._results_writer = None
+
     def combine(self):
         """Combine all the calculated parts.
 
         Returns:
             the processing results for as much as this is applicable
         """
-        del self._volume_indices
-        os.remove(self._roi_lookup_path)
+        self.close()
 
-    def _write_volumes(self, roi_indices, results, tmp_dir):
-        """Write the result arrays to the temporary storage
+    def load_results(self):
+        """Load the results after they have been combined.
+
+        Returns:
+            the processing results for as much as this is applicable, the same as returned by :meth:`combine`.
+        """
+
+    def _write_results(self, write_function, *args):
+        """Write results using the given function, using the background writer if enabled.
+
+        The given arguments should not be changed after calling this function since the writing may happen later.
+
+        Args:
+            write_function (callable): the function that writes the results
+            *args: the arguments to the write function
+        """
+        if self._results_writer is None:
+            write_function(*args)
+        else:
+            self._results_writer.submit(write_function, *args)
+
+    def _get_used_devices(self):
+        """Get the names of the devices used by the routine of this worker.
+
+        Returns:
+            list of str: the names of the devices in use
+        """
+        return []
+
+    def _get_chunk_stats(self, roi_indices, process_time):
+        """Create the performance statistics of a processed chunk, to which the write time is added when writing.
 
         Args:
             roi_indices (ndarray): the indices of the voxels we computed
-            results (dict): the dictionary with the results to save
-            tmp_dir (str): the directory to save the intermediate results to
+            process_time (float): the time spent by the routine (optimizer or sampler) in seconds
+
+        Returns:
+            dict: the statistics of this chunk
+        """
+        return {'nmr_voxels': len(roi_indices),
+                'process_time': process_time,
+                'transfer_time': None,
+                'write_time': 0.0,
+                'devices': self._get_used_devices(),
+                'host': socket.gethostname(),
+                'pid': os.getpid()}
+
+    def _record_chunk_stats(self, chunk_stats):
+        """Append the statistics of a processed chunk to the performance log in the temporary storage.
+
+        This should be called after the chunk is written, such that the write time is included. This holds the
+        write lock, which serializes the appends to the performance log over all the processes writing to the same
+        temporary storage.
+
+        Args:
+            chunk_stats (dict): the statistics of the chunk, see :meth:`_get_chunk_stats`
         """
-        if not os.path.exists(tmp_dir):
-            os.makedirs(tmp_dir)
+        chunk_stats = dict(chunk_stats)
+        total_time = chunk_stats['process_time'] + chunk_stats['write_time']
+        chunk_stats['voxels_per_second'] = chunk_stats['nmr_voxels'] / total_time if total_time else None
+        chunk_stats['peak_rss_mb'] = get_peak_memory_usage()
+
+        with self._write_lock:
+            with open(self._performance_log_path, 'a') as f:
+                f.write(json.dumps(chunk_stats) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _write_performance_summary(self, combine_time, nifti_write_time):
+        """Write the performance statistics of all the chunks and the combine step to ``performance.json``.
+
+        Args:
+            combine_time (float): the total time spent combining the results, in seconds
+            nifti_write_time (float): the part of the combine time spent writing the nifti files, in seconds
+        """
+        chunks = []
+        if os.path.isfile(self._performance_log_path):
+            with open(self._performance_log_path, 'r') as f:
+                for line in f:
+                    try:
+                        chunks.append(json.loads(line))
+                    except ValueError:
+                        continue
+
+        process_time = sum(chunk['process_time'] for chunk in chunks)
+        write_time = sum(chunk['write_time'] for chunk in chunks)
+        nmr_voxels = sum(chunk['nmr_voxels'] for chunk in chunks)
+        peak_rss = [v for v in [chunk['peak_rss_mb'] for chunk in chunks] + [get_peak_memory_usage()]
+                    if v is not None]
+
+        summary = {'chunks': chunks,
+                   'totals': {'nmr_chunks': len(chunks),
+                              'nmr_voxels': nmr_voxels,
+                              'process_time': process_time,
+                              'write_time': write_time,
+                              'voxels_per_second': nmr_voxels / (process_time + write_time)
+                              if process_time + write_time else None,
+                              'combine_time': combine_time,
+                              'nifti_write_time': nifti_write_time,
+                              'peak_rss_mb': max(peak_rss) if peak_rss else None}}
+
+        with open(os.path.join(self._output_dir, 'performance.json'), 'w') as f:
+            json.dump(summary, f, indent=4, sort_keys=True)
+
+    def _clear_tmp_storage(self):
+        """Remove all the temporary results, except for the protected files, see :meth:`set_protected_paths`."""
+        clear_tmp_storage(self._tmp_storage_dir, self._protected_paths)
+
+    def _mark_chunk_done(self, roi_indices):
+        """Mark the given chunk as completed in the chunks manifest.
+
+        This should be the last write action for a chunk, after all the results of the chunk are synced to disk.
+        This holds the write lock, which serializes the additions to the manifest over all the processes writing to
+        the same temporary storage.
+
+        Args:
+            roi_indices (ndarray): the indices of the voxels we computed
+        """
+        with self._write_lock:
+            self._chunks_manifest.add(roi_indices)
+
+    def _write_volumes(self, roi_indices, results, tmp_dir, chunk_stats=None):
+        """Write the result arrays to the temporary storage
 
-        volume_indices = self._volume_indices[roi_indices, :]
+        The results are written directly into preallocated uncompressed nifti files, which are moved (or compressed)
+        to the output directory when the results are combined.
 
-        for param_name, result_array in results.items():
-            storage_path = os.path.join(tmp_dir, param_name + '.npy')
+        This is serialized over all the (device) copies of this worker. All the written files are synced to disk
+        before this function returns.
 
-            map_4d_dim_len = 1
-            if len(result_array.shape) > 1:
-                map_4d_dim_len = result_array.shape[1]
+        Args:
+            roi_indices (ndarray): the indices of the voxels we computed
+            results (dict): the dictionary with the results to save
+            tmp_dir (str): the directory to save the intermediate results to
+            chunk_stats (dict): if given, the statistics of the chunk to which we add the write time
+        """
+        with self._write_lock:
+            start_time = timeit.default_timer()
+
+            if not os.path.exists(tmp_dir):
+                os.makedirs(tmp_dir)
+
+            volume_indices = self._volume_indices[roi_indices, :]
+
+            if getattr(self._model, 'output_maps_selection', None) is not None:
+                results = self._model.output_maps_selection.select(results)
+
+            for param_name, result_array in results.items():
+                storage_path = os.path.join(tmp_dir, param_name + '.nii')
+
+                map_4d_dim_len = 1
+                if len(result_array.shape) > 1:
+                    map_4d_dim_len = result_array.shape[1]
+                else:
+                    result_array = np.reshape(result_array, (-1, 1))
+
+                if os.path.isfile(storage_path):
+                    tmp_matrix = open_nifti_memmap(storage_path)
+                else:
+                    tmp_matrix = create_nifti_memmap(storage_path, self._problem_data.volume_header,
+                                                     self._problem_data.mask.shape[0:3] + (map_4d_dim_len,),
+                                                     result_array.dtype)
+                tmp_matrix[volume_indices[:, 0], volume_indices[:, 1], volume_indices[:, 2]] = result_array
+                tmp_matrix.flush()
+                del tmp_matrix
+                sync_to_disk(storage_path)
+
+            mask_path = os.path.join(tmp_dir, '{}.nii'.format(self._used_mask_name))
+            if os.path.isfile(mask_path):
+                tmp_mask = open_nifti_memmap(mask_path)
             else:
-                result_array = np.reshape(result_array, (-1, 1))
-
-            mode = 'w+'
-            if os.path.isfile(storage_path):
-                mode = 'r+'
-            tmp_matrix = open_memmap(storage_path, mode=mode, dtype=result_array.dtype,
-                                     shape=self._problem_data.mask.shape[0:3] + (map_4d_dim_len,))
-            tmp_matrix[volume_indices[:, 0], volume_indices[:, 1], volume_indices[:, 2]] = result_array
-
-        mask_path = os.path.join(tmp_dir, '{}.npy'.format(self._used_mask_name))
-        mode = 'w+'
-        if os.path.isfile(mask_path):
-            mode = 'r+'
-        tmp_mask = open_memmap(mask_path, mode=mode, dtype=np.bool, shape=self._problem_data.mask.shape)
-        tmp_mask[volume_indices[:, 0], volume_indices[:, 1], volume_indices[:, 2]] = True
+                tmp_mask = create_nifti_memmap(mask_path, self._problem_data.volume_header,
+                                               self._problem_data.mask.shape, bool)
+            tmp_mask[volume_indices[:, 0], volume_indices[:, 1], volume_indices[:, 2]] = True
+            tmp_mask.flush()
+            del tmp_mask
+            sync_to_disk(mask_path)
+
+            self._chunk_timings['write'] = timeit.default_timer() - start_time
+            if chunk_stats is not None:
+                chunk_stats['write_time'] += self._chunk_timings['write']
 
     def _combine_volumes(self, output_dir, chunks_dir, volume_header, maps_subdir=''):
         """Combine volumes found in subdirectories to a final volume.
 
+        The temporary results are already stored as nifti files, this moves them to the output directory, or, if
+        gzip is enabled, compresses them to the output directory. Compression is done for multiple volumes
+        concurrently, using the gzip options from the configuration. If the temporary results are kept, the files are
+        copied instead of moved. Maps for which the configuration sets another output data type are converted
+        while they are written to the output directory.
+
         Args:
             output_dir (str): the location for the output files
             chunks_dir (str): the directory in which all the chunks are located
             maps_subdir (str): we may have per chunk a subdirectory in which the maps are located. This
                 parameter is for that subdir. Example search: <chunks_dir>/<chunk>/<maps_subdir>/*.nii*
-
-        Returns:
-            dict: the dictionary with the ROIs for every volume, by parameter name
         """
         if not os.path.exists(os.path.join(output_dir, maps_subdir)):
             os.makedirs(os.path.join(output_dir, maps_subdir))
 
         map_names = list(map(lambda p: os.path.splitext(os.path.basename(p))[0],
-                             glob.glob(os.path.join(chunks_dir, maps_subdir, '*.npy'))))
+                             glob.glob(os.path.join(chunks_dir, maps_subdir, '*.nii'))))
 
         basic_info = (os.path.join(chunks_dir, maps_subdir),
                       os.path.join(output_dir, maps_subdir),
-                      volume_header,
-                      self._write_volumes_gzipped)
+                      self._write_volumes_gzipped,
+                      self._keep_tmp_results,
+                      get_gzip_compression_level(),
+                      self._used_mask_name)
         info_list = [(map_name, basic_info) for map_name in map_names]
 
-        list(map(_combine_volumes_write_out, info_list))
+        nmr_workers = min(len(info_list), get_gzip_nmr_workers() or cpu_count())
+        if nmr_workers > 1:
+            pool = ThreadPool(nmr_workers)
+            try:
+                pool.map(_combine_volumes_write_out, info_list)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            list(map(_combine_volumes_write_out, info_list))
 
-    def _create_roi_to_volume_index_lookup_table(self):
-        """Creates and returns a lookup table for roi index -> volume index.
 
-        This will create from the given mask a memory mapped lookup table mapping the ROI indices (single integer)
-        to the correct voxel location in 3d. To find a voxel index using the ROI index, just index this lookup
-        table using the ROI index as index.
+class ResultsWriter(object):
 
-        For example, suppose we have the lookup table:
+    def __init__(self, max_queue_size=2):
+        """Writes results in a background thread.
 
-            0: (0, 0, 0)
-            1: (0, 0, 1)
-            2: (0, 1, 0)
-            ...
+        Writing jobs are put in a bounded queue and executed in submission order by a single writer thread. If the
+        queue is full, :meth:`submit` blocks until there is room, limiting the number of results held in memory.
 
-        We can get the position of a voxel in the 3d space by indexing this array as: ``lookup_table[roi_index]``
-        to get the correct 3d location.
+        Args:
+            max_queue_size (int): the maximum number of write jobs waiting in the queue
+        """
+        self._logger = logging.getLogger(__name__)
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._errors = []
+        self._thread = None
+        self._thread_lock = threading.Lock()
 
-        Returns:
-            memmap ndarray: the memory mapped array which
+    def submit(self, write_function, *args):
+        """Add a write job to the queue, starts the writer thread if needed.
+
+        This may be called concurrently from multiple threads, the jobs of every thread are written in the order in
+        which that thread submitted them.
+
+        Args:
+            write_function (callable): the function to call in the writer thread
+            *args: the arguments for the write function
+
+        Raises:
+            Exception: the first error raised by a previous write job, if any
+        """
+        self._raise_errors()
+
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._write_jobs)
+                self._thread.daemon = True
+                self._thread.start()
+
+        self._queue.put((write_function, args))
+
+    def flush(self):
+        """Block until all the submitted write jobs are finished.
+
+        Raises:
+            Exception: the first error raised by a write job, if any
         """
-        if os.path.isfile(self._roi_lookup_path):
-            os.remove(self._roi_lookup_path)
-        np.save(self._roi_lookup_path, np.argwhere(self._problem_data.mask))
-        return np.load(self._roi_lookup_path, mmap_mode='r')
+        if self._thread is not None:
+            self._queue.join()
+        self._raise_errors()
+
+    def close(self):
+        """Finish all the write jobs and stop the writer thread."""
+        with self._thread_lock:
+            if self._thread is not None:
+                self._queue.join()
+                self._queue.put(None)
+                self._thread.join()
+                self._thread = None
+
+    def _raise_errors(self):
+        if self._errors:
+            raise self._errors[0]
+
+    def _write_jobs(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+
+                write_function, args = job
+                if not self._errors:
+                    write_function(*args)
+            except Exception as exc:
+                self._logger.exception('Writing the results failed.')
+                self._errors.append(exc)
+            finally:
+                self._queue.task_done()
 
 
 def _combine_volumes_write_out(info_pair):
-    """Write out the given information to a nifti volume.
+    """Move or compress the given temporary nifti volume to the output directory.
 
     Needs to be used by ModelProcessingWorker._combine_volumes
     """
     map_name, info_list = info_pair
-    chunks_dir, output_dir, volume_header, write_gzipped = info_list
+    chunks_dir, output_dir, write_gzipped, keep_tmp_results, compression_level, used_mask_name = info_list
+
+    tmp_path = os.path.join(chunks_dir, map_name + '.nii')
+    output_path = os.path.join(output_dir, map_name + '.nii')
+
+    for existing_path in (output_path, output_path + '.gz'):
+        if os.path.exists(existing_path):
+            os.remove(existing_path)
+
+    output_dtype = None
+    if map_name != used_mask_name:
+        header = nib.load(tmp_path).header
+        output_dtype = _get_output_dtype(map_name, header.get_data_dtype(), header.get_data_shape())
+
+    if output_dtype is not None:
+        convert_nifti_dtype(tmp_path, output_path + ('.gz' if write_gzipped else ''), output_dtype,
+                            remove_original=not keep_tmp_results, compression_level=compression_level)
+    elif write_gzipped:
+        gzip_nifti(tmp_path, output_path + '.gz', remove_original=not keep_tmp_results,
+                   compression_level=compression_level)
+    elif keep_tmp_results:
+        shutil.copy(tmp_path, output_path)
+    else:
+        shutil.move(tmp_path, output_path)
+
+
+def _get_output_dtype(map_name, dtype, shape):
+    """Get the data type in which we want to store the given result map.
+
+    Args:
+        map_name (str): the name of the map
+        dtype (np.dtype): the data type of the map
+        shape (tuple): the shape of the map
+
+    Returns:
+        np.dtype: the data type to store the map in, or None if the map should be stored as is
+    """
+    if map_name == 'ReturnCodes':
+        map_class = 'return_codes'
+    elif np.issubdtype(dtype, np.integer):
+        map_class = 'indices'
+    elif len(shape) > 3 and shape[3] > 1:
+        map_class = 'vectors'
+    else:
+        map_class = 'parameters'
 
-    data = np.load(os.path.join(chunks_dir, map_name + '.npy'), mmap_mode='r')
-    write_all_as_nifti({map_name: data}, output_dir, volume_header, gzip=write_gzipped)
-    del data
+    output_dtype = get_output_dtype(map_class)
+    if output_dtype is None or np.dtype(output_dtype) == dtype:
+        return None
+    return np.dtype(output_dtype)
 
 
 class FittingProcessingWorker(ModelProcessingWorker):
@@ -406,17 +1726,41 @@ class FittingProcessingWorker(ModelProcessingWorker):
         self._optimizer = optimizer
         self._write_volumes_gzipped = gzip_optimization_results()
 
+    def _set_cl_environments(self, cl_environments):
+        self._optimizer = copy.copy(self._optimizer)
+        self._optimizer.cl_environments = cl_environments
+        self._optimizer.load_balancer = EvenDistribution()
+
     def process(self, roi_indices):
+        start_time = timeit.default_timer()
         results, extra_output = self._optimizer.minimize(self._model, full_output=True)
+        self._chunk_timings['process'] = timeit.default_timer() - start_time
         results.update(extra_output)
 
-        self._write_volumes(roi_indices, results, self._tmp_storage_dir)
+        chunk_stats = self._get_chunk_stats(roi_indices, self._chunk_timings['process'])
+        self._write_results(self._write_volumes, roi_indices, results, self._tmp_storage_dir, chunk_stats)
+        self._write_results(self._mark_chunk_done, roi_indices)
+        self._write_results(self._record_chunk_stats, chunk_stats)
         return results
 
     def combine(self):
+        start_time = timeit.default_timer()
         super(FittingProcessingWorker, self).combine()
+
+        nifti_start_time = timeit.default_timer()
         self._combine_volumes(self._output_dir, self._tmp_storage_dir, self._problem_data.volume_header)
-        return create_roi(get_all_image_data(self._output_dir), self._problem_data.mask)
+        nifti_write_time = timeit.default_timer() - nifti_start_time
+
+        self._write_performance_summary(timeit.default_timer() - start_time, nifti_write_time)
+        return self.load_results()
+
+    def _get_used_devices(self):
+        return [str(env) for env in
+                self._optimizer.load_balancer.get_used_cl_environments(self._optimizer.cl_environments)]
+
+    def load_results(self):
+        return create_roi(get_all_image_data(self._output_dir, prefetch=get_fitting_results_prefetch(self._model)),
+                          self._problem_data.mask)
 
 
 class SamplingProcessingWorker(ModelProcessingWorker):
@@ -440,30 +1784,58 @@ class SamplingProcessingWorker(ModelProcessingWorker):
         self._write_volumes_gzipped = gzip_sampling_results()
         self._store_samples = store_samples
 
+    def _set_cl_environments(self, cl_environments):
+        self._sampler = copy.copy(self._sampler)
+        self._sampler.cl_environments = cl_environments
+        self._sampler.load_balancer = EvenDistribution()
+
     def process(self, roi_indices):
+        start_time = timeit.default_timer()
         results, other_output = self._sampler.sample(self._model, full_output=True)
+        self._chunk_timings['process'] = timeit.default_timer() - start_time
 
-        self._write_volumes(roi_indices, other_output, os.path.join(self._tmp_storage_dir, 'volume_maps'))
+        chunk_stats = self._get_chunk_stats(roi_indices, self._chunk_timings['process'])
+        self._write_results(self._write_volumes, roi_indices, other_output,
+                            os.path.join(self._tmp_storage_dir, 'volume_maps'), chunk_stats)
+
+        if self._store_samples:
+            self._write_results(self._write_sample_results, results, self._problem_data.mask, roi_indices,
+                                chunk_stats)
+
+        self._write_results(self._mark_chunk_done, roi_indices)
+        self._write_results(self._record_chunk_stats, chunk_stats)
 
         if self._store_samples:
-            self._write_sample_results(results, self._problem_data.mask, roi_indices)
             return results
 
         return SamplingProcessingWorker.SampleChainNotStored()
 
     def combine(self):
+        start_time = timeit.default_timer()
         super(SamplingProcessingWorker, self).combine()
+
+        nifti_start_time = timeit.default_timer()
         self._combine_volumes(self._output_dir, self._tmp_storage_dir,
                               self._problem_data.volume_header, maps_subdir='volume_maps')
+        nifti_write_time = timeit.default_timer() - nifti_start_time
 
         if self._store_samples:
             for samples in glob.glob(os.path.join(self._tmp_storage_dir, '*.samples.npy')):
                 shutil.move(samples, self._output_dir)
-            return load_samples(self._output_dir)
 
+        self._write_performance_summary(timeit.default_timer() - start_time, nifti_write_time)
+        return self.load_results()
+
+    def _get_used_devices(self):
+        return [str(env) for env in
+                self._sampler.load_balancer.get_used_cl_environments(self._sampler.cl_environments)]
+
+    def load_results(self):
+        if self._store_samples:
+            return load_samples(self._output_dir)
         return SamplingProcessingWorker.SampleChainNotStored()
 
-    def _write_sample_results(self, results, full_mask, roi_indices):
+    def _write_sample_results(self, results, full_mask, roi_indices, chunk_stats=None):
         """Write the sample results to a .npy file.
 
         If the given sample files do not exists or if the existing file is not large enough it will create one
@@ -474,22 +1846,32 @@ class SamplingProcessingWorker(ModelProcessingWorker):
             results (dict): the samples to write
             full_mask (ndarray): the complete mask for the entire brain
             roi_indices (ndarray): the roi indices of the voxels we computed
+            chunk_stats (dict): if given, the statistics of the chunk to which we add the write time
         """
-        total_nmr_voxels = np.count_nonzero(full_mask)
-
-        if not os.path.exists(self._output_dir):
-            os.makedirs(self._output_dir)
-
-        for map_name, samples in results.items():
-            samples_path = os.path.join(self._output_dir, map_name + '.samples.npy')
-            mode = 'w+'
-            if os.path.isfile(samples_path):
-                mode = 'r+'
-                current_results = open_memmap(samples_path, mode='r')
-                if current_results.shape[1] != samples.shape[1]:
-                    mode = 'w+'
-                del current_results # closes the memmap
-
-            saved = open_memmap(samples_path, mode=mode, dtype=samples.dtype,
-                                shape=(total_nmr_voxels, samples.shape[1]))
-            saved[roi_indices, :] = samples
+        total_nmr_voxels = get_mask_index(full_mask).nmr_voxels
+
+        with self._write_lock:
+            start_time = timeit.default_timer()
+
+            if not os.path.exists(self._output_dir):
+                os.makedirs(self._output_dir)
+
+            for map_name, samples in results.items():
+                samples_path = os.path.join(self._output_dir, map_name + '.samples.npy')
+                mode = 'w+'
+                if os.path.isfile(samples_path):
+                    mode = 'r+'
+                    current_results = open_memmap(samples_path, mode='r')
+                    if current_results.shape[1] != samples.shape[1]:
+                        mode = 'w+'
+                    del current_results  # closes the memmap
+
+                saved = open_memmap(samples_path, mode=mode, dtype=samples.dtype,
+                                    shape=(total_nmr_voxels, samples.shape[1]))
+                saved[roi_indices, :] = samples
+                saved.flush()
+                del saved
+                sync_to_disk(samples_path)
+
+            if chunk_stats is not None:
+                chunk_stats['write_time'] += timeit.default_timer() - start_time
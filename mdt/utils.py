@@ -1,12 +1,17 @@
 import collections
 import distutils.dir_util
 import glob
+import hashlib
+import json
 import logging
 import logging.config as logging_config
 import os
 import re
 import shutil
 import tempfile
+import threading
+import time
+import weakref
 from collections import defaultdict
 from contextlib import contextmanager
 
@@ -18,7 +23,9 @@ from scipy.special import jnp_zeros
 from six import string_types
 
 import mot.utils
-from mdt.nifti import load_nifti, write_nifti, write_all_as_nifti, get_all_image_data
+from mdt.__version__ import __version__
+from mdt.nifti import load_nifti, write_nifti, write_all_as_nifti, get_all_image_data, load_nifti_memmap, \
+    load_nifti_data, ScaledVolume, yield_nifti_info
 from mdt.cl_routines.mapping.calculate_eigenvectors import CalculateEigenvectors
 from mdt.components_loader import get_model
 from mdt.configuration import get_config_dir
@@ -51,7 +58,7 @@ __email__ = "robbert.harms@maastrichtuniversity.nl"
 class DMRIProblemData(AbstractProblemData):
 
     def __init__(self, protocol, dwi_volume, mask, volume_header, static_maps=None, gradient_deviations=None,
-                 noise_std=None):
+                 noise_std=None, dtype=None):
         """An implementation of the problem data for diffusion MRI models.
 
         Args:
@@ -65,6 +72,15 @@ class DMRIProblemData(AbstractProblemData):
                 index and the 4th should contain the grad dev data.
             noise_std (number or ndarray): either None for automatic detection,
                 or a scalar, or an 3d matrix with one value per voxel.
+            dtype (np.dtype): the storage data type for the observations, static maps and noise std. If given, the
+                observations are converted per chunk and the maps once when loaded. Typically this matches the
+                precision of the model, float32 for single and float64 for double precision.
+                If None we keep the data types of the given data.
+
+        The observations are loaded lazily, that is, only the voxels selected by the model (using
+        ``problems_to_analyze``) are read from the DWI volume, when needed. If the DWI volume is a memory map (see
+        :func:`load_problem_data` with ``lazy=True``) this reads only those voxels from disk.
+        See :class:`LazyROI` for details.
 
         Attributes:
             dwi_volume (ndarray): The DWI volume
@@ -79,23 +95,61 @@ class DMRIProblemData(AbstractProblemData):
         self._static_maps = static_maps or {}
         self.gradient_deviations = gradient_deviations
         self._noise_std = noise_std
+        self.dtype = dtype
+        self._static_maps_cache = {}
+        self._noise_std_cache = {}
 
     def copy_with_updates(self, *args, **kwargs):
         """Create a copy of this problem data, while setting some of the arguments to new values.
 
         You can use any of the arguments (args and kwargs) of the constructor for this call.
         If given we will use those values instead of the values in this problem data object for the copy.
+
+        The loaded static maps and noise std are shared with the copy if the mask and their sources are not updated.
+        The noise std is also only shared if the protocol and DWI volume are not updated,
+        see :meth:`get_volume_subset` for an exception.
         """
         new_args = [self._protocol, self.dwi_volume, self._mask, self.volume_header]
         for ind, value in enumerate(args):
             new_args[ind] = value
 
         new_kwargs = dict(static_maps=self._static_maps, gradient_deviations=self.gradient_deviations,
-                          noise_std=self._noise_std)
+                          noise_std=self._noise_std, dtype=self.dtype)
         for key, value in kwargs.items():
             new_kwargs[key] = value
 
-        return DMRIProblemData(*new_args, **new_kwargs)
+        new_problem_data = DMRIProblemData(*new_args, **new_kwargs)
+
+        if new_args[2] is self._mask and new_kwargs['dtype'] == self.dtype:
+            if new_kwargs['static_maps'] is self._static_maps:
+                new_problem_data._static_maps_cache = self._static_maps_cache
+            if new_kwargs['noise_std'] is self._noise_std and new_args[0] is self._protocol \
+                    and new_args[1] is self.dwi_volume:
+                new_problem_data._noise_std_cache = self._noise_std_cache
+
+        return new_problem_data
+
+    def get_volume_subset(self, volume_indices):
+        """Create a copy of this problem data with only the given volumes of the protocol and the DWI.
+
+        This does not copy the DWI data. The new DWI volume is a :class:`VolumeSubset` of the current DWI volume and
+        the new observations are a column selection on the current observations. The noise std is loaded or
+        estimated on this problem data, using all the volumes, before the subset is created. The subset uses that
+        value, such that all the models in a cascade use a single estimate from the full data.
+
+        Args:
+            volume_indices (ndarray): the indices of the volumes (protocol rows) to keep
+
+        Returns:
+            DMRIProblemData: a copy of this problem data with only the given volumes
+        """
+        volume_indices = np.asarray(volume_indices)
+        new_problem_data = self.copy_with_updates(self._protocol.get_new_protocol_with_indices(volume_indices),
+                                                  VolumeSubset(self.dwi_volume, volume_indices))
+        if isinstance(self.observations, LazyROI):
+            new_problem_data._observation_list = self.observations.get_volume_subset(volume_indices)
+        new_problem_data._noise_std_cache = {'noise_std': self.noise_std}
+        return new_problem_data
 
     def get_nmr_inst_per_problem(self):
         return self._protocol.length
@@ -107,7 +161,8 @@ class DMRIProblemData(AbstractProblemData):
     @property
     def observations(self):
         if self._observation_list is None:
-            self._observation_list = create_roi(self.dwi_volume, self._mask)
+            self._observation_list = LazyROI(self.dwi_volume, autodetect_brain_mask_loader(self._mask).get_data(),
+                                             dtype=self.dtype)
         return self._observation_list
 
     @property
@@ -128,11 +183,15 @@ class DMRIProblemData(AbstractProblemData):
         """
         self._mask = new_mask
         self._observation_list = None
+        self._static_maps_cache = {}
+        self._noise_std_cache = {}
 
     @property
     def static_maps(self):
         """Get the static maps. They are used as data for the static parameters.
 
+        The maps are loaded once per mask, the loaded maps are cached until the mask is changed.
+
         Returns:
             Dict[str, val]: per static map the value for the static map. This can either be an one or two dimensional
                 matrix containing the values for each problem instance or it can be a single value we will use
@@ -142,17 +201,22 @@ class DMRIProblemData(AbstractProblemData):
             return_items = {}
 
             for key, val in self._static_maps.items():
+                if key not in self._static_maps_cache:
+                    loaded_val = None
+
+                    if isinstance(val, six.string_types):
+                        loaded_val = create_roi(load_nifti_data(val, dtype=self.dtype)[0], self.mask)
+                    elif isinstance(val, np.ndarray):
+                        loaded_val = create_roi(val, self.mask)
+                    elif is_scalar(val):
+                        loaded_val = val
 
-                loaded_val = None
+                    if self.dtype is not None and isinstance(loaded_val, np.ndarray):
+                        loaded_val = loaded_val.astype(self.dtype, copy=False)
 
-                if isinstance(val, six.string_types):
-                    loaded_val = create_roi(load_nifti(val).get_data(), self.mask)
-                elif isinstance(val, np.ndarray):
-                    loaded_val = create_roi(val, self.mask)
-                elif is_scalar(val):
-                    loaded_val = val
+                    self._static_maps_cache[key] = loaded_val
 
-                return_items[key] = loaded_val
+                return_items[key] = self._static_maps_cache[key]
 
             return return_items
 
@@ -165,9 +229,17 @@ class DMRIProblemData(AbstractProblemData):
         During optimization or sampling the model will be evaluated against the observations using an evaluation
         model. Most of these evaluation models need to have a standard deviation.
 
+        The noise std is loaded or estimated once per mask, the result is cached until the mask is changed.
+
         Returns:
             number of ndarray: either a scalar or a 2d matrix with one value per problem instance.
         """
+        if 'noise_std' not in self._noise_std_cache:
+            self._noise_std_cache['noise_std'] = self._load_noise_std()
+        return self._noise_std_cache['noise_std']
+
+    def _load_noise_std(self):
+        """Load or estimate the noise std, see :attr:`noise_std`."""
         try:
             noise_std = autodetect_noise_std_loader(self._noise_std).get_noise_std(self)
         except NoiseStdEstimationNotPossible:
@@ -180,7 +252,61 @@ class DMRIProblemData(AbstractProblemData):
             return noise_std
         else:
             self._logger.info('Using a voxel wise noise standard deviation.')
-            return create_roi(noise_std, self.mask)
+            noise_std = create_roi(noise_std, self.mask)
+            if self.dtype is not None:
+                noise_std = noise_std.astype(self.dtype, copy=False)
+            return noise_std
+
+    def get_input_fingerprint(self):
+        """Get a fingerprint of the input data, to detect changes in the input between model fits.
+
+        This hashes the protocol, the mask, the gradient deviations and the given noise std (not the estimated one).
+        To keep this fast for large datasets, the DWI volume is hashed on its shape, data type and three sample
+        slices instead of on all its data.
+
+        Returns:
+            str: the fingerprint of the input data, see :func:`get_fingerprint`
+        """
+        def as_fingerprint_item(value):
+            if isinstance(value, six.string_types):
+                return get_file_fingerprint(value)
+            if value is None or is_scalar(value):
+                return value
+            return np.asarray(value)
+
+        protocol = None
+        if self._protocol is not None:
+            protocol = {name: self._protocol.get_column(name) for name in self._protocol.column_names}
+
+        return get_fingerprint(protocol, _get_volume_sample(self.dwi_volume), as_fingerprint_item(self._mask),
+                               as_fingerprint_item(self.gradient_deviations), as_fingerprint_item(self._noise_std))
+
+
+def _get_volume_sample(volume):
+    """Get the items identifying the given volume for use in :func:`get_fingerprint`, without reading all its data.
+
+    This uses the shape and data type of the volume and the slices at one quarter, half and three quarters of the
+    third dimension. Lazy volumes are sampled on their underlying data.
+
+    Args:
+        volume (ndarray, ScaledVolume, VolumeSubset or None): the volume to sample
+
+    Returns:
+        list: the items identifying the volume
+    """
+    if volume is None:
+        return None
+    if isinstance(volume, VolumeSubset):
+        return [_get_volume_sample(volume.volume), volume.volume_indices]
+    if isinstance(volume, ScaledVolume):
+        return [_get_volume_sample(volume.data), volume.slope, volume.inter, volume.dtype.str]
+
+    items = [tuple(volume.shape), np.dtype(volume.dtype).str]
+    if volume.ndim >= 3:
+        items.extend(np.asarray(volume[:, :, int(volume.shape[2] * ind) // 4]) for ind in (1, 2, 3))
+    else:
+        items.append(np.asarray(volume))
+    return items
 
 
 class MockDMRIProblemData(DMRIProblemData):
@@ -200,6 +326,267 @@ class MockDMRIProblemData(DMRIProblemData):
         return self._noise_std
 
 
+class LazyROI(object):
+
+    def __init__(self, volume, brain_mask, volume_indices=None, dtype=None):
+        """A lazy version of the region of interest of a volume, see :func:`create_roi`.
+
+        This behaves like the two dimensional (voxels, protocol) matrix returned by :func:`create_roi`, but only reads
+        the voxels from the volume when they are indexed. For example, ``roi[problems_to_analyze, ...]`` only reads
+        the given voxels. This bounds the memory usage by the number of selected voxels instead of by the size of the
+        region of interest, which is of use for chunked processing and for memory mapped volumes.
+
+        The rows are read from a two dimensional (voxels, protocol) view on the volume using a precomputed flat
+        index of the voxels in the mask, in the memory order of the volume. If such a view is not possible (for
+        non-contiguous volumes) we index the volume with the voxel coordinates instead. Scaling (of a
+        :class:`~mdt.nifti.ScaledVolume`) and conversion to the given data type are only applied to the rows read.
+
+        Args:
+            volume (ndarray, VolumeSubset or ScaledVolume): the three or four dimensional volume,
+                for example a memory map
+            brain_mask (ndarray): the three dimensional mask indicating the voxels in the region of interest
+            volume_indices (ndarray): if given, only use these volumes (columns) of the volume
+            dtype (np.dtype): if given, the data type to convert the rows to, defaults to the type of the volume
+        """
+        if isinstance(volume, VolumeSubset):
+            volume_indices = volume.get_base_indices(volume_indices)
+            volume = volume.volume
+
+        self._scaling = None
+        self.dtype = np.dtype(volume.dtype if dtype is None else dtype)
+        if isinstance(volume, ScaledVolume):
+            self._scaling = ScaledVolume(volume.data, volume.slope, volume.inter, dtype=self.dtype)
+            volume = volume.data
+        elif self.dtype != volume.dtype:
+            self._scaling = ScaledVolume(volume, dtype=self.dtype)
+
+        mask_index = get_mask_index(brain_mask)
+        self._volume = volume
+        self._shape3d = mask_index.shape
+        self._volume_indices = mask_index.flat_indices
+        self._columns = None if volume_indices is None else np.asarray(volume_indices)
+
+        nmr_volumes = volume.shape[3] if len(volume.shape) > 3 else 1
+        self.ndim = 2
+
+        self._voxels = None
+        self._flat_indices = None
+        if volume.flags.c_contiguous or volume.flags.f_contiguous:
+            order = 'C' if volume.flags.c_contiguous else 'F'
+            self._voxels = volume.reshape((-1, nmr_volumes), order=order)
+            self._flat_indices = mask_index.get_flat_indices(order=order)
+
+    @property
+    def shape(self):
+        nmr_volumes = self._volume.shape[3] if len(self._volume.shape) > 3 else 1
+        if self._columns is not None:
+            nmr_volumes = len(self._columns)
+        return len(self._volume_indices), nmr_volumes
+
+    def get_volume_subset(self, volume_indices):
+        """Get a LazyROI with only the given volumes (columns) of this ROI.
+
+        The returned object shares the volume and the voxel index with this object, this does not copy any data.
+
+        Args:
+            volume_indices (ndarray): the indices of the columns of this ROI to keep
+
+        Returns:
+            LazyROI: the ROI with the given subset of columns
+        """
+        subset = LazyROI.__new__(LazyROI)
+        subset.__dict__.update(self.__dict__)
+        if self._columns is None:
+            subset._columns = np.asarray(volume_indices)
+        else:
+            subset._columns = self._columns[volume_indices]
+        return subset
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, item):
+        if not isinstance(item, tuple):
+            item = (item,)
+
+        if self._voxels is not None:
+            flat_indices = self._flat_indices[item[0]]
+            if self._columns is None:
+                values = self._voxels[flat_indices]
+            elif np.ndim(flat_indices):
+                values = self._voxels[np.ix_(flat_indices, self._columns)]
+            else:
+                values = self._voxels[flat_indices, self._columns]
+        else:
+            values = self._volume[np.unravel_index(self._volume_indices[item[0]], self._shape3d)]
+            if len(self._volume.shape) == 3:
+                values = values[..., None]
+            if self._columns is not None:
+                values = values[..., self._columns]
+
+        if self._scaling is not None:
+            values = self._scaling.scale(values)
+
+        if values.ndim == 2:
+            return values[(slice(None),) + item[1:]]
+        return values[item[1:]]
+
+    def __array__(self, dtype=None, copy=None):
+        values = self[:]
+        if dtype is not None:
+            return values.astype(dtype, copy=False)
+        return values
+
+
+class MaskIndex(object):
+
+    def __init__(self, brain_mask):
+        """Index structures of a brain mask, for mapping between the ROI (see :func:`create_roi`) and the volume.
+
+        Please use :func:`get_mask_index` to get a cached instance per mask. The flat indices are computed directly,
+        the other structures on first use.
+
+        Args:
+            brain_mask (ndarray): the three dimensional brain mask
+
+        Attributes:
+            shape (tuple): the three dimensional shape of the mask
+            flat_indices (ndarray): per ROI voxel the flat (C-order) index in the volume
+            nmr_voxels (int): the number of voxels in the ROI
+        """
+        self.shape = tuple(brain_mask.shape[:3])
+        if len(brain_mask.shape) == 3:
+            self.flat_indices = np.flatnonzero(brain_mask)
+        else:
+            self.flat_indices = np.ravel_multi_index(np.nonzero(brain_mask)[:3], self.shape, order='C')
+        self.nmr_voxels = len(self.flat_indices)
+        self._fortran_flat_indices = None
+        self._coordinates = None
+        self._bounding_box = None
+
+    def get_flat_indices(self, order='C'):
+        """Get per ROI voxel the flat index in the volume.
+
+        Args:
+            order (str): the memory order of the volume, 'C' for row-major and 'F' for column-major order
+
+        Returns:
+            ndarray: the flat indices of the voxels in the ROI
+        """
+        if order == 'F':
+            if self._fortran_flat_indices is None:
+                self._fortran_flat_indices = np.ravel_multi_index(np.unravel_index(self.flat_indices, self.shape),
+                                                                  self.shape, order='F')
+            return self._fortran_flat_indices
+        return self.flat_indices
+
+    @property
+    def coordinates(self):
+        """Get per ROI voxel the 3d coordinate in the volume, the same as ``np.argwhere(mask)``.
+
+        Returns:
+            ndarray: a (voxels, 3) matrix with the voxel coordinates
+        """
+        if self._coordinates is None:
+            self._coordinates = np.column_stack(np.unravel_index(self.flat_indices, self.shape))
+        return self._coordinates
+
+    @property
+    def bounding_box(self):
+        """Get the bounding box of the voxels in the mask.
+
+        Returns:
+            tuple: the (start, end) coordinates of the box, with an inclusive start and an exclusive end.
+                This is None for an empty mask.
+        """
+        if self._bounding_box is None and self.nmr_voxels:
+            self._bounding_box = (tuple(int(v) for v in self.coordinates.min(axis=0)),
+                                  tuple(int(v) + 1 for v in self.coordinates.max(axis=0)))
+        return self._bounding_box
+
+
+_mask_indices = {}
+_mask_indices_lock = threading.Lock()
+
+
+def get_mask_index(brain_mask):
+    """Get the cached :class:`MaskIndex` of the given brain mask.
+
+    The index is cached per mask object for as long as the mask exists. Since masks are identified by object, please
+    do not change a mask in place after using it.
+
+    Args:
+        brain_mask (ndarray or str): the three dimensional brain mask or the path to the brain mask
+
+    Returns:
+        MaskIndex: the index structures of the mask
+    """
+    brain_mask = autodetect_brain_mask_loader(brain_mask).get_data()
+    key = id(brain_mask)
+
+    with _mask_indices_lock:
+        if key in _mask_indices and _mask_indices[key][0]() is brain_mask:
+            return _mask_indices[key][1]
+
+    mask_index = MaskIndex(brain_mask)
+    try:
+        reference = weakref.ref(brain_mask, lambda _: _mask_indices.pop(key, None))
+    except TypeError:
+        return mask_index
+
+    with _mask_indices_lock:
+        _mask_indices[key] = (reference, mask_index)
+    return mask_index
+
+
+class VolumeSubset(object):
+
+    def __init__(self, volume, volume_indices):
+        """A lazy selection of some of the volumes of a four dimensional volume.
+
+        This behaves like ``volume[..., volume_indices]``, but without copying the data. Indexing the last axis, like
+        ``subset[..., indices]``, only reads the selected volumes. Other indexing falls back to indexing a copy of
+        the selected volumes. For the region of interest of this volume, :func:`create_roi` uses a :class:`LazyROI`
+        on the underlying volume, which also avoids the copy.
+
+        Args:
+            volume (ndarray or VolumeSubset): the four dimensional volume
+            volume_indices (ndarray): the indices of the volumes to select
+        """
+        if isinstance(volume, VolumeSubset):
+            volume_indices = volume.get_base_indices(volume_indices)
+            volume = volume.volume
+        self.volume = volume
+        self.volume_indices = np.asarray(volume_indices)
+        self.dtype = volume.dtype
+        self.ndim = volume.ndim
+        self.shape = tuple(volume.shape[:3]) + (len(self.volume_indices),)
+
+    def get_base_indices(self, volume_indices=None):
+        """Translate the indices of the volumes in this subset to the indices in the underlying volume.
+
+        Args:
+            volume_indices (ndarray): the indices in this subset, if None we return all the indices of this subset
+
+        Returns:
+            ndarray: the indices in the underlying volume
+        """
+        if volume_indices is None:
+            return self.volume_indices
+        return self.volume_indices[volume_indices]
+
+    def __getitem__(self, item):
+        if isinstance(item, tuple) and len(item) == 2 and item[0] is Ellipsis:
+            return self.volume[..., self.volume_indices[item[1]]]
+        return self.volume[..., self.volume_indices][item]
+
+    def __array__(self, dtype=None, copy=None):
+        values = self.volume[..., self.volume_indices]
+        if dtype is not None:
+            return values.astype(dtype, copy=False)
+        return values
+
+
 class PathJoiner(object):
 
     def __init__(self, *args):
@@ -510,7 +897,7 @@ def get_slice_in_dimension(volume, dimension, index):
     return np.squeeze(array_slice)
 
 
-def create_roi(data, brain_mask):
+def create_roi(data, brain_mask, lazy=False):
     """Create and return masked data of the given brain volume and mask
 
     Args:
@@ -519,6 +906,8 @@ def create_roi(data, brain_mask):
             with a filename of a dataset to use.
         brain_mask (ndarray or str): the mask indicating the region of interest with dimensions: (x, y, z) or the string
             to the brain mask to use
+        lazy (boolean): if True we return a :class:`LazyROI` per volume instead of an ndarray. The voxels are then
+            only read from the volume(s) when indexed. Volumes given as a string are then memory mapped.
 
     Returns:
         ndarray, tuple, dict: If a single ndarray is given we will return the ROI for that array. If
@@ -529,17 +918,24 @@ def create_roi(data, brain_mask):
     brain_mask = autodetect_brain_mask_loader(brain_mask).get_data()
 
     def creator(v):
+        if lazy:
+            return LazyROI(v, brain_mask)
+        if isinstance(v, (VolumeSubset, ScaledVolume)) or \
+                (isinstance(v, np.ndarray) and v.shape[:3] == brain_mask.shape[:3] and 3 <= v.ndim <= 4):
+            return LazyROI(v, brain_mask)[:]
         return_val = v[brain_mask]
         if len(return_val.shape) == 1:
             return_val = np.expand_dims(return_val, axis=1)
         return return_val
 
     if isinstance(data, (dict, collections.MutableMapping)):
-        return DeferredActionDict(lambda _, item: create_roi(item, brain_mask), data, memoize=True)
+        return DeferredActionDict(lambda _, item: create_roi(item, brain_mask, lazy=lazy), data, memoize=True)
     elif isinstance(data, six.string_types):
+        if lazy:
+            return creator(load_nifti_memmap(data, tmp_dir=get_tmp_results_dir())[0])
         return creator(load_nifti(data).get_data())
     elif isinstance(data, (list, tuple, collections.Sequence)):
-        return DeferredActionTuple(lambda _, item: create_roi(item, brain_mask), data, memoize=True)
+        return DeferredActionTuple(lambda _, item: create_roi(item, brain_mask, lazy=lazy), data, memoize=True)
     return creator(data)
 
 
@@ -563,7 +959,7 @@ def restore_volumes(data, brain_mask, with_volume_dim=True):
     brain_mask = autodetect_brain_mask_loader(brain_mask).get_data()
 
     shape3d = brain_mask.shape[:3]
-    indices = np.ravel_multi_index(np.nonzero(brain_mask)[:3], shape3d, order='C')
+    indices = get_mask_index(brain_mask).flat_indices
 
     def restorer(voxel_list):
         s = voxel_list.shape
@@ -856,7 +1252,8 @@ def sort_volumes_per_voxel(input_volumes, sort_matrix):
                 for ind in range(len(input_volumes))]
 
 
-def load_problem_data(volume_info, protocol, mask, static_maps=None, gradient_deviations=None, noise_std=None):
+def load_problem_data(volume_info, protocol, mask, static_maps=None, gradient_deviations=None, noise_std=None,
+                      lazy=False, dtype=None):
     """Load and create the problem data object that can be given to a model
 
     Args:
@@ -872,6 +1269,14 @@ def load_problem_data(volume_info, protocol, mask, static_maps=None, gradient_de
             disable.
         noise_std (number or ndarray): either None for automatic detection,
             or a scalar, or an 3d matrix with one value per voxel.
+        lazy (boolean): if True and the volume is given as a path, we memory map the DWI volume instead of loading
+            it in memory. The observations are then read per chunk of voxels, bounding the memory usage by the chunk
+            size instead of by the volume size. Compressed volumes are decompressed once to a temporary
+            file in the temporary results directory, see :func:`mdt.nifti.load_nifti_memmap`.
+        dtype (np.dtype): the storage data type, typically matching the model precision, float32 for single and
+            float64 for double precision. Floating point data is converted once, volume by volume, while loading.
+            Integer data is kept in its compact type and is scaled and converted lazily, per chunk.
+            If None we keep the data type of the loaded data.
 
     Returns:
         DMRIProblemData: the problem data object containing all the info needed for diffusion MRI model fitting
@@ -879,10 +1284,10 @@ def load_problem_data(volume_info, protocol, mask, static_maps=None, gradient_de
     protocol = autodetect_protocol_loader(protocol).get_protocol()
     mask = autodetect_brain_mask_loader(mask).get_data()
 
-    if isinstance(volume_info, string_types):
-        info = load_nifti(volume_info)
-        signal4d = info.get_data()
-        img_header = info.get_header()
+    if isinstance(volume_info, string_types) and lazy:
+        signal4d, img_header = load_nifti_memmap(volume_info, tmp_dir=get_tmp_results_dir(), dtype=dtype)
+    elif isinstance(volume_info, string_types):
+        signal4d, img_header = load_nifti_data(volume_info, dtype=dtype)
     else:
         signal4d, img_header = volume_info
 
@@ -890,7 +1295,19 @@ def load_problem_data(volume_info, protocol, mask, static_maps=None, gradient_de
         gradient_deviations = load_nifti(gradient_deviations).get_data()
 
     return DMRIProblemData(protocol, signal4d, mask, img_header, static_maps=static_maps, noise_std=noise_std,
-                           gradient_deviations=gradient_deviations)
+                           gradient_deviations=gradient_deviations, dtype=dtype)
+
+
+def get_storage_dtype(double_precision):
+    """Get the storage data type for the problem data matching the precision of the model.
+
+    Args:
+        double_precision (boolean): if the model runs in double precision
+
+    Returns:
+        np.dtype: float64 for double precision, float32 for single precision
+    """
+    return np.float64 if double_precision else np.float32
 
 
 def load_brain_mask(brain_mask_fname):
@@ -935,11 +1352,13 @@ def get_cl_devices():
     return CLEnvironmentFactory.smart_device_selection()
 
 
-def model_output_exists(model, output_folder, append_model_name_to_path=True):
+def model_output_exists(model, output_folder, append_model_name_to_path=True, fingerprint=None):
     """Checks if the output for the given model exists in the given output folder.
 
     This will check for a given model if the output folder exists and contains a nifti file for each parameter
-    of the model.
+    of the model. If the output folder contains an output manifest (see :func:`write_output_manifest`) we use the
+    maps listed in the manifest instead of searching the directory. Output without a manifest is checked by
+    searching for the map files.
 
     When using this to try to skip subjects when batch fitting it might fail if one of the models can not be calculated
     for a given subject. For example Noddi requires two shells. If that is not given we can not calculate it and
@@ -952,6 +1371,9 @@ def model_output_exists(model, output_folder, append_model_name_to_path=True):
         append_model_name_to_path (boolean): by default we will append the name of the model to the output folder.
             This is to be consistent with the way the model fitting routine places the results in the
             <output folder>/<model_name> directories. Sometimes, however you might want to skip this appending.
+        fingerprint (str): if given, the fingerprint of the current input (see :func:`get_model_fit_fingerprint`).
+            If the output has a manifest with a different fingerprint, the output is stale and we return False.
+            This is not used for cascade models.
 
     Returns:
         boolean: true if the output folder exists and contains files for all the parameters of the model.
@@ -972,6 +1394,14 @@ def model_output_exists(model, output_folder, append_model_name_to_path=True):
 
     parameter_names = model.get_optimization_output_param_names()
 
+    manifest = load_output_manifest(output_path)
+    if manifest is not None:
+        if not manifest.get('completed'):
+            return False
+        if fingerprint is not None and manifest.get('fingerprint') != fingerprint:
+            return False
+        return all(parameter_name in manifest.get('maps', {}) for parameter_name in parameter_names)
+
     if not os.path.exists(output_path):
         return False
 
@@ -982,6 +1412,285 @@ def model_output_exists(model, output_folder, append_model_name_to_path=True):
     return True
 
 
+def get_model_fit_fingerprint(model_name, problem_data, optimizer=None, refit_optimizer=None,
+                              refit_return_codes=None, output_maps_selection=None):
+    """Get the fingerprint identifying the input of a model fit, stored in the output manifest.
+
+    This combines the name of the model, the fingerprint of the input data (see
+    :meth:`DMRIProblemData.get_input_fingerprint`), the MDT version and the optimizer settings. If used, the refit
+    settings and the selection of output maps are added as well.
+
+    Args:
+        model_name (str): the name of the fitted model
+        problem_data (DMRIProblemData): the input data of the model fit
+        optimizer (AbstractOptimizer): the optimizer used for the model fit
+        refit_optimizer (AbstractOptimizer): the optimizer used to refit the failed voxels, if any
+        refit_return_codes (list of int): the return codes of the voxels refitted by the refit optimizer
+        output_maps_selection (OutputMapsSelection): the selection of the maps written by the model fit
+
+    Returns:
+        str: the fingerprint of the model fit
+    """
+    items = [model_name, problem_data.get_input_fingerprint(), __version__, get_optimizer_info(optimizer)]
+
+    if refit_optimizer is not None:
+        items.append({'refit_optimizer': get_optimizer_info(refit_optimizer),
+                      'refit_return_codes': sorted(int(code) for code in refit_return_codes or [])})
+
+    if output_maps_selection is not None and not output_maps_selection.selects_all():
+        items.append({'output_maps_include': output_maps_selection.include,
+                      'output_maps_exclude': output_maps_selection.exclude})
+
+    return get_fingerprint(*items)
+
+
+def get_optimizer_info(optimizer):
+    """Get a serializable description of the given optimizer, for use in the output manifest and the fingerprint.
+
+    Meta optimizers are described recursively, with the optimizers of a multi step optimizer under ``optimizers``
+    and the optimizer wrapped by for example a random restart optimizer under ``optimizer``.
+
+    Args:
+        optimizer (AbstractOptimizer): the optimizer, can be None
+
+    Returns:
+        dict: the name, patience and optimizer specific settings of the optimizer, or None if no optimizer is given
+    """
+    if optimizer is None:
+        return None
+
+    settings = getattr(optimizer, 'optimizer_settings', None) or getattr(optimizer, '_optimizer_settings', None) or {}
+    info = {'name': type(optimizer).__name__,
+            'patience': _get_serializable_value(getattr(optimizer, 'patience', None)),
+            'settings': {str(key): _get_serializable_value(value) for key, value in settings.items()}}
+
+    sub_optimizers = getattr(optimizer, 'optimizers', None)
+    if sub_optimizers is not None:
+        info['optimizers'] = [get_optimizer_info(sub_optimizer) for sub_optimizer in sub_optimizers]
+
+    wrapped_optimizer = getattr(optimizer, 'optimizer', None) or getattr(optimizer, '_optimizer', None)
+    if wrapped_optimizer is not None:
+        info['optimizer'] = get_optimizer_info(wrapped_optimizer)
+
+    starting_point_generator = getattr(optimizer, '_starting_point_generator', None)
+    if starting_point_generator is not None:
+        info['starting_point_generator'] = _get_serializable_value(starting_point_generator)
+
+    return info
+
+
+def _get_serializable_value(value):
+    """Get a JSON serializable representation of the given value that does not change between runs.
+
+    Numbers, strings, lists and dictionaries are kept, arrays are replaced by their fingerprint and other objects by
+    their class name and their public attributes. Unlike ``repr()``, this never contains memory addresses.
+
+    Args:
+        value: the value to convert
+
+    Returns:
+        the serializable representation of the value
+    """
+    if value is None or isinstance(value, (bool, float) + six.integer_types + string_types):
+        return value
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return {'ndarray': get_fingerprint(value)}
+    if isinstance(value, dict):
+        return {str(key): _get_serializable_value(el) for key, el in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_get_serializable_value(el) for el in value]
+
+    cls = type(value)
+    name = '{}.{}'.format(cls.__module__, cls.__name__)
+    if not hasattr(value, '__dict__'):
+        return {'class': name}
+    return {'class': name, 'attributes': {key: _get_serializable_value(el) for key, el in vars(value).items()
+                                          if not key.startswith('_') and not callable(el)}}
+
+
+def write_output_manifest(output_path, model_name, fingerprint, optimizer=None):
+    """Write the output manifest of a completed model fit.
+
+    The manifest (``manifest.json`` in the output path) lists the result maps with their shape and data type, the
+    fingerprint of the input and a completion marker. Checking if the output of a model exists then only requires
+    reading this file, see :func:`model_output_exists`. The manifest is written atomically, by writing a temporary
+    file first and then renaming it, such that an interrupted write never leaves an incomplete manifest.
+
+    Args:
+        output_path (str): the directory with the result maps of the model
+        model_name (str): the name of the fitted model
+        fingerprint (str): the fingerprint of the model fit, see :func:`get_model_fit_fingerprint`
+        optimizer (AbstractOptimizer): the optimizer used for the model fit, added for reference
+    """
+    maps = {}
+    for path, map_name, _ in yield_nifti_info(output_path):
+        header = load_nifti(path).header
+        maps[map_name] = {'file': os.path.basename(path),
+                          'shape': [int(el) for el in header.get_data_shape()],
+                          'dtype': str(header.get_data_dtype())}
+
+    manifest = {'model': model_name,
+                'mdt_version': __version__,
+                'fingerprint': fingerprint,
+                'optimizer': get_optimizer_info(optimizer),
+                'maps': maps,
+                'completed': True,
+                'completed_at': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+    manifest_path = os.path.join(output_path, 'manifest.json')
+    tmp_path = '{}.{}.tmp'.format(manifest_path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+
+    if six.PY2:
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+        os.rename(tmp_path, manifest_path)
+    else:
+        os.replace(tmp_path, manifest_path)
+
+
+def load_output_manifest(output_path):
+    """Load the output manifest of a model fit, see :func:`write_output_manifest`.
+
+    Args:
+        output_path (str): the directory with the result maps of the model
+
+    Returns:
+        dict: the content of the manifest, or None if there is no (valid) manifest
+    """
+    try:
+        with open(os.path.join(output_path, 'manifest.json'), 'r') as f:
+            manifest = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if not isinstance(manifest, dict):
+        return None
+    return manifest
+
+
+def remove_output_manifest(output_path):
+    """Remove the output manifest of a model fit, if present.
+
+    This marks the output as incomplete, which we do before (re)calculating the model.
+
+    Args:
+        output_path (str): the directory with the result maps of the model
+    """
+    manifest_path = os.path.join(output_path, 'manifest.json')
+    if os.path.isfile(manifest_path):
+        os.remove(manifest_path)
+
+
+def get_fingerprint(*items):
+    """Get a hash identifying the given items, used to detect changes in the input of a computation.
+
+    Arrays are hashed on their data type, shape and content, dictionaries on their (sorted) keys and values, lists and
+    tuples on their elements and all other items on their string representation.
+
+    Args:
+        *items: the items to hash
+
+    Returns:
+        str: the hexadecimal SHA-1 hash of the items
+    """
+    sha = hashlib.sha1()
+
+    def update(item):
+        if isinstance(item, np.ndarray):
+            sha.update('ndarray:{}:{}:'.format(item.dtype.str, item.shape).encode('utf8'))
+            sha.update(np.ascontiguousarray(item).tobytes())
+        elif isinstance(item, dict):
+            sha.update(b'dict:')
+            for key in sorted(item, key=str):
+                update(key)
+                update(item[key])
+        elif isinstance(item, (list, tuple)):
+            sha.update('list:{}:'.format(len(item)).encode('utf8'))
+            for element in item:
+                update(element)
+        else:
+            sha.update('{}:{!r};'.format(type(item).__name__, item).encode('utf8'))
+
+    update(items)
+    return sha.hexdigest()
+
+
+def get_file_fingerprint(path):
+    """Get the items identifying the current version of a file, for use in :func:`get_fingerprint`.
+
+    This only uses the path, size and modification time of the file, such that it is fast for large files.
+
+    Args:
+        path (str): the path to the file, can be None
+
+    Returns:
+        tuple: the absolute path, size and modification time of the file, or (path, None, None) if the file does
+            not exist.
+    """
+    if path is None or not os.path.isfile(path):
+        return path, None, None
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_size, stat.st_mtime
+
+
+class OutputMapsSelection(object):
+
+    def __init__(self, include=None, exclude=None, required=None):
+        """Selection of the result maps we want to compute and write for a model.
+
+        A map is selected if it matches one of the include regexes (or if there are no include regexes) and does not
+        match any of the exclude regexes. The required maps are always selected. As with the model specific
+        configuration, the regexes are matched using ``re.match``, that is, from the start of the map name.
+
+        Args:
+            include (list of str): regexes of the map names to include, if empty we include all maps
+            exclude (list of str): regexes of the map names to exclude
+            required (list of str): the names of the maps we always select, regardless of the include and exclude
+        """
+        self.include = list(include or [])
+        self.exclude = list(exclude or [])
+        self.required = list(required or [])
+
+    def is_selected(self, map_name):
+        """Check if the given map is selected.
+
+        Args:
+            map_name (str): the name of the map
+
+        Returns:
+            boolean: if we should compute and write the given map
+        """
+        if map_name in self.required:
+            return True
+        if self.include and not any(re.match(regex, map_name) for regex in self.include):
+            return False
+        return not any(re.match(regex, map_name) for regex in self.exclude)
+
+    def select(self, results):
+        """Get the subset of the given results with only the selected maps.
+
+        Args:
+            results (dict): the result maps indexed by map name
+
+        Returns:
+            dict: a new dictionary with only the selected maps
+        """
+        return {map_name: value for map_name, value in results.items() if self.is_selected(map_name)}
+
+    def selects_all(self):
+        """Check if this selection selects every possible map.
+
+        Returns:
+            boolean: true if there are no include and no exclude regexes
+        """
+        return not self.include and not self.exclude
+
+
 def split_image_path(image_path):
     """Split the path to an image into three parts, the directory, the basename and the extension.
 
@@ -1219,8 +1928,7 @@ def roi_index_to_volume_index(roi_indices, brain_mask):
     Returns:
         ndarray: the 3d voxel location(s) of the indicated voxel(s)
     """
-    mask = autodetect_brain_mask_loader(brain_mask).get_data()
-    return np.argwhere(mask)[roi_indices, :]
+    return get_mask_index(brain_mask).coordinates[roi_indices, :]
 
 
 def volume_index_to_roi_index(volume_index, brain_mask):
@@ -1253,7 +1961,7 @@ def create_index_matrix(brain_mask):
             of that voxel in the linear ROI list.
     """
     mask = autodetect_brain_mask_loader(brain_mask).get_data()
-    roi = np.arange(0, np.count_nonzero(mask))
+    roi = np.arange(0, get_mask_index(mask).nmr_voxels)
     return restore_volumes(roi, mask, with_volume_dim=False)
 
 
@@ -0,0 +1,129 @@
+import glob
+import os
+import shutil
+import tempfile
+import unittest
+
+from mdt.batch_utils import DirectoryIndex, BatchJobsDatabase
+
+__author__ = 'Robbert Harms'
+__date__ = "2017-06-21"
+__license__ = "LGPL v3"
+__maintainer__ = "Robbert Harms"
+__email__ = "robbert.harms@maastrichtuniversity.nl"
+
+
+class TestDirectoryIndex(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp()
+        for subject in ('subject_1', 'subject_2', '.hidden'):
+            os.makedirs(os.path.join(self._tmp_dir, subject, 'T1w'))
+            with open(os.path.join(self._tmp_dir, subject, 'data.nii.gz'), 'w'):
+                pass
+        with open(os.path.join(self._tmp_dir, 'subject_3'), 'w'):
+            pass
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def _assert_same_as_glob(self, pattern):
+        pattern = os.path.join(self._tmp_dir, pattern)
+        self.assertEqual(DirectoryIndex().glob(pattern), sorted(glob.glob(pattern)))
+
+    def test_glob_files(self):
+        self._assert_same_as_glob('*/data.nii*')
+        self._assert_same_as_glob('subject_?')
+        self._assert_same_as_glob('subject_1/data.nii.gz')
+        self._assert_same_as_glob('subject_1/missing.nii')
+
+    def test_glob_hidden(self):
+        self._assert_same_as_glob('.*/data.nii.gz')
+
+    def test_glob_directories(self):
+        self._assert_same_as_glob('*/')
+        self._assert_same_as_glob('*/T1w/')
+        self._assert_same_as_glob('subject_1/')
+        self._assert_same_as_glob('subject_3/')
+
+
+class TestBatchJobsDatabase(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp()
+        self._db = BatchJobsDatabase(os.path.join(self._tmp_dir, 'jobs.sqlite'))
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def test_no_database(self):
+        self.assertEqual(self._db.get_jobs(), [])
+
+    def test_add_jobs(self):
+        self._db.add_jobs(['subject_2', 'subject_1'], ['Tensor', 'BallStick_r1'])
+
+        jobs = self._db.get_jobs()
+        self.assertEqual([(job['subject_id'], job['model_name']) for job in jobs],
+                         [('subject_1', 'BallStick_r1'), ('subject_1', 'Tensor'),
+                          ('subject_2', 'BallStick_r1'), ('subject_2', 'Tensor')])
+        self.assertTrue(all(job['state'] == BatchJobsDatabase.PENDING for job in jobs))
+        self.assertTrue(all(job['attempts'] == 0 for job in jobs))
+        self.assertIsNone(self._db.get_job('subject_3', 'Tensor'))
+
+    def test_add_jobs_keeps_existing(self):
+        self._db.add_jobs(['subject_1'], ['Tensor'])
+        self._db.set_running('subject_1', 'Tensor')
+        self._db.set_finished('subject_1', 'Tensor', BatchJobsDatabase.DONE, fingerprint='abc')
+
+        self._db.add_jobs(['subject_1'], ['Tensor'])
+        job = self._db.get_job('subject_1', 'Tensor')
+        self.assertEqual(job['state'], BatchJobsDatabase.DONE)
+        self.assertEqual(job['fingerprint'], 'abc')
+
+    def test_state_transitions(self):
+        self._db.add_jobs(['subject_1'], ['Tensor'])
+
+        self._db.set_running('subject_1', 'Tensor', device='0,1')
+        job = self._db.get_job('subject_1', 'Tensor')
+        self.assertEqual(job['state'], BatchJobsDatabase.RUNNING)
+        self.assertEqual(job['device'], '0,1')
+        self.assertIsNotNone(job['started_at'])
+        self.assertIsNone(job['finished_at'])
+
+        self._db.set_finished('subject_1', 'Tensor', BatchJobsDatabase.FAILED, fingerprint='abc', error='failed')
+        job = self._db.get_job('subject_1', 'Tensor')
+        self.assertEqual(job['state'], BatchJobsDatabase.FAILED)
+        self.assertEqual(job['error'], 'failed')
+        self.assertGreaterEqual(job['runtime'], 0)
+
+        self._db.set_running('subject_1', 'Tensor')
+        job = self._db.get_job('subject_1', 'Tensor')
+        self.assertEqual(job['state'], BatchJobsDatabase.RUNNING)
+        self.assertIsNone(job['error'])
+        self.assertIsNone(job['runtime'])
+
+        self._db.set_finished('subject_1', 'Tensor', BatchJobsDatabase.DONE, fingerprint='abc')
+        job = self._db.get_job('subject_1', 'Tensor')
+        self.assertEqual(job['state'], BatchJobsDatabase.DONE)
+        self.assertEqual(job['fingerprint'], 'abc')
+        self.assertIsNotNone(job['finished_at'])
+
+    def test_attempts(self):
+        self._db.add_jobs(['subject_1'], ['Tensor'])
+        for attempt in range(1, 4):
+            self._db.set_running('subject_1', 'Tensor')
+            self._db.set_finished('subject_1', 'Tensor', BatchJobsDatabase.FAILED, error='failed')
+            self.assertEqual(self._db.get_job('subject_1', 'Tensor')['attempts'], attempt)
+
+    def test_jobs_added_when_run(self):
+        self._db.set_running('subject_1', 'Tensor')
+        self.assertEqual(self._db.get_job('subject_1', 'Tensor')['attempts'], 1)
+
+        self._db.set_finished('subject_2', 'Tensor', BatchJobsDatabase.SKIPPED)
+        job = self._db.get_job('subject_2', 'Tensor')
+        self.assertEqual(job['state'], BatchJobsDatabase.SKIPPED)
+        self.assertEqual(job['attempts'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,287 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from multiprocessing.pool import ThreadPool
+
+import mot.configuration
+import numpy as np
+from six.moves import queue
+
+from mdt import model_fitting
+from mdt.batch_utils import BatchJobsDatabase
+from mdt.model_fitting import _get_refit_improvements, _BatchFitRunner, _get_device_groups, BatchFitting, \
+    _ProblemDataPrefetcher
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+__author__ = 'Robbert Harms'
+__date__ = "2017-06-21"
+__license__ = "LGPL v3"
+__maintainer__ = "Robbert Harms"
+__email__ = "robbert.harms@maastrichtuniversity.nl"
+
+
+class TestRefitImprovements(unittest.TestCase):
+
+    def test_lower_error(self):
+        np.testing.assert_array_equal(_get_refit_improvements([1.0, 1.0, 1.0], [0.5, 1.0, 2.0]),
+                                      [True, False, False])
+
+    def test_nan_refit(self):
+        np.testing.assert_array_equal(_get_refit_improvements([1.0, np.nan, np.inf], [np.nan, np.nan, np.nan]),
+                                      [False, False, False])
+
+    def test_nan_original(self):
+        np.testing.assert_array_equal(_get_refit_improvements([np.nan, np.nan, np.inf], [0.5, np.inf, 0.5]),
+                                      [True, False, True])
+
+
+class _Model(object):
+
+    name = 'Tensor'
+
+    def get_optimization_output_param_names(self):
+        return ['Tensor.d']
+
+
+class _SubjectInfo(object):
+
+    def __init__(self, subject_id, output_dir):
+        self.subject_id = subject_id
+        self.output_dir = output_dir
+
+
+class TestBatchFitJobStatus(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp()
+        self._db = BatchJobsDatabase(os.path.join(self._tmp_dir, 'jobs.sqlite'))
+        self._subject = _SubjectInfo('subject_1', os.path.join(self._tmp_dir, 'output'))
+        self._db.add_jobs(['subject_1'], ['Tensor'])
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def _get_status(self, retry_failed=True, recalculate=False, fingerprint='abc'):
+        runner = _BatchFitRunner([_Model()], recalculate, False, None, False, None,
+                                 jobs_db=self._db, retry_failed=retry_failed)
+        return runner._get_job_status(self._subject, _Model(), fingerprint)
+
+    def _finish(self, state, fingerprint='abc'):
+        self._db.set_running('subject_1', 'Tensor')
+        self._db.set_finished('subject_1', 'Tensor', state, fingerprint=fingerprint)
+
+    def test_pending(self):
+        self.assertEqual(self._get_status(), 'todo')
+
+    def test_pending_with_existing_output(self):
+        os.makedirs(os.path.join(self._subject.output_dir, 'Tensor'))
+        with open(os.path.join(self._subject.output_dir, 'Tensor', 'Tensor.d.nii.gz'), 'w'):
+            pass
+
+        self.assertEqual(self._get_status(), 'done')
+        job = self._db.get_job('subject_1', 'Tensor')
+        self.assertEqual(job['state'], BatchJobsDatabase.DONE)
+        self.assertEqual(job['fingerprint'], 'abc')
+
+    def test_done(self):
+        self._finish(BatchJobsDatabase.DONE)
+        self.assertEqual(self._get_status(), 'done')
+        self.assertEqual(self._get_status(recalculate=True), 'todo')
+
+    def test_skipped(self):
+        self._finish(BatchJobsDatabase.SKIPPED)
+        self.assertEqual(self._get_status(), 'done')
+
+    def test_stale(self):
+        self._finish(BatchJobsDatabase.DONE)
+        self.assertEqual(self._get_status(fingerprint='changed'), 'stale')
+
+    def test_retry_failed(self):
+        self._finish(BatchJobsDatabase.FAILED)
+        self.assertEqual(self._get_status(retry_failed=True), 'todo')
+        self.assertEqual(self._get_status(retry_failed=False), 'done')
+
+    def test_interrupted(self):
+        self._db.set_running('subject_1', 'Tensor')
+        self.assertEqual(self._get_status(retry_failed=False), 'todo')
+
+
+class _CLEnvironment(object):
+
+    def __init__(self, is_gpu):
+        self.is_gpu = is_gpu
+
+
+class _PreferGPU(object):
+
+    def get_used_cl_environments(self, cl_environments):
+        return [env for env in cl_environments if env.is_gpu]
+
+
+class TestDeviceGroups(unittest.TestCase):
+
+    def test_divide_devices(self):
+        self.assertEqual(_get_device_groups([0, 1, 2, 3, 4], 2), [[0, 2, 4], [1, 3]])
+        self.assertEqual(_get_device_groups([3, 1], 2), [[3], [1]])
+
+    def test_share_devices(self):
+        self.assertEqual(_get_device_groups([2], 3), [[2], [2], [2]])
+        self.assertEqual(_get_device_groups([0, 1], 3), [[0], [1], [0]])
+
+    def test_load_balanced_devices(self):
+        devices = [_CLEnvironment(False), _CLEnvironment(True), _CLEnvironment(True), _CLEnvironment(False)]
+        with mock.patch.object(model_fitting, 'get_cl_devices', return_value=devices):
+            with mot.configuration.config_context(
+                    mot.configuration.RuntimeConfigurationAction(load_balancer=_PreferGPU())):
+                self.assertEqual(_get_device_groups(None, 2), [[1], [2]])
+                self.assertEqual(_get_device_groups(None, 1), [[1, 2]])
+
+
+class _ThreadsContext(object):
+    """Replaces the spawn context of the parallel batch fitting, to run the workers in threads of this process."""
+
+    Queue = queue.Queue
+    Pool = ThreadPool
+
+
+class _FailingSubjectInfo(_SubjectInfo):
+
+    def get_input_fingerprint(self):
+        return 'abc'
+
+    def get_problem_data(self, dtype=None):
+        raise ValueError('Loading the data of {} failed.'.format(self.subject_id))
+
+
+class _BatchProfile(object):
+
+    def __init__(self, subjects):
+        self._subjects = subjects
+
+    def set_root_dir(self, root_dir):
+        pass
+
+    def get_subjects(self):
+        return self._subjects
+
+    def get_subjects_count(self):
+        return len(self._subjects)
+
+
+class TestParallelBatchFitting(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def _get_subject(self, subject_id, done):
+        subject = _FailingSubjectInfo(subject_id, os.path.join(self._tmp_dir, subject_id))
+        os.makedirs(os.path.join(subject.output_dir, 'Tensor'))
+        if done:
+            with open(os.path.join(subject.output_dir, 'Tensor', 'Tensor.d.nii.gz'), 'w'):
+                pass
+        return subject
+
+    def _run(self, subjects):
+        batch_fitting = BatchFitting(self._tmp_dir, batch_profile=_BatchProfile(subjects), models_to_fit=[_Model()],
+                                     parallel=2, use_jobs_database=False)
+        with mock.patch.object(model_fitting, '_get_spawn_context', return_value=_ThreadsContext()), \
+                mock.patch.object(model_fitting, 'get_cl_devices', return_value=[_CLEnvironment(True)]), \
+                mot.configuration.config_context(mot.configuration.RuntimeConfigurationAction(
+                    load_balancer=_PreferGPU())):
+            return batch_fitting.run()
+
+    def test_all_subjects_done(self):
+        subjects = [self._get_subject('subject_1', True), self._get_subject('subject_2', True)]
+        self.assertEqual(self._run(subjects), subjects)
+
+    def test_failed_subjects(self):
+        subjects = [self._get_subject('subject_1', False), self._get_subject('subject_2', True),
+                    self._get_subject('subject_3', False)]
+
+        with self.assertRaises(RuntimeError) as context:
+            self._run(subjects)
+        self.assertIn('subject_1, subject_3', str(context.exception))
+        self.assertNotIn('subject_2', str(context.exception))
+
+        with open(os.path.join(self._tmp_dir, 'subject_1', 'batch_fit.log')) as f:
+            self.assertIn('Loading the data of subject_1 failed.', f.read())
+
+
+class _PrefetchedProblemData(object):
+
+    def __init__(self, subject, nmr_bytes):
+        self.subject = subject
+        self.dwi_volume = np.zeros(nmr_bytes, dtype=np.uint8)
+        self.mask = None
+        self.gradient_deviations = None
+
+
+class TestProblemDataPrefetcher(unittest.TestCase):
+
+    def setUp(self):
+        self._loaded = []
+        self._load_events = {}
+
+    def _load(self, subject):
+        self._loaded.append(subject)
+        if subject in self._load_events:
+            self._load_events[subject].set()
+        if subject.startswith('failing'):
+            raise ValueError('Loading {} failed.'.format(subject))
+        if subject.startswith('done'):
+            return None
+        return _PrefetchedProblemData(subject, 1000)
+
+    def test_order(self):
+        subjects = ['subject_1', 'done_2', 'subject_3', 'subject_4']
+        results = list(_ProblemDataPrefetcher(subjects, self._load, 10 ** 6))
+
+        self.assertEqual([subject for subject, _ in results], subjects)
+        self.assertEqual([problem_data.subject if problem_data is not None else None for _, problem_data in results],
+                         ['subject_1', None, 'subject_3', 'subject_4'])
+        self.assertEqual(self._loaded, subjects)
+
+    def test_prefetch_within_memory(self):
+        self._load_events['subject_2'] = threading.Event()
+
+        for subject, _ in _ProblemDataPrefetcher(['subject_1', 'subject_2', 'subject_3'], self._load, 2000):
+            if subject == 'subject_1':
+                self.assertTrue(self._load_events['subject_2'].wait(5))
+                self.assertNotIn('subject_3', self._loaded)
+
+    def test_no_prefetch_above_memory(self):
+        self._load_events['subject_2'] = threading.Event()
+
+        for subject, _ in _ProblemDataPrefetcher(['subject_1', 'subject_2'], self._load, 999):
+            if subject == 'subject_1':
+                self.assertFalse(self._load_events['subject_2'].wait(0.2))
+        self.assertEqual(self._loaded, ['subject_1', 'subject_2'])
+
+    def test_load_error(self):
+        prefetcher = iter(_ProblemDataPrefetcher(['subject_1', 'failing_2', 'subject_3'], self._load, 10 ** 6))
+
+        self.assertEqual(next(prefetcher)[0], 'subject_1')
+        with self.assertRaises(ValueError):
+            next(prefetcher)
+        self.assertNotIn('subject_3', self._loaded)
+
+    def test_stop_early(self):
+        self._load_events['subject_2'] = threading.Event()
+
+        for _ in _ProblemDataPrefetcher(['subject_1', 'subject_2', 'subject_3'], self._load, 10 ** 6):
+            self.assertTrue(self._load_events['subject_2'].wait(5))
+            break
+        self.assertNotIn('subject_3', self._loaded)
+
+
+if __name__ == '__main__':
+    unittest.main()
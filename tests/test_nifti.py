@@ -0,0 +1,233 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import nibabel as nib
+import numpy as np
+
+import mdt.nifti
+from mdt.nifti import create_nifti_memmap, convert_nifti_dtype, load_nifti_data, get_all_image_data
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+__author__ = 'Robbert Harms'
+__date__ = "2017-06-21"
+__license__ = "LGPL v3"
+__maintainer__ = "Robbert Harms"
+__email__ = "robbert.harms@maastrichtuniversity.nl"
+
+
+class TestNiftiMemmap(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp()
+        self._header = nib.Nifti1Header()
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def _create(self, data):
+        path = os.path.join(self._tmp_dir, 'map.nii')
+        memmap = create_nifti_memmap(path, self._header, data.shape, data.dtype)
+        memmap[:] = data
+        memmap.flush()
+        del memmap
+        return path
+
+    def _add_header_extension(self):
+        self._header.extensions.append(nib.nifti1.Nifti1Extension('comment', b'an extension of the input header'))
+
+    def test_write(self):
+        data = np.arange(24, dtype=np.float32).reshape((2, 3, 4))
+        path = self._create(data)
+
+        nifti = nib.load(path)
+        self.assertEqual(nifti.header.get_data_dtype(), np.float32)
+        np.testing.assert_array_equal(np.asarray(nifti.dataobj), data)
+
+    def test_write_bool(self):
+        data = np.array([True, False, True, True], dtype=np.bool_).reshape((1, 2, 2))
+        path = self._create(data)
+
+        nifti = nib.load(path)
+        self.assertEqual(nifti.header.get_data_dtype(), np.uint8)
+        np.testing.assert_array_equal(np.asarray(nifti.dataobj), data)
+
+    def test_convert(self):
+        data = np.arange(24, dtype=np.float32).reshape((2, 3, 4))
+        path = self._create(data)
+        output_path = convert_nifti_dtype(path, os.path.join(self._tmp_dir, 'map_int.nii.gz'), np.int16)
+
+        nifti = nib.load(output_path)
+        self.assertEqual(nifti.header.get_data_dtype(), np.int16)
+        np.testing.assert_allclose(np.asarray(nifti.dataobj), data, atol=1e-3)
+
+    def test_header_with_extensions(self):
+        self._add_header_extension()
+        data = np.arange(24, dtype=np.float32).reshape((2, 3, 4))
+        path = self._create(data)
+
+        nifti = nib.load(path)
+        self.assertEqual(len(nifti.header.extensions), 0)
+        np.testing.assert_array_equal(np.asarray(nifti.dataobj), data)
+
+    def test_convert_header_with_extensions(self):
+        self._add_header_extension()
+        data = np.arange(24, dtype=np.float32).reshape((2, 3, 4))
+        path = self._create(data)
+        output_path = convert_nifti_dtype(path, os.path.join(self._tmp_dir, 'map_int.nii.gz'), np.int16)
+
+        nifti = nib.load(output_path)
+        self.assertEqual(nifti.header.get_data_dtype(), np.int16)
+        np.testing.assert_allclose(np.asarray(nifti.dataobj), data, atol=1e-3)
+
+    def test_convert_non_finite_to_zero(self):
+        data = np.array([-10, np.nan, 0, np.inf, 10, -np.inf], dtype=np.float32).reshape((1, 2, 3))
+        path = self._create(data)
+        output_path = convert_nifti_dtype(path, os.path.join(self._tmp_dir, 'map_int.nii'), np.int16)
+
+        values = np.asarray(nib.load(output_path).dataobj).ravel()
+        np.testing.assert_allclose(values, [-10, 0, 0, 0, 10, 0], atol=1e-3)
+
+
+class TestLoadNiftiData(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def _write(self, data, file_name, slope=None, inter=None):
+        path = os.path.join(self._tmp_dir, file_name)
+        nifti = nib.Nifti1Image(data, np.eye(4))
+        if slope is not None:
+            nifti.header.set_slope_inter(slope, inter)
+        nib.save(nifti, path)
+        return path
+
+    def _assert_same_as_nibabel(self, path, dtype):
+        data, header = load_nifti_data(path, dtype=dtype)
+        self.assertEqual(data.dtype, dtype)
+        self.assertEqual(header.get_data_shape(), data.shape)
+        np.testing.assert_allclose(data, np.asarray(nib.load(path).dataobj).astype(dtype), rtol=1e-6)
+
+    def test_compressed_4d(self):
+        data = np.random.RandomState(0).rand(4, 5, 3, 6).astype(np.float32)
+        self._assert_same_as_nibabel(self._write(data, 'data.nii.gz'), np.float64)
+
+    def test_uncompressed_4d(self):
+        data = np.random.RandomState(0).rand(4, 5, 3, 6)
+        self._assert_same_as_nibabel(self._write(data, 'data.nii'), np.float32)
+
+    def test_compressed_3d(self):
+        data = np.random.RandomState(0).rand(4, 5, 3).astype(np.float32)
+        self._assert_same_as_nibabel(self._write(data, 'data.nii.gz'), np.float64)
+
+    def test_scaled(self):
+        data = np.random.RandomState(0).rand(4, 5, 3, 6).astype(np.float32)
+        self._assert_same_as_nibabel(self._write(data, 'data.nii.gz', slope=2.5, inter=-1), np.float64)
+
+
+class TestGetAllImageData(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp()
+        self._data = {}
+        for ind, map_name in enumerate(['a', 'b', 'c']):
+            self._data[map_name] = np.full((2, 3, 4), ind, dtype=np.float32)
+            nib.save(nib.Nifti1Image(self._data[map_name], np.eye(4)),
+                     os.path.join(self._tmp_dir, map_name + '.nii.gz'))
+
+        self._loaded = []
+        self._load_events = {map_name: threading.Event() for map_name in self._data}
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def _load_image_data(self, path):
+        map_name = os.path.basename(path)[:-len('.nii.gz')]
+        self._loaded.append(map_name)
+        data = nib.load(path).get_data()
+        self._load_events[map_name].set()
+        return data
+
+    def _assert_data(self, volumes):
+        self.assertEqual(sorted(volumes.keys()), sorted(self._data.keys()))
+        for map_name, data in self._data.items():
+            np.testing.assert_array_equal(volumes[map_name], data)
+
+    def test_not_deferred(self):
+        with mock.patch('mdt.nifti._load_image_data', side_effect=self._load_image_data):
+            volumes = get_all_image_data(self._tmp_dir, deferred=False)
+
+        self.assertIsInstance(volumes, dict)
+        self._assert_data(volumes)
+        self.assertEqual(sorted(self._loaded), ['a', 'b', 'c'])
+
+    def test_prefetch(self):
+        with mock.patch('mdt.nifti._load_image_data', side_effect=self._load_image_data):
+            volumes = get_all_image_data(self._tmp_dir, prefetch=['b', 'missing'])
+
+            self.assertTrue(self._load_events['b'].wait(5))
+            self.assertEqual(self._loaded, ['b'])
+            np.testing.assert_array_equal(volumes['c'], self._data['c'])
+            self.assertEqual(self._loaded, ['b', 'c'])
+            np.testing.assert_array_equal(volumes['b'], self._data['b'])
+            self.assertEqual(self._loaded, ['b', 'c'])
+
+    def test_no_prefetch(self):
+        with mock.patch('mdt.nifti._load_image_data', side_effect=self._load_image_data):
+            volumes = get_all_image_data(self._tmp_dir)
+            self.assertFalse(self._load_events['a'].wait(0.1))
+            self._assert_data(volumes)
+
+    def test_map_names_read_in_background(self):
+        with mock.patch('mdt.nifti._load_image_data', side_effect=self._load_image_data):
+            volumes = get_all_image_data(self._tmp_dir, map_names=['a', 'c'], prefetch=['b'])
+
+            self.assertTrue(self._load_events['a'].wait(5))
+            self.assertTrue(self._load_events['c'].wait(5))
+            self.assertEqual(sorted(volumes.keys()), ['a', 'c'])
+            np.testing.assert_array_equal(volumes['c'], self._data['c'])
+            self.assertEqual(sorted(self._loaded), ['a', 'c'])
+
+    def test_prefetch_error(self):
+        with open(os.path.join(self._tmp_dir, 'b.nii.gz'), 'wb') as f:
+            f.write(b'not a nifti')
+
+        volumes = get_all_image_data(self._tmp_dir, prefetch=['a', 'b'])
+        np.testing.assert_array_equal(volumes['a'], self._data['a'])
+        with self.assertRaises(Exception):
+            volumes['b']
+
+    def test_pool_joined(self):
+        pools = []
+
+        class _ThreadPool(mdt.nifti.ThreadPool):
+            def __init__(self, *args, **kwargs):
+                super(_ThreadPool, self).__init__(*args, **kwargs)
+                self.joined = threading.Event()
+                pools.append(self)
+
+            def join(self):
+                super(_ThreadPool, self).join()
+                self.joined.set()
+
+        with mock.patch('mdt.nifti.ThreadPool', _ThreadPool):
+            self._assert_data(get_all_image_data(self._tmp_dir, deferred=False))
+            volumes = get_all_image_data(self._tmp_dir, prefetch=['a'])
+
+        self.assertEqual(len(pools), 2)
+        for pool in pools:
+            self.assertTrue(pool.joined.wait(5))
+        self._assert_data(volumes)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,770 @@
+import json
+import math
+import multiprocessing
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import mot.configuration
+import nibabel as nib
+import numpy as np
+
+from mdt.nifti import create_nifti_memmap
+from mdt.processing_strategies import ModelProcessingWorker, ShardsCoordinator, InterProcessLock, ResultsWriter, \
+    QueuedChunksProcessingStrategy, ChunksManifest, estimate_voxel_memory, get_device_memory, \
+    get_memory_limited_nmr_voxels, ThroughputTuner, ChunkSizeTuningCache, yield_voxel_ranges, \
+    _combine_volumes_write_out, _get_output_dtype
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+__author__ = 'Robbert Harms'
+__date__ = "2017-06-20"
+__license__ = "LGPL v3"
+__maintainer__ = "Robbert Harms"
+__email__ = "robbert.harms@maastrichtuniversity.nl"
+
+
+class _Model(object):
+
+    def __init__(self, problems_to_analyze=None):
+        self.problems_to_analyze = problems_to_analyze
+
+
+class _ProblemData(object):
+
+    def __init__(self, mask):
+        self.mask = mask
+
+
+class TestVoxelsToCompute(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp()
+        self._mask = np.ones((4, 4, 4), dtype=np.bool_)
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def _get_voxels_to_compute(self, problems_to_analyze, honor_voxels_to_analyze=True):
+        worker = ModelProcessingWorker(_Model(problems_to_analyze), _ProblemData(self._mask), self._tmp_dir,
+                                       self._tmp_dir, honor_voxels_to_analyze)
+        return worker.get_voxels_to_compute()
+
+    def test_all_voxels(self):
+        np.testing.assert_array_equal(self._get_voxels_to_compute(None), np.arange(64))
+
+    def test_not_honoring_voxels_to_analyze(self):
+        np.testing.assert_array_equal(self._get_voxels_to_compute(np.array([3, 5]), False), np.arange(64))
+
+    def test_refit_no_voxels(self):
+        self.assertEqual(len(self._get_voxels_to_compute(np.array([], dtype=np.int64))), 0)
+
+    def test_refit_first_voxel(self):
+        np.testing.assert_array_equal(self._get_voxels_to_compute(np.array([0])), [0])
+
+    def test_refit_single_voxel(self):
+        np.testing.assert_array_equal(self._get_voxels_to_compute(np.array([7])), [7])
+
+    def test_refit_multiple_voxels(self):
+        np.testing.assert_array_equal(self._get_voxels_to_compute(np.array([0, 5, 63])), [0, 5, 63])
+
+    def test_refit_list_of_voxels(self):
+        np.testing.assert_array_equal(self._get_voxels_to_compute([2, 4]), [2, 4])
+
+    def test_done_chunks_are_excluded(self):
+        worker = ModelProcessingWorker(_Model(np.array([0, 5, 63])), _ProblemData(self._mask), self._tmp_dir,
+                                       self._tmp_dir, True)
+        worker._chunks_manifest.add(np.array([5]))
+        np.testing.assert_array_equal(worker.get_voxels_to_compute(), [0, 63])
+
+
+class TestVoxelRanges(unittest.TestCase):
+
+    def _get_ranges(self, roi_indices, nmr_voxels):
+        return [list(chunk) for chunk in yield_voxel_ranges(np.asarray(roi_indices), nmr_voxels)]
+
+    def test_remainder(self):
+        self.assertEqual(self._get_ranges(range(7), 3), [[0, 1, 2], [3, 4, 5], [6]])
+
+    def test_exact(self):
+        self.assertEqual(self._get_ranges([5, 8, 9, 20], 2), [[5, 8], [9, 20]])
+
+    def test_larger_than_total(self):
+        self.assertEqual(self._get_ranges(range(3), 10), [[0, 1, 2]])
+
+    def test_empty(self):
+        self.assertEqual(self._get_ranges([], 10), [])
+
+
+class TestCombineVolumesWriteOut(unittest.TestCase):
+
+    dtypes = {'parameters': 'float32', 'vectors': 'float32', 'return_codes': 'int8', 'indices': None}
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp()
+        self._chunks_dir = os.path.join(self._tmp_dir, 'chunks')
+        self._output_dir = os.path.join(self._tmp_dir, 'output')
+        os.makedirs(self._chunks_dir)
+        os.makedirs(self._output_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def _write_out(self, map_name, data, write_gzipped=False):
+        memmap = create_nifti_memmap(os.path.join(self._chunks_dir, map_name + '.nii'), nib.Nifti1Header(),
+                                     data.shape, data.dtype)
+        memmap[:] = data
+        memmap.flush()
+        del memmap
+
+        with mock.patch('mdt.processing_strategies.get_output_dtype', side_effect=self.dtypes.get), \
+                mock.patch('mdt.processing_strategies.open_nifti_memmap', side_effect=AssertionError):
+            _combine_volumes_write_out((map_name, [self._chunks_dir, self._output_dir, write_gzipped, False, 1,
+                                                   'UsedMask']))
+
+        output_path = os.path.join(self._output_dir, map_name + ('.nii.gz' if write_gzipped else '.nii'))
+        self.assertFalse(os.path.exists(os.path.join(self._chunks_dir, map_name + '.nii')))
+        return nib.load(output_path)
+
+    def test_get_output_dtype(self):
+        with mock.patch('mdt.processing_strategies.get_output_dtype', side_effect=self.dtypes.get):
+            self.assertEqual(_get_output_dtype('Tensor.d', np.dtype(np.float64), (2, 3, 4)), np.float32)
+            self.assertEqual(_get_output_dtype('Tensor.vec0', np.dtype(np.float64), (2, 3, 4, 3)), np.float32)
+            self.assertIsNone(_get_output_dtype('Tensor.d', np.dtype(np.float32), (2, 3, 4, 1)))
+            self.assertEqual(_get_output_dtype('ReturnCodes', np.dtype(np.int32), (2, 3, 4)), np.int8)
+            self.assertIsNone(_get_output_dtype('Ranking', np.dtype(np.int32), (2, 3, 4)))
+
+    def test_converted(self):
+        data = np.arange(24, dtype=np.float64).reshape((2, 3, 4))
+        nifti = self._write_out('Tensor.d', data, write_gzipped=True)
+
+        self.assertEqual(nifti.header.get_data_dtype(), np.float32)
+        np.testing.assert_allclose(np.asarray(nifti.dataobj), data)
+
+    def test_kept_as_is(self):
+        data = np.arange(24, dtype=np.int32).reshape((2, 3, 4))
+        nifti = self._write_out('Ranking', data)
+
+        self.assertEqual(nifti.header.get_data_dtype(), np.int32)
+        np.testing.assert_array_equal(np.asarray(nifti.dataobj), data)
+
+
+class _RecordingLock(object):
+
+    def __init__(self):
+        self.held = False
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self._lock.acquire()
+        self.held = True
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.held = False
+        self._lock.release()
+
+
+class TestPerformanceLog(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp()
+        self._worker = ModelProcessingWorker(_Model(), _ProblemData(np.ones((4, 4, 4), dtype=np.bool_)),
+                                             self._tmp_dir, self._tmp_dir, False)
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def _read_log(self):
+        with open(os.path.join(self._tmp_dir, 'performance.jsonl'), 'r') as f:
+            return [json.loads(line) for line in f]
+
+    def test_appends_under_write_lock(self):
+        lock = _RecordingLock()
+        self._worker.set_write_lock(lock)
+
+        original_open = open
+        lock_states = []
+
+        def recording_open(*args, **kwargs):
+            lock_states.append(lock.held)
+            return original_open(*args, **kwargs)
+
+        with mock.patch('mdt.processing_strategies.open', side_effect=recording_open, create=True):
+            self._worker._record_chunk_stats({'nmr_voxels': 10, 'process_time': 1.0, 'write_time': 1.0})
+
+        self.assertEqual(lock_states, [True])
+        self.assertEqual(self._read_log()[0]['voxels_per_second'], 5)
+
+    def test_concurrent_appends(self):
+        def record(ind):
+            for _ in range(20):
+                self._worker._record_chunk_stats({'nmr_voxels': ind, 'process_time': 1.0, 'write_time': 0.0})
+
+        threads = [threading.Thread(target=record, args=(ind,)) for ind in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(chunk['nmr_voxels'] for chunk in self._read_log()),
+                         sorted(list(range(8)) * 20))
+
+
+class TestChunksManifest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp()
+        self._manifest_path = os.path.join(self._tmp_dir, 'chunks_manifest.jsonl')
+        self._mask = np.ones((4, 4, 4), dtype=np.bool_)
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def _touch(self, *path):
+        path = os.path.join(self._tmp_dir, *path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w'):
+            pass
+        return path
+
+    def test_no_manifest(self):
+        self.assertEqual(len(ChunksManifest(self._manifest_path, self._mask).get_done_roi_indices()), 0)
+
+    def test_resume_after_partial_write(self):
+        manifest = ChunksManifest(self._manifest_path, self._mask)
+        manifest.add(np.arange(0, 8))
+        manifest.add(np.array([10, 11, 20]))
+        self._touch('Tensor.d.nii')
+
+        resumed = ChunksManifest(self._manifest_path, self._mask)
+        np.testing.assert_array_equal(resumed.get_done_roi_indices(), [0, 1, 2, 3, 4, 5, 6, 7, 10, 11, 20])
+        self.assertTrue(os.path.isfile(os.path.join(self._tmp_dir, 'Tensor.d.nii')))
+
+        resumed.add(np.arange(30, 32))
+        np.testing.assert_array_equal(ChunksManifest(self._manifest_path, self._mask).get_done_roi_indices(),
+                                      [0, 1, 2, 3, 4, 5, 6, 7, 10, 11, 20, 30, 31])
+
+    def test_truncated_last_line(self):
+        manifest = ChunksManifest(self._manifest_path, self._mask)
+        manifest.add(np.arange(0, 4))
+        with open(self._manifest_path, 'a') as f:
+            f.write('{"roi_ranges": [[4, ')
+
+        np.testing.assert_array_equal(manifest.get_done_roi_indices(), [0, 1, 2, 3])
+
+        manifest.add(np.arange(8, 10))
+        np.testing.assert_array_equal(ChunksManifest(self._manifest_path, self._mask).get_done_roi_indices(),
+                                      [0, 1, 2, 3, 8, 9])
+
+    def test_mask_change(self):
+        ChunksManifest(self._manifest_path, self._mask).add(np.arange(0, 8))
+        self._touch('Tensor.d.nii')
+        self._touch('UsedMask.nii')
+        self._touch('volume_maps', 'Tensor.vec0.nii')
+
+        mask = np.copy(self._mask)
+        mask[0, 0, 0] = False
+        manifest = ChunksManifest(self._manifest_path, mask)
+        self.assertEqual(len(manifest.get_done_roi_indices()), 0)
+        self.assertEqual(os.listdir(self._tmp_dir), [])
+
+        manifest.add(np.arange(0, 2))
+        np.testing.assert_array_equal(ChunksManifest(self._manifest_path, mask).get_done_roi_indices(), [0, 1])
+
+    def test_mask_change_keeps_protected_paths(self):
+        ChunksManifest(self._manifest_path, self._mask).add(np.arange(0, 8))
+        self._touch('UsedMask.nii')
+        shards_path = self._touch('shards.sqlite')
+
+        mask = np.copy(self._mask)
+        mask[0, 0, 0] = False
+        worker = ModelProcessingWorker(_Model(), _ProblemData(mask), self._tmp_dir, self._tmp_dir, True)
+        worker.set_protected_paths([shards_path])
+
+        self.assertEqual(len(worker.get_voxels_to_compute()), 63)
+        self.assertEqual(os.listdir(self._tmp_dir), ['shards.sqlite'])
+
+
+class TestShardsCoordinator(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp()
+        self._db_path = os.path.join(self._tmp_dir, 'shards.sqlite')
+        self._nmr_clears = 0
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def _clear(self):
+        self._nmr_clears += 1
+
+    def _get_coordinator(self, pid=None):
+        """Get a coordinator, with a pid given it acts as the coordinator of that process."""
+        coordinator = ShardsCoordinator(self._db_path)
+        if pid is not None:
+            coordinator._owner = '{}:{}'.format(socket.gethostname(), pid)
+        coordinator.start(False, self._clear)
+        coordinator.add_shards(lambda: [np.arange(0, 5), np.arange(5, 8)])
+        return coordinator
+
+    def test_claim_exhaustion(self):
+        coordinator = self._get_coordinator()
+
+        first_id, first_indices = coordinator.claim()
+        second_id, second_indices = coordinator.claim()
+        self.assertNotEqual(first_id, second_id)
+        np.testing.assert_array_equal(np.concatenate([first_indices, second_indices]), np.arange(8))
+
+        self.assertIsNone(coordinator.claim())
+        self.assertEqual(coordinator.get_nmr_voxels_done(), 8)
+        np.testing.assert_array_equal(coordinator.get_all_roi_indices(), np.arange(8))
+
+    def test_shards_are_added_once(self):
+        self._get_coordinator()
+        coordinator = ShardsCoordinator(self._db_path)
+        coordinator.start(False, self._clear)
+        coordinator.add_shards(lambda: [np.arange(0, 20)])
+        np.testing.assert_array_equal(coordinator.get_all_roi_indices(), np.arange(8))
+
+    def test_combine_handoff(self):
+        coordinator = self._get_coordinator()
+        other = self._get_coordinator(pid=os.getppid())
+
+        first_id, _ = coordinator.claim()
+        second_id, _ = other.claim()
+        self.assertIsNone(coordinator.claim())
+
+        coordinator.mark_done(first_id)
+        self.assertEqual(coordinator.get_combine_status(), ShardsCoordinator.WAIT)
+
+        other.mark_done(second_id)
+        self.assertEqual(coordinator.get_combine_status(), ShardsCoordinator.COMBINE)
+        self.assertEqual(other.get_combine_status(), ShardsCoordinator.WAIT)
+
+        coordinator.set_combined()
+        self.assertEqual(other.get_combine_status(), ShardsCoordinator.COMBINED)
+
+    def test_stale_claim_is_reclaimed(self):
+        process = subprocess.Popen([sys.executable, '-c', ''])
+        process.wait()
+
+        stopped = self._get_coordinator(pid=process.pid)
+        shard_id, _ = stopped.claim()
+
+        coordinator = self._get_coordinator()
+        self.assertEqual(coordinator.claim()[0], shard_id)
+
+    def test_restart_after_combined(self):
+        coordinator = self._get_coordinator()
+        for _ in range(2):
+            coordinator.mark_done(coordinator.claim()[0])
+        self.assertEqual(coordinator.get_combine_status(), ShardsCoordinator.COMBINE)
+        coordinator.set_combined()
+
+        self._get_coordinator()
+        self.assertEqual(self._nmr_clears, 1)
+        self.assertEqual(coordinator.get_nmr_voxels_done(), 0)
+
+
+def _increment_counter(lock_path, counter_path, nmr_increments):
+    lock = InterProcessLock(lock_path)
+    for _ in range(nmr_increments):
+        with lock:
+            with open(counter_path, 'r') as f:
+                value = int(f.read())
+            with open(counter_path, 'w') as f:
+                f.write(str(value + 1))
+
+
+class TestInterProcessLock(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def test_mutual_exclusion(self):
+        lock_path = os.path.join(self._tmp_dir, 'lock.sqlite')
+        counter_path = os.path.join(self._tmp_dir, 'counter')
+        with open(counter_path, 'w') as f:
+            f.write('0')
+
+        processes = [multiprocessing.Process(target=_increment_counter, args=(lock_path, counter_path, 25))
+                     for _ in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+        with open(counter_path, 'r') as f:
+            self.assertEqual(int(f.read()), 100)
+
+
+class TestResultsWriter(unittest.TestCase):
+
+    def _slow_append(self, results, value):
+        time.sleep(0.01)
+        results.append(value)
+
+    @staticmethod
+    def _fail(message, event=None):
+        if event is not None:
+            event.wait()
+        raise ValueError(message)
+
+    def test_jobs_in_order(self):
+        writer = ResultsWriter(max_queue_size=2)
+        results = []
+        for ind in range(10):
+            writer.submit(self._slow_append, results, ind)
+        writer.flush()
+        self.assertEqual(results, list(range(10)))
+        writer.close()
+
+    def test_writes_in_background(self):
+        writer = ResultsWriter()
+        thread_names = []
+        writer.submit(lambda: thread_names.append(threading.current_thread().name))
+        writer.flush()
+        self.assertNotEqual(thread_names[0], threading.current_thread().name)
+        writer.close()
+
+    def test_close_finishes_pending_jobs(self):
+        writer = ResultsWriter(max_queue_size=5)
+        results = []
+        for ind in range(5):
+            writer.submit(self._slow_append, results, ind)
+        writer.close()
+        self.assertEqual(results, list(range(5)))
+
+    def test_close_without_jobs(self):
+        ResultsWriter().close()
+
+    def test_error_raised_on_flush(self):
+        writer = ResultsWriter()
+        writer.submit(self._fail, 'write failed')
+        with self.assertRaises(ValueError):
+            writer.flush()
+        writer.close()
+
+    def test_error_raised_on_submit(self):
+        writer = ResultsWriter()
+        writer.submit(self._fail, 'write failed')
+        with self.assertRaises(ValueError):
+            writer.flush()
+        with self.assertRaises(ValueError):
+            writer.submit(lambda: None)
+        writer.close()
+
+    def test_jobs_after_error_are_skipped(self):
+        writer = ResultsWriter(max_queue_size=5)
+        results = []
+        event = threading.Event()
+        writer.submit(self._fail, 'write failed', event)
+        writer.submit(self._slow_append, results, 1)
+        event.set()
+        with self.assertRaises(ValueError):
+            writer.flush()
+        self.assertEqual(results, [])
+        writer.close()
+
+    def test_concurrent_submit(self):
+        writer = ResultsWriter(max_queue_size=5)
+        results = []
+        barrier = threading.Event()
+
+        def submit_jobs(name):
+            barrier.wait()
+            for ind in range(20):
+                writer.submit(lambda *args: results.append(args + (threading.current_thread().name,)), name, ind)
+
+        threads = [threading.Thread(target=submit_jobs, args=(name,)) for name in 'abcd']
+        for thread in threads:
+            thread.start()
+        barrier.set()
+        for thread in threads:
+            thread.join()
+        writer.close()
+
+        self.assertEqual(len(set(result[2] for result in results)), 1)
+        for name in 'abcd':
+            self.assertEqual([result[1] for result in results if result[0] == name], list(range(20)))
+
+
+class _CLEnvironment(object):
+
+    def __init__(self, name, is_gpu):
+        self.name = name
+        self.is_gpu = is_gpu
+
+    def __str__(self):
+        return self.name
+
+
+class _PreferGPU(object):
+
+    def get_used_cl_environments(self, cl_environments):
+        return [env for env in cl_environments if env.is_gpu]
+
+
+class _DeviceWorker(ModelProcessingWorker):
+
+    def __init__(self, processed, *args):
+        super(_DeviceWorker, self).__init__(*args)
+        self._processed = processed
+        self._device = None
+
+    def _set_cl_environments(self, cl_environments):
+        self._device = str(cl_environments[0])
+
+    def process(self, roi_indices):
+        chunk = list(self._model.problems_to_analyze)
+        time.sleep(0.01)
+        self._chunk_timings['process'] = len(chunk)
+        self._write_results(self._processed.append, (self._device, chunk, self.chunk_timings['process']))
+        self._write_results(self._mark_chunk_done, roi_indices)
+
+
+class _DeviceWorkerGenerator(object):
+
+    def __init__(self):
+        self.processed = []
+
+    def create_worker(self, model, problem_data, output_dir, tmp_storage_dir, honor_voxels_to_analyze):
+        return _DeviceWorker(self.processed, model, problem_data, output_dir, tmp_storage_dir,
+                             honor_voxels_to_analyze)
+
+
+class _QueuedVoxelRange(QueuedChunksProcessingStrategy):
+
+    def _chunks_generator(self, model, problem_data, output_path, worker, total_roi_indices):
+        for ind_start in range(0, len(total_roi_indices), 4):
+            yield total_roi_indices[ind_start:ind_start + 4]
+
+
+class TestQueuedChunksProcessingStrategy(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp()
+        self._environments = [_CLEnvironment('gpu_0', True), _CLEnvironment('gpu_1', True),
+                              _CLEnvironment('cpu', False)]
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def _run(self, **kwargs):
+        model = _Model()
+        worker_generator = _DeviceWorkerGenerator()
+        _QueuedVoxelRange(**kwargs).run(model, _ProblemData(np.ones((4, 4, 4), dtype=np.bool_)),
+                                        self._tmp_dir, False, worker_generator)
+        self.assertIsNone(model.problems_to_analyze)
+        return worker_generator.processed
+
+    def test_all_chunks_processed_once(self):
+        processed = self._run(cl_environments=self._environments[:2])
+
+        self.assertEqual(sorted(ind for _, chunk, _ in processed for ind in chunk), list(range(64)))
+        self.assertEqual(set(device for device, _, _ in processed), {'gpu_0', 'gpu_1'})
+        self.assertTrue(all(timing == len(chunk) for _, chunk, timing in processed))
+
+    def test_uses_load_balancer(self):
+        with mot.configuration.config_context(mot.configuration.RuntimeConfigurationAction(
+                cl_environments=self._environments, load_balancer=_PreferGPU())):
+            processed = self._run()
+
+        self.assertEqual(set(device for device, _, _ in processed), {'gpu_0', 'gpu_1'})
+
+    def test_synchronous_writing(self):
+        processed = self._run(cl_environments=self._environments, write_queue_size=0)
+        self.assertEqual(sorted(ind for _, chunk, _ in processed for ind in chunk), list(range(64)))
+
+
+class _Device(object):
+
+    def __init__(self, global_mem_size, max_mem_alloc_size):
+        self.global_mem_size = global_mem_size
+        self.max_mem_alloc_size = max_mem_alloc_size
+
+
+class _DeviceEnvironment(_CLEnvironment):
+
+    def __init__(self, name, global_mem_size, max_mem_alloc_size, is_gpu=True):
+        super(_DeviceEnvironment, self).__init__(name, is_gpu)
+        self.device = _Device(global_mem_size, max_mem_alloc_size)
+
+
+class _MemoryModel(object):
+
+    name = 'Tensor'
+
+    def __init__(self, double_precision=False, nmr_inst=100, nmr_params=5, nmr_maps=7):
+        self.double_precision = double_precision
+        self._nmr_inst = nmr_inst
+        self._nmr_params = nmr_params
+        self._nmr_maps = nmr_maps
+
+    def get_nmr_inst_per_problem(self):
+        return self._nmr_inst
+
+    def get_nmr_estimable_parameters(self):
+        return self._nmr_params
+
+    def get_optimization_output_param_names(self):
+        return ['map_{}'.format(ind) for ind in range(self._nmr_maps)]
+
+
+class TestMemoryBudget(unittest.TestCase):
+
+    # with the default _MemoryModel in single precision we need 2980 bytes per voxel on the device and 1136 on the host
+    device_bytes = 4 * (100 * (2 + 5) + 5 * (5 + 4))
+    host_bytes = 4 * 2 * 100 + 8 * (7 + 5 ** 2 + 10)
+
+    def _get_nmr_voxels(self, cl_environments, available_host_memory=None, **kwargs):
+        with mot.configuration.config_context(mot.configuration.RuntimeConfigurationAction(
+                cl_environments=cl_environments, load_balancer=_PreferGPU())):
+            with mock.patch('mdt.processing_strategies.get_available_host_memory',
+                            return_value=available_host_memory):
+                return get_memory_limited_nmr_voxels(_MemoryModel(), **kwargs)
+
+    def test_estimate_voxel_memory(self):
+        self.assertEqual(estimate_voxel_memory(_MemoryModel()), (self.host_bytes, self.device_bytes))
+
+        host_bytes, device_bytes = estimate_voxel_memory(_MemoryModel(double_precision=True))
+        self.assertEqual(device_bytes, 2 * self.device_bytes)
+        self.assertEqual(host_bytes, 8 * 2 * 100 + 8 * (7 + 5 ** 2 + 10))
+
+    def test_device_memory_is_smallest_device(self):
+        environments = [_DeviceEnvironment('gpu_0', 4000, 1000), _DeviceEnvironment('gpu_1', 2000, 3000)]
+        self.assertEqual(get_device_memory(environments), (2000, 1000))
+
+    def test_device_memory_uses_load_balancer(self):
+        environments = [_DeviceEnvironment('gpu', 4000, 3000), _DeviceEnvironment('cpu', 1000, 1000, is_gpu=False)]
+        with mot.configuration.config_context(mot.configuration.RuntimeConfigurationAction(
+                cl_environments=environments, load_balancer=_PreferGPU())):
+            self.assertEqual(get_device_memory(), (4000, 3000))
+
+    def test_max_buffer_size_limit(self):
+        max_mem_alloc_size = 4 * 100 * 50 + 3
+        nmr_voxels = self._get_nmr_voxels([_DeviceEnvironment('gpu', 10 ** 12, max_mem_alloc_size)],
+                                          host_memory=1, device_memory=1)
+        self.assertEqual(nmr_voxels, max_mem_alloc_size // (4 * 100))
+        self.assertEqual(nmr_voxels, 50)
+
+    def test_global_memory_limit(self):
+        environments = [_DeviceEnvironment('gpu_0', self.device_bytes * 2000, 10 ** 12),
+                        _DeviceEnvironment('gpu_1', self.device_bytes * 1000 + 10, 10 ** 12)]
+        self.assertEqual(self._get_nmr_voxels(environments, host_memory=10 ** 6), 500)
+        self.assertEqual(self._get_nmr_voxels(environments, host_memory=10 ** 6, memory_fraction=1), 1000)
+
+    def test_device_memory_setting(self):
+        nmr_voxels = self._get_nmr_voxels([_DeviceEnvironment('gpu', 10 ** 12, 10 ** 12)],
+                                          host_memory=10 ** 6, device_memory=1)
+        self.assertEqual(nmr_voxels, 1024 ** 2 // self.device_bytes)
+
+    def test_host_memory_limit(self):
+        environments = [_DeviceEnvironment('gpu', 10 ** 12, 10 ** 12)]
+
+        self.assertEqual(self._get_nmr_voxels(environments, host_memory=1), 1024 ** 2 // self.host_bytes)
+        self.assertEqual(self._get_nmr_voxels(environments, available_host_memory=self.host_bytes * 600), 300)
+        self.assertEqual(self._get_nmr_voxels(environments, available_host_memory=None),
+                         int(10 ** 12 * 0.5) // self.device_bytes)
+
+
+class TestThroughputTuner(unittest.TestCase):
+
+    def _tune(self, throughput_function, chunk_size, step_factor=2.0, min_size=1000, max_size=10 ** 6,
+              nmr_chunks=40):
+        def bounded(nmr_voxels):
+            return int(min(max_size, max(min_size, nmr_voxels)))
+
+        tuner = ThroughputTuner(bounded(chunk_size), step_factor, bounded)
+        chunk_sizes = []
+        for _ in range(nmr_chunks):
+            chunk_sizes.append(tuner.chunk_size)
+            tuner.add_measurement(tuner.chunk_size, tuner.chunk_size / throughput_function(tuner.chunk_size))
+        return tuner, chunk_sizes
+
+    def test_converges_to_best_throughput(self):
+        def throughput(nmr_voxels):
+            return 1e6 / (1 + math.log(nmr_voxels / 30000.0) ** 2)
+
+        tuner, chunk_sizes = self._tune(throughput, 1000)
+
+        self.assertAlmostEqual(math.log(tuner.best_chunk_size / 30000.0), 0, delta=math.log(1.2))
+        self.assertEqual(set(chunk_sizes[-10:]), {tuner.best_chunk_size})
+
+    def test_shrinks_if_smaller_is_better(self):
+        tuner, chunk_sizes = self._tune(lambda nmr_voxels: 1e9 / nmr_voxels ** 0.5, 50000)
+
+        self.assertEqual(tuner.best_chunk_size, 1000)
+        self.assertEqual(chunk_sizes[-1], 1000)
+
+    def test_bounded(self):
+        tuner, chunk_sizes = self._tune(lambda nmr_voxels: nmr_voxels, 1000, max_size=20000)
+
+        self.assertEqual(max(chunk_sizes), 20000)
+        self.assertEqual(tuner.best_chunk_size, 20000)
+        self.assertEqual(chunk_sizes[-1], 20000)
+
+    def test_cached_size_fine_tuning(self):
+        def throughput(nmr_voxels):
+            return 1e6 / (1 + math.log(nmr_voxels / 30000.0) ** 2)
+
+        tuner, chunk_sizes = self._tune(throughput, 30000, step_factor=1.25)
+
+        self.assertTrue(all(30000 / 1.25 <= size <= 30000 * 1.25 for size in chunk_sizes))
+        self.assertEqual(tuner.best_chunk_size, 30000)
+
+
+class TestChunkSizeTuningCache(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp()
+        self._cache_file = os.path.join(self._tmp_dir, 'config', 'chunk_size_tuning.json')
+        self._environments = [_CLEnvironment('gpu_0', True), _CLEnvironment('cpu', False)]
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def test_miss_and_hit(self):
+        key = ChunkSizeTuningCache.get_key(_MemoryModel(), self._environments[:1])
+        self.assertIsNone(ChunkSizeTuningCache(self._cache_file).get(key))
+
+        ChunkSizeTuningCache(self._cache_file).set(key, 12345.0)
+        self.assertEqual(ChunkSizeTuningCache(self._cache_file).get(key), 12345)
+
+        other_key = ChunkSizeTuningCache.get_key(_MemoryModel(double_precision=True), self._environments[:1])
+        self.assertIsNone(ChunkSizeTuningCache(self._cache_file).get(other_key))
+
+    def test_key_uses_load_balancer(self):
+        model = _MemoryModel()
+        with mot.configuration.config_context(mot.configuration.RuntimeConfigurationAction(
+                cl_environments=self._environments, load_balancer=_PreferGPU())):
+            key = ChunkSizeTuningCache.get_key(model)
+
+        self.assertEqual(key, ChunkSizeTuningCache.get_key(model, self._environments[:1]))
+        self.assertNotEqual(key, ChunkSizeTuningCache.get_key(model, self._environments))
+
+    def test_invalid_cache_file(self):
+        os.makedirs(os.path.dirname(self._cache_file))
+        with open(self._cache_file, 'w') as f:
+            f.write('{"Tensor | 100')
+
+        self.assertIsNone(ChunkSizeTuningCache(self._cache_file).get('Tensor | 100'))
+        ChunkSizeTuningCache(self._cache_file).set('Tensor | 100', 1000)
+        self.assertEqual(ChunkSizeTuningCache(self._cache_file).get('Tensor | 100'), 1000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,256 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import nibabel as nib
+import numpy as np
+from mot.cl_routines.optimizing.multi_step_optimizer import MultiStepOptimizer
+from mot.cl_routines.optimizing.nmsimplex import NMSimplex
+from mot.cl_routines.optimizing.powell import Powell
+from mot.cl_routines.optimizing.random_restart import RandomRestart, RandomStartingPoint
+
+from mdt.__version__ import __version__
+from mdt.nifti import ScaledVolume
+from mdt.utils import get_optimizer_info, get_model_fit_fingerprint, get_fingerprint, OutputMapsSelection, \
+    write_output_manifest, load_output_manifest, remove_output_manifest, model_output_exists, LazyROI, \
+    VolumeSubset, create_roi
+
+__author__ = 'Robbert Harms'
+__date__ = "2017-06-22"
+__license__ = "LGPL v3"
+__maintainer__ = "Robbert Harms"
+__email__ = "robbert.harms@maastrichtuniversity.nl"
+
+
+class _Setting(object):
+
+    def __init__(self, value):
+        self.value = value
+
+
+class _Optimizer(object):
+
+    def __init__(self, **settings):
+        self.patience = 1
+        self.optimizer_settings = settings
+
+
+class TestOptimizerInfo(unittest.TestCase):
+
+    def test_no_optimizer(self):
+        self.assertIsNone(get_optimizer_info(None))
+
+    def test_settings(self):
+        info = get_optimizer_info(Powell(patience=2))
+        self.assertEqual(info['name'], 'Powell')
+        self.assertEqual(info['patience'], 2)
+        self.assertEqual(info['settings']['patience'], 2)
+
+    def test_multi_step_optimizers(self):
+        powell = get_optimizer_info(MultiStepOptimizer([Powell(patience=2)]))
+        simplex = get_optimizer_info(MultiStepOptimizer([NMSimplex(patience=50)]))
+
+        self.assertEqual([info['name'] for info in powell['optimizers']], ['Powell'])
+        self.assertNotEqual(powell, simplex)
+        self.assertNotEqual(get_fingerprint(powell), get_fingerprint(simplex))
+
+    def test_random_restart_optimizer(self):
+        powell = get_optimizer_info(RandomRestart(Powell(patience=2), RandomStartingPoint(3)))
+        simplex = get_optimizer_info(RandomRestart(NMSimplex(patience=2), RandomStartingPoint(3)))
+        more_runs = get_optimizer_info(RandomRestart(Powell(patience=2), RandomStartingPoint(5)))
+
+        self.assertEqual(powell['optimizer']['name'], 'Powell')
+        self.assertNotEqual(powell, simplex)
+        self.assertNotEqual(powell, more_runs)
+
+    def test_stable_object_settings(self):
+        first = get_optimizer_info(_Optimizer(setting=_Setting(2), array=np.arange(3), scalar=np.float32(1.5)))
+        second = get_optimizer_info(_Optimizer(setting=_Setting(2), array=np.arange(3), scalar=np.float32(1.5)))
+        changed = get_optimizer_info(_Optimizer(setting=_Setting(3), array=np.arange(3), scalar=np.float32(1.5)))
+
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, changed)
+        self.assertEqual(json.loads(json.dumps(first)), first)
+
+
+class _ProblemData(object):
+
+    def get_input_fingerprint(self):
+        return 'input'
+
+
+class TestModelFitFingerprint(unittest.TestCase):
+
+    def _get_fingerprint(self, **kwargs):
+        return get_model_fit_fingerprint('Tensor', _ProblemData(), Powell(patience=2), **kwargs)
+
+    def test_without_refit_and_selection(self):
+        self.assertEqual(self._get_fingerprint(),
+                         get_fingerprint('Tensor', 'input', __version__, get_optimizer_info(Powell(patience=2))))
+        self.assertEqual(self._get_fingerprint(output_maps_selection=OutputMapsSelection(required=['Tensor.d'])),
+                         self._get_fingerprint())
+
+    def test_refit(self):
+        refit = self._get_fingerprint(refit_optimizer=NMSimplex(), refit_return_codes=[3, 1])
+
+        self.assertNotEqual(refit, self._get_fingerprint())
+        self.assertEqual(refit, self._get_fingerprint(refit_optimizer=NMSimplex(), refit_return_codes=[1, 3]))
+        self.assertNotEqual(refit, self._get_fingerprint(refit_optimizer=NMSimplex(), refit_return_codes=[1]))
+        self.assertNotEqual(refit, self._get_fingerprint(refit_optimizer=NMSimplex(patience=5),
+                                                         refit_return_codes=[1, 3]))
+
+    def test_output_maps_selection(self):
+        exclude = self._get_fingerprint(output_maps_selection=OutputMapsSelection(exclude=['Tensor.vec']))
+
+        self.assertNotEqual(exclude, self._get_fingerprint())
+        self.assertNotEqual(exclude, self._get_fingerprint(
+            output_maps_selection=OutputMapsSelection(include=['Tensor.vec'])))
+
+
+class _Model(object):
+
+    name = 'Tensor'
+
+    def get_optimization_output_param_names(self):
+        return ['Tensor.d', 'Tensor.theta']
+
+
+class TestOutputManifest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp()
+        self._output_path = os.path.join(self._tmp_dir, 'Tensor')
+        os.makedirs(self._output_path)
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def _write_maps(self, map_names):
+        for map_name in map_names:
+            nib.save(nib.Nifti1Image(np.zeros((2, 3, 4), dtype=np.float32), np.eye(4)),
+                     os.path.join(self._output_path, map_name + '.nii.gz'))
+
+    def test_write_and_load(self):
+        self._write_maps(['Tensor.d', 'Tensor.theta'])
+        write_output_manifest(self._output_path, 'Tensor', 'abc', optimizer=Powell(patience=2))
+
+        manifest = load_output_manifest(self._output_path)
+        self.assertTrue(manifest['completed'])
+        self.assertEqual(manifest['fingerprint'], 'abc')
+        self.assertEqual(manifest['optimizer']['name'], 'Powell')
+        self.assertEqual(manifest['maps']['Tensor.d'], {'file': 'Tensor.d.nii.gz', 'shape': [2, 3, 4],
+                                                        'dtype': 'float32'})
+        self.assertEqual(os.listdir(self._output_path).count('manifest.json'), 1)
+
+    def test_output_exists(self):
+        self._write_maps(['Tensor.d', 'Tensor.theta'])
+        write_output_manifest(self._output_path, 'Tensor', 'abc')
+
+        self.assertTrue(model_output_exists(_Model(), self._tmp_dir))
+        self.assertTrue(model_output_exists(_Model(), self._tmp_dir, fingerprint='abc'))
+        self.assertFalse(model_output_exists(_Model(), self._tmp_dir, fingerprint='changed'))
+
+    def test_output_exists_uses_manifest(self):
+        self._write_maps(['Tensor.d'])
+        write_output_manifest(self._output_path, 'Tensor', 'abc')
+        self._write_maps(['Tensor.theta'])
+
+        self.assertFalse(model_output_exists(_Model(), self._tmp_dir))
+
+        remove_output_manifest(self._output_path)
+        self.assertIsNone(load_output_manifest(self._output_path))
+        self.assertTrue(model_output_exists(_Model(), self._tmp_dir))
+
+    def test_invalid_manifest(self):
+        self._write_maps(['Tensor.d', 'Tensor.theta'])
+        with open(os.path.join(self._output_path, 'manifest.json'), 'w') as f:
+            f.write('{"completed": tr')
+
+        self.assertIsNone(load_output_manifest(self._output_path))
+        self.assertTrue(model_output_exists(_Model(), self._tmp_dir))
+
+    def test_no_output(self):
+        self.assertFalse(model_output_exists(_Model(), os.path.join(self._tmp_dir, 'missing')))
+
+
+class TestLazyROI(unittest.TestCase):
+
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        self._volume = random_state.rand(4, 5, 6, 7)
+        self._mask = random_state.rand(4, 5, 6) > 0.5
+        self._items = [slice(None), 0, 3, -1, -5, slice(2, 10), slice(None, None, -3), np.array([5, 0, 2, 2]),
+                       np.array([-1, 1, -4]), np.arange(self._mask.sum()) % 3 == 0, (slice(None), 0),
+                       (np.array([1, 3]), -1), (4, np.array([0, -2])), (-2, slice(1, 4)), (np.array([0, 2]), Ellipsis)]
+
+    def _assert_roi(self, roi, expected):
+        self.assertEqual(roi.shape, expected.shape)
+        self.assertEqual(len(roi), expected.shape[0])
+        np.testing.assert_array_equal(np.asarray(roi), expected)
+
+        for item in self._items:
+            try:
+                expected_values = expected[item]
+            except IndexError:
+                self.assertRaises(IndexError, roi.__getitem__, item)
+                continue
+
+            values = roi[item]
+            self.assertEqual(values.dtype, expected.dtype)
+            np.testing.assert_array_equal(values, expected_values)
+
+    def test_c_order(self):
+        volume = np.ascontiguousarray(self._volume)
+        self._assert_roi(LazyROI(volume, self._mask), volume[self._mask])
+
+    def test_f_order(self):
+        volume = np.asfortranarray(self._volume)
+        self._assert_roi(LazyROI(volume, self._mask), volume[self._mask])
+
+    def test_non_contiguous(self):
+        volume = np.random.RandomState(1).rand(8, 5, 6, 14)[::2, :, :, ::2]
+        self.assertFalse(volume.flags.c_contiguous or volume.flags.f_contiguous)
+        self._assert_roi(LazyROI(volume, self._mask), volume[self._mask])
+
+    def test_three_dimensional(self):
+        for volume in [self._volume[..., 0].copy(), np.asfortranarray(self._volume[..., 0]), self._volume[..., 0]]:
+            self._assert_roi(LazyROI(volume, self._mask), volume[self._mask][:, None])
+
+    def test_volume_indices(self):
+        volume_indices = np.array([6, 0, 3])
+        roi = LazyROI(self._volume, self._mask, volume_indices=volume_indices)
+        self._assert_roi(roi, self._volume[self._mask][:, volume_indices])
+        self._assert_roi(roi.get_volume_subset([2, 0]), self._volume[self._mask][:, [3, 6]])
+        self._assert_roi(LazyROI(self._volume, self._mask).get_volume_subset(np.array([-1, 1])),
+                         self._volume[self._mask][:, [6, 1]])
+
+    def test_volume_subset(self):
+        subset = VolumeSubset(VolumeSubset(np.asfortranarray(self._volume), [1, 2, 4, 6]), [3, 0])
+        self._assert_roi(LazyROI(subset, self._mask), self._volume[self._mask][:, [6, 1]])
+        self._assert_roi(LazyROI(subset, self._mask, volume_indices=[1]), self._volume[self._mask][:, [1]])
+
+    def test_scaled_volume(self):
+        data = np.asfortranarray(np.random.RandomState(2).randint(-100, 100, size=(4, 5, 6, 7)).astype(np.int16))
+        expected = (data[self._mask].astype(np.float32) * 2.5 + 1).astype(np.float32)
+
+        roi = LazyROI(ScaledVolume(data, 2.5, 1, dtype=np.float32), self._mask)
+        self._assert_roi(roi, expected)
+        self._assert_roi(LazyROI(VolumeSubset(ScaledVolume(data, 2.5, 1, dtype=np.float32), [2, 5]), self._mask),
+                         expected[:, [2, 5]])
+
+    def test_dtype(self):
+        data = np.random.RandomState(3).randint(0, 100, size=(4, 5, 6, 7)).astype(np.uint8)
+        self._assert_roi(LazyROI(data, self._mask, dtype=np.float64), data[self._mask].astype(np.float64))
+        self._assert_roi(LazyROI(data, self._mask), data[self._mask])
+
+    def test_create_roi(self):
+        subset = VolumeSubset(self._volume, [0, 5])
+        np.testing.assert_array_equal(create_roi(subset, self._mask), self._volume[self._mask][:, [0, 5]])
+        np.testing.assert_array_equal(create_roi(self._volume, self._mask), self._volume[self._mask])
+        self._assert_roi(create_roi(self._volume, self._mask, lazy=True), self._volume[self._mask])
+
+
+if __name__ == '__main__':
+    unittest.main()